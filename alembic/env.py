@@ -0,0 +1,38 @@
+import asyncio
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from src import models
+
+config = context.config
+# Cuando la API ejecuta las migraciones al iniciar ya tiene su propia configuración de logging
+if config.config_file_name is not None and "connection" not in config.attributes:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+target_metadata = models.Base.metadata
+
+
+def ejecutar_migraciones(connection):
+    context.configure(connection=connection, target_metadata=target_metadata)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def ejecutar_migraciones_async():
+    engine = create_async_engine(models.DATABASE_URL)
+    async with engine.connect() as connection:
+        await connection.run_sync(ejecutar_migraciones)
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    context.configure(url=models.DATABASE_URL, target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+elif "connection" in config.attributes:
+    # Conexión compartida por models.create_db_and_tables()
+    ejecutar_migraciones(config.attributes["connection"])
+else:
+    asyncio.run(ejecutar_migraciones_async())
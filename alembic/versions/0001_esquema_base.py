@@ -0,0 +1,176 @@
+"""esquema base: registro de sensores y tabla de lecturas
+
+Adopta las bases creadas antes de usar Alembic (Base.metadata.create_all), incluida la
+tabla 'sensores' original que mezclaba definición y lecturas.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def crear_si_no_existe(inspector, nombre, *columnas, indices=()):
+    if inspector.has_table(nombre):
+        return
+    op.create_table(nombre, *columnas)
+    for indice, campos, unico in indices:
+        op.create_index(indice, nombre, campos, unique=unico)
+
+
+def upgrade():
+    conexion = op.get_bind()
+    inspector = sa.inspect(conexion)
+    legado = inspector.has_table("sensores") and "valor" in {c["name"] for c in inspector.get_columns("sensores")}
+    if legado:
+        apartar_tabla_sensores_legado()
+        inspector = sa.inspect(conexion)
+
+    crear_si_no_existe(
+        inspector, "user",
+        sa.Column("id", postgresql.UUID(), nullable=False),
+        sa.Column("email", sa.String(length=320), nullable=False),
+        sa.Column("hashed_password", sa.String(length=1024), nullable=False),
+        sa.Column("is_active", sa.Boolean(), nullable=False),
+        sa.Column("is_superuser", sa.Boolean(), nullable=False),
+        sa.Column("is_verified", sa.Boolean(), nullable=False),
+        sa.Column("verification_code", sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        indices=[("ix_user_email", ["email"], True)],
+    )
+    crear_si_no_existe(
+        inspector, "maquinas",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("nombre", sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        indices=[("ix_maquinas_id", ["id"], False)],
+    )
+    crear_si_no_existe(
+        inspector, "tipos_sensor",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("tipo", sa.String(), nullable=False),
+        sa.Column("unidad", sa.String(), nullable=False),
+        sa.Column("ventana_anomalias", sa.Integer(), nullable=True),
+        sa.Column("umbral_z", sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        indices=[("ix_tipos_sensor_id", ["id"], False)],
+    )
+    crear_si_no_existe(
+        inspector, "sensores",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("tipo_sensor_id", sa.Integer(), nullable=True),
+        sa.Column("maquina_id", sa.Integer(), nullable=True),
+        sa.Column("nombre", sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(["maquina_id"], ["maquinas.id"]),
+        sa.ForeignKeyConstraint(["tipo_sensor_id"], ["tipos_sensor.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("maquina_id", "tipo_sensor_id", "nombre"),
+        indices=[("ix_sensores_id", ["id"], False)],
+    )
+    crear_si_no_existe(
+        inspector, "lecturas",
+        sa.Column("id", sa.BigInteger(), nullable=False),
+        sa.Column("sensor_id", sa.Integer(), nullable=False),
+        sa.Column("fecha_hora", postgresql.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column("valor", sa.Float(), nullable=True),
+        sa.Column("estado", sa.Boolean(), nullable=True),
+        sa.ForeignKeyConstraint(["sensor_id"], ["sensores.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    crear_si_no_existe(
+        inspector, "ultimas_lecturas",
+        sa.Column("sensor_id", sa.Integer(), nullable=False),
+        sa.Column("lectura_id", sa.BigInteger(), nullable=True),
+        sa.Column("fecha_hora", postgresql.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column("valor", sa.Float(), nullable=True),
+        sa.Column("estado", sa.Boolean(), nullable=True),
+        sa.ForeignKeyConstraint(["sensor_id"], ["sensores.id"]),
+        sa.PrimaryKeyConstraint("sensor_id"),
+    )
+    crear_si_no_existe(
+        inspector, "eventos_criticos",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("timestamp", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("sensor_id", sa.Integer(), nullable=True),
+        sa.Column("lectura_id", sa.BigInteger(), nullable=True),
+        sa.Column("value", sa.Float(), nullable=True),
+        sa.Column("description", sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(["sensor_id"], ["sensores.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        indices=[("ix_eventos_criticos_id", ["id"], False)],
+    )
+    crear_si_no_existe(
+        inspector, "notificaciones",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("event_id", sa.Integer(), nullable=True),
+        sa.Column("sent_to", sa.String(), nullable=True),
+        sa.Column("sent_timestamp", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("status", sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(["event_id"], ["eventos_criticos.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        indices=[("ix_notificaciones_id", ["id"], False)],
+    )
+
+    # Columnas agregadas después de la creación inicial de las tablas
+    op.execute("ALTER TABLE tipos_sensor ADD COLUMN IF NOT EXISTS ventana_anomalias INTEGER")
+    op.execute("ALTER TABLE tipos_sensor ADD COLUMN IF NOT EXISTS umbral_z FLOAT")
+    op.execute("ALTER TABLE eventos_criticos ADD COLUMN IF NOT EXISTS lectura_id BIGINT")
+
+    if legado:
+        migrar_lecturas_legado()
+
+    # Último valor por sensor: luego lo mantiene la ingesta
+    op.execute(
+        "INSERT INTO ultimas_lecturas (sensor_id, lectura_id, fecha_hora, valor, estado) "
+        "SELECT DISTINCT ON (sensor_id) sensor_id, id, fecha_hora, valor, estado FROM lecturas "
+        "ORDER BY sensor_id, fecha_hora DESC "
+        "ON CONFLICT (sensor_id) DO NOTHING"
+    )
+
+
+def apartar_tabla_sensores_legado():
+    # Se renombra para liberar el nombre al registro de sensores y copiar luego sus filas a 'lecturas'
+    op.execute("ALTER TABLE eventos_criticos DROP CONSTRAINT IF EXISTS eventos_criticos_sensor_id_fkey")
+    op.execute("ALTER TABLE sensores RENAME TO sensores_legado")
+    op.execute("ALTER TABLE sensores_legado RENAME CONSTRAINT sensores_pkey TO sensores_legado_pkey")
+    op.execute("ALTER INDEX IF EXISTS ix_sensores_id RENAME TO ix_sensores_legado_id")
+    op.execute("ALTER SEQUENCE IF EXISTS sensores_id_seq RENAME TO sensores_legado_id_seq")
+
+
+def migrar_lecturas_legado():
+    op.execute(
+        "INSERT INTO sensores (maquina_id, tipo_sensor_id, nombre) "
+        "SELECT DISTINCT maquina_id, tipo_sensor_id, nombre FROM sensores_legado"
+    )
+    # Se conservan los ids originales para que los eventos críticos sigan apuntando a su lectura
+    op.execute(
+        "INSERT INTO lecturas (id, sensor_id, fecha_hora, valor, estado) "
+        "SELECT l.id, s.id, l.fecha_hora, l.valor, l.estado FROM sensores_legado l "
+        "JOIN sensores s ON s.maquina_id IS NOT DISTINCT FROM l.maquina_id "
+        "AND s.tipo_sensor_id IS NOT DISTINCT FROM l.tipo_sensor_id AND s.nombre = l.nombre "
+        "WHERE l.fecha_hora IS NOT NULL"
+    )
+    op.execute(
+        "SELECT setval(pg_get_serial_sequence('lecturas', 'id'), COALESCE((SELECT MAX(id) FROM lecturas), 0) + 1, false)"
+    )
+    op.execute(
+        "UPDATE eventos_criticos e SET lectura_id = e.sensor_id, sensor_id = l.sensor_id "
+        "FROM lecturas l WHERE l.id = e.sensor_id AND e.lectura_id IS NULL"
+    )
+    op.execute(
+        "ALTER TABLE eventos_criticos ADD CONSTRAINT eventos_criticos_sensor_id_fkey "
+        "FOREIGN KEY (sensor_id) REFERENCES sensores (id)"
+    )
+
+
+def downgrade():
+    for tabla in ("notificaciones", "eventos_criticos", "ultimas_lecturas", "lecturas", "sensores", "tipos_sensor", "maquinas", "user"):
+        op.drop_table(tabla)
@@ -0,0 +1,104 @@
+"""índices de series de tiempo y particionado de lecturas por rango de fecha_hora
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+# Crea las particiones mensuales (en UTC) que falten entre dos fechas; la API la vuelve a
+# ejecutar periódicamente para tener siempre particiones futuras disponibles.
+FUNCION_CREAR_PARTICIONES = """
+CREATE OR REPLACE FUNCTION crear_particiones_lecturas(desde DATE, hasta DATE) RETURNS INTEGER AS $$
+DECLARE
+    mes DATE := date_trunc('month', desde)::date;
+    nombre TEXT;
+    creadas INTEGER := 0;
+BEGIN
+    WHILE mes <= hasta LOOP
+        nombre := 'lecturas_' || to_char(mes, 'YYYY_MM');
+        IF to_regclass(nombre) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF lecturas FOR VALUES FROM (%L) TO (%L)',
+                nombre,
+                mes::timestamp AT TIME ZONE 'UTC',
+                (mes + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC'
+            );
+            creadas := creadas + 1;
+        END IF;
+        mes := (mes + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN creadas;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.execute("ALTER TABLE lecturas RENAME TO lecturas_sin_particion")
+    op.execute("ALTER TABLE lecturas_sin_particion RENAME CONSTRAINT lecturas_pkey TO lecturas_sin_particion_pkey")
+    op.execute("ALTER TABLE lecturas_sin_particion DROP CONSTRAINT IF EXISTS lecturas_sensor_id_fkey")
+    op.execute("ALTER SEQUENCE lecturas_id_seq OWNED BY NONE")
+
+    # La clave primaria de una tabla particionada debe incluir la columna de partición
+    op.execute(
+        "CREATE TABLE lecturas ("
+        "id BIGINT NOT NULL DEFAULT nextval('lecturas_id_seq'), "
+        "sensor_id INTEGER NOT NULL REFERENCES sensores (id), "
+        "fecha_hora TIMESTAMP WITH TIME ZONE NOT NULL, "
+        "valor FLOAT, "
+        "estado BOOLEAN, "
+        "PRIMARY KEY (id, fecha_hora)"
+        ") PARTITION BY RANGE (fecha_hora)"
+    )
+    op.execute("ALTER SEQUENCE lecturas_id_seq OWNED BY lecturas.id")
+    op.create_index("ix_lecturas_sensor_fecha", "lecturas", ["sensor_id", sa.text("fecha_hora DESC")])
+
+    op.execute(FUNCION_CREAR_PARTICIONES)
+    # Lecturas fuera de las particiones mensuales (p. ej. relojes de dispositivos desfasados)
+    op.execute("CREATE TABLE lecturas_default PARTITION OF lecturas DEFAULT")
+    op.execute(
+        "SELECT crear_particiones_lecturas("
+        "(COALESCE((SELECT MIN(fecha_hora) FROM lecturas_sin_particion), now()) AT TIME ZONE 'UTC')::date, "
+        "((now() AT TIME ZONE 'UTC') + INTERVAL '3 months')::date)"
+    )
+    op.execute(
+        "INSERT INTO lecturas (id, sensor_id, fecha_hora, valor, estado) "
+        "SELECT id, sensor_id, fecha_hora, valor, estado FROM lecturas_sin_particion"
+    )
+    op.execute("DROP TABLE lecturas_sin_particion")
+
+    op.create_index("ix_sensores_maquina_nombre", "sensores", ["maquina_id", "nombre"])
+    op.create_index("ix_eventos_criticos_sensor_timestamp", "eventos_criticos", ["sensor_id", sa.text("timestamp DESC")])
+
+
+def downgrade():
+    op.drop_index("ix_eventos_criticos_sensor_timestamp", table_name="eventos_criticos")
+    op.drop_index("ix_sensores_maquina_nombre", table_name="sensores")
+
+    op.execute("ALTER TABLE lecturas RENAME TO lecturas_particionada")
+    op.execute("ALTER TABLE lecturas_particionada RENAME CONSTRAINT lecturas_pkey TO lecturas_particionada_pkey")
+    op.execute("ALTER SEQUENCE lecturas_id_seq OWNED BY NONE")
+    op.execute(
+        "CREATE TABLE lecturas ("
+        "id BIGINT NOT NULL DEFAULT nextval('lecturas_id_seq') PRIMARY KEY, "
+        "sensor_id INTEGER NOT NULL REFERENCES sensores (id), "
+        "fecha_hora TIMESTAMP WITH TIME ZONE NOT NULL, "
+        "valor FLOAT, "
+        "estado BOOLEAN"
+        ")"
+    )
+    op.execute("ALTER SEQUENCE lecturas_id_seq OWNED BY lecturas.id")
+    op.execute(
+        "INSERT INTO lecturas (id, sensor_id, fecha_hora, valor, estado) "
+        "SELECT id, sensor_id, fecha_hora, valor, estado FROM lecturas_particionada"
+    )
+    op.execute("DROP TABLE lecturas_particionada CASCADE")
+    op.execute("DROP FUNCTION IF EXISTS crear_particiones_lecturas(DATE, DATE)")
@@ -0,0 +1,53 @@
+"""agregados por minuto, hora y día de las lecturas
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+TRUNCADO = {"minuto": "minute", "hora": "hour", "dia": "day"}
+
+
+def upgrade():
+    op.create_table(
+        "lecturas_agregadas",
+        sa.Column("resolucion", sa.String(), nullable=False),
+        sa.Column("sensor_id", sa.Integer(), nullable=False),
+        sa.Column("inicio", postgresql.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column("cantidad", sa.BigInteger(), nullable=False),
+        sa.Column("minimo", sa.Float(), nullable=True),
+        sa.Column("maximo", sa.Float(), nullable=True),
+        sa.Column("suma", sa.Float(), nullable=True),
+        sa.Column("suma_cuadrados", sa.Float(), nullable=True),
+        sa.Column("primero", sa.Float(), nullable=True),
+        sa.Column("ultimo", sa.Float(), nullable=True),
+        sa.Column("fecha_primero", postgresql.TIMESTAMP(timezone=True), nullable=True),
+        sa.Column("fecha_ultimo", postgresql.TIMESTAMP(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(["sensor_id"], ["sensores.id"]),
+        sa.PrimaryKeyConstraint("resolucion", "sensor_id", "inicio"),
+    )
+
+    # Carga inicial desde las lecturas existentes; luego los mantiene la ingesta
+    for resolucion, campo in TRUNCADO.items():
+        op.execute(
+            "INSERT INTO lecturas_agregadas (resolucion, sensor_id, inicio, cantidad, minimo, maximo, suma, "
+            "suma_cuadrados, primero, ultimo, fecha_primero, fecha_ultimo) "
+            f"SELECT '{resolucion}', sensor_id, date_trunc('{campo}', fecha_hora AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', "
+            "COUNT(*), MIN(valor), MAX(valor), SUM(valor), SUM(valor * valor), "
+            "(array_agg(valor ORDER BY fecha_hora))[1], (array_agg(valor ORDER BY fecha_hora DESC))[1], "
+            "MIN(fecha_hora), MAX(fecha_hora) "
+            "FROM lecturas WHERE valor IS NOT NULL GROUP BY 1, 2, 3"
+        )
+
+
+def downgrade():
+    op.drop_table("lecturas_agregadas")
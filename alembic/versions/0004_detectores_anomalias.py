@@ -0,0 +1,26 @@
+"""detector de anomalías configurable por tipo de sensor y por sensor
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for tabla in ("tipos_sensor", "sensores"):
+        op.add_column(tabla, sa.Column("detector", sa.String(), nullable=True))
+        op.add_column(tabla, sa.Column("parametros_detector", sa.JSON(), nullable=True))
+
+
+def downgrade():
+    for tabla in ("sensores", "tipos_sensor"):
+        op.drop_column(tabla, "parametros_detector")
+        op.drop_column(tabla, "detector")
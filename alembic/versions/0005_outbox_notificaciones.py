@@ -0,0 +1,32 @@
+"""outbox de notificaciones: reintentos con espera exponencial
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("notificaciones", sa.Column("intentos", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("notificaciones", sa.Column("proximo_intento", sa.DateTime(timezone=True), nullable=True))
+    op.add_column("notificaciones", sa.Column("ultimo_error", sa.String(), nullable=True))
+    # El despachador solo recorre las pendientes
+    op.create_index(
+        "ix_notificaciones_pendientes", "notificaciones", ["proximo_intento"],
+        postgresql_where=sa.text("status = 'pendiente'")
+    )
+
+
+def downgrade():
+    op.drop_index("ix_notificaciones_pendientes", table_name="notificaciones")
+    op.drop_column("notificaciones", "ultimo_error")
+    op.drop_column("notificaciones", "proximo_intento")
+    op.drop_column("notificaciones", "intentos")
@@ -0,0 +1,25 @@
+"""retención de lecturas crudas y agregados por minuto por tipo de sensor
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # NULL: se conservan indefinidamente (o según RETENCION_DIAS / RETENCION_MINUTO_DIAS)
+    op.add_column("tipos_sensor", sa.Column("retencion_dias", sa.Integer(), nullable=True))
+    op.add_column("tipos_sensor", sa.Column("retencion_minuto_dias", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("tipos_sensor", "retencion_minuto_dias")
+    op.drop_column("tipos_sensor", "retencion_dias")
@@ -0,0 +1,87 @@
+"""crear particiones mensuales aunque lecturas_default ya tenga filas de ese mes
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+# Postgres rechaza CREATE TABLE ... PARTITION OF si la partición por defecto ya tiene filas del
+# rango nuevo (p. ej. lecturas con fecha futura antes de que exista su mes). En ese caso se separa
+# lecturas_default, se crea la partición, se mueven las filas del mes y se vuelve a adjuntar.
+FUNCION_CREAR_PARTICIONES = """
+CREATE OR REPLACE FUNCTION crear_particiones_lecturas(desde DATE, hasta DATE) RETURNS INTEGER AS $$
+DECLARE
+    mes DATE := date_trunc('month', desde)::date;
+    nombre TEXT;
+    inicio TIMESTAMPTZ;
+    fin TIMESTAMPTZ;
+    creadas INTEGER := 0;
+BEGIN
+    WHILE mes <= hasta LOOP
+        nombre := 'lecturas_' || to_char(mes, 'YYYY_MM');
+        inicio := mes::timestamp AT TIME ZONE 'UTC';
+        fin := (mes + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC';
+        IF to_regclass(nombre) IS NULL THEN
+            IF EXISTS (SELECT 1 FROM lecturas_default WHERE fecha_hora >= inicio AND fecha_hora < fin) THEN
+                ALTER TABLE lecturas DETACH PARTITION lecturas_default;
+                EXECUTE format('CREATE TABLE %I PARTITION OF lecturas FOR VALUES FROM (%L) TO (%L)', nombre, inicio, fin);
+                EXECUTE format(
+                    'WITH movidas AS ('
+                    'DELETE FROM lecturas_default WHERE fecha_hora >= %L AND fecha_hora < %L '
+                    'RETURNING id, sensor_id, fecha_hora, valor, estado) '
+                    'INSERT INTO %I (id, sensor_id, fecha_hora, valor, estado) '
+                    'SELECT id, sensor_id, fecha_hora, valor, estado FROM movidas',
+                    inicio, fin, nombre
+                );
+                ALTER TABLE lecturas ATTACH PARTITION lecturas_default DEFAULT;
+            ELSE
+                EXECUTE format('CREATE TABLE %I PARTITION OF lecturas FOR VALUES FROM (%L) TO (%L)', nombre, inicio, fin);
+            END IF;
+            creadas := creadas + 1;
+        END IF;
+        mes := (mes + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN creadas;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+FUNCION_ANTERIOR = """
+CREATE OR REPLACE FUNCTION crear_particiones_lecturas(desde DATE, hasta DATE) RETURNS INTEGER AS $$
+DECLARE
+    mes DATE := date_trunc('month', desde)::date;
+    nombre TEXT;
+    creadas INTEGER := 0;
+BEGIN
+    WHILE mes <= hasta LOOP
+        nombre := 'lecturas_' || to_char(mes, 'YYYY_MM');
+        IF to_regclass(nombre) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF lecturas FOR VALUES FROM (%L) TO (%L)',
+                nombre,
+                mes::timestamp AT TIME ZONE 'UTC',
+                (mes + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC'
+            );
+            creadas := creadas + 1;
+        END IF;
+        mes := (mes + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN creadas;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.execute(FUNCION_CREAR_PARTICIONES)
+
+
+def downgrade():
+    op.execute(FUNCION_ANTERIOR)
@@ -0,0 +1,25 @@
+"""marca de tiempo del servidor por defecto en eventos críticos y notificaciones
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Las inserciones que no pasan por el ORM (outbox, SQL directo) también reciben la hora actual
+    op.alter_column("eventos_criticos", "timestamp", server_default=sa.func.now())
+    op.alter_column("notificaciones", "sent_timestamp", server_default=sa.func.now())
+
+
+def downgrade():
+    op.alter_column("notificaciones", "sent_timestamp", server_default=None)
+    op.alter_column("eventos_criticos", "timestamp", server_default=None)
@@ -0,0 +1,182 @@
+import math
+import os
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import BigInteger, Float, case, cast, func
+from sqlalchemy.dialects.postgresql import ARRAY, array, insert as pg_insert
+from sqlalchemy.future import select
+from . import models
+
+RESOLUCIONES = {
+    "minuto": timedelta(minutes=1),
+    "hora": timedelta(hours=1),
+    "dia": timedelta(days=1),
+}
+# Con resolucion=auto se usa la resolución más fina que no supere este número de puntos por sensor
+AGREGADOS_MAX_PUNTOS = int(os.getenv("AGREGADOS_MAX_PUNTOS", 2000))
+# Rangos más cortos que este se leen directamente de 'lecturas'
+AGREGADOS_RANGO_CRUDO_MINUTOS = int(os.getenv("AGREGADOS_RANGO_CRUDO_MINUTOS", 60))
+FILAS_POR_SENTENCIA = 1000
+
+
+def a_utc(fecha_hora):
+    # Las fechas sin zona horaria recibidas por query se interpretan en UTC
+    if fecha_hora.tzinfo is None:
+        return fecha_hora.replace(tzinfo=timezone.utc)
+    return fecha_hora.astimezone(timezone.utc)
+
+
+def truncar(fecha_hora, resolucion):
+    fecha_hora = a_utc(fecha_hora).replace(second=0, microsecond=0)
+    if resolucion in ("hora", "dia"):
+        fecha_hora = fecha_hora.replace(minute=0)
+    if resolucion == "dia":
+        fecha_hora = fecha_hora.replace(hour=0)
+    return fecha_hora
+
+
+def elegir_resolucion(resolucion, fecha_inicio, fecha_fin=None):
+    if resolucion != "auto":
+        return resolucion
+    if fecha_inicio is None:
+        return "cruda"
+    rango = a_utc(fecha_fin or datetime.now(timezone.utc)) - a_utc(fecha_inicio)
+    if rango <= timedelta(minutes=AGREGADOS_RANGO_CRUDO_MINUTOS):
+        return "cruda"
+    for nombre, ancho in RESOLUCIONES.items():
+        if rango / ancho <= AGREGADOS_MAX_PUNTOS:
+            return nombre
+    return "dia"
+
+
+def agregar_lote(filas):
+    # Agregados parciales del lote por (resolución, sensor, ventana)
+    parciales = {}
+    for fila in filas:
+        valor = fila["valor"]
+        if valor is None:
+            continue
+        fecha_hora = fila["fecha_hora"]
+        for resolucion in RESOLUCIONES:
+            clave = (resolucion, fila["sensor_id"], truncar(fecha_hora, resolucion))
+            parcial = parciales.get(clave)
+            if parcial is None:
+                parciales[clave] = {
+                    "resolucion": resolucion,
+                    "sensor_id": fila["sensor_id"],
+                    "inicio": clave[2],
+                    "cantidad": 1,
+                    "minimo": valor,
+                    "maximo": valor,
+                    "suma": valor,
+                    "suma_cuadrados": valor * valor,
+                    "primero": valor,
+                    "ultimo": valor,
+                    "fecha_primero": fecha_hora,
+                    "fecha_ultimo": fecha_hora,
+                }
+                continue
+            parcial["cantidad"] += 1
+            parcial["minimo"] = min(parcial["minimo"], valor)
+            parcial["maximo"] = max(parcial["maximo"], valor)
+            parcial["suma"] += valor
+            parcial["suma_cuadrados"] += valor * valor
+            if fecha_hora < parcial["fecha_primero"]:
+                parcial["primero"], parcial["fecha_primero"] = valor, fecha_hora
+            if fecha_hora >= parcial["fecha_ultimo"]:
+                parcial["ultimo"], parcial["fecha_ultimo"] = valor, fecha_hora
+    # Orden estable de claves para que las actualizaciones concurrentes tomen los bloqueos en el mismo orden
+    return [parciales[clave] for clave in sorted(parciales)]
+
+
+async def actualizar_agregados(sesion_db, filas):
+    parciales = agregar_lote(filas)
+    agregado = models.LecturaAgregada
+    for desde in range(0, len(parciales), FILAS_POR_SENTENCIA):
+        consulta = pg_insert(agregado).values(parciales[desde:desde + FILAS_POR_SENTENCIA])
+        nuevo = consulta.excluded
+        consulta = consulta.on_conflict_do_update(
+            index_elements=[agregado.resolucion, agregado.sensor_id, agregado.inicio],
+            set_={
+                "cantidad": agregado.cantidad + nuevo.cantidad,
+                "minimo": func.least(agregado.minimo, nuevo.minimo),
+                "maximo": func.greatest(agregado.maximo, nuevo.maximo),
+                "suma": agregado.suma + nuevo.suma,
+                "suma_cuadrados": agregado.suma_cuadrados + nuevo.suma_cuadrados,
+                "primero": case((nuevo.fecha_primero < agregado.fecha_primero, nuevo.primero), else_=agregado.primero),
+                "fecha_primero": func.least(agregado.fecha_primero, nuevo.fecha_primero),
+                "ultimo": case((nuevo.fecha_ultimo >= agregado.fecha_ultimo, nuevo.ultimo), else_=agregado.ultimo),
+                "fecha_ultimo": func.greatest(agregado.fecha_ultimo, nuevo.fecha_ultimo),
+            }
+        )
+        await sesion_db.execute(consulta)
+
+
+def consulta_agregados(sensor_ids, resolucion, fecha_inicio=None, fecha_fin=None):
+    consulta = select(models.LecturaAgregada).where(
+        models.LecturaAgregada.resolucion == resolucion,
+        models.LecturaAgregada.sensor_id.in_(sensor_ids)
+    )
+    if fecha_inicio:
+        consulta = consulta.filter(models.LecturaAgregada.inicio >= truncar(fecha_inicio, resolucion))
+    if fecha_fin:
+        consulta = consulta.filter(models.LecturaAgregada.inicio <= fecha_fin)
+    return consulta
+
+
+def fuente_intervalos(ancho):
+    # Resolución agregada más gruesa que divide al intervalo; por debajo del minuto se agregan las lecturas crudas
+    for resolucion in ("dia", "hora", "minuto"):
+        if ancho % RESOLUCIONES[resolucion] == timedelta(0):
+            return resolucion
+    return "cruda"
+
+
+def consulta_intervalos(sensor_ids, fuente, origen, ancho, fecha_fin):
+    # Una sola agregación para todos los sensores, agrupada por sensor e intervalo floor((t - origen) / ancho)
+    # (date_bin() recién existe desde PostgreSQL 14). Filas: (sensor_id, índice, cantidad, suma, mínimo,
+    # máximo, [epoch, valor] del último); max() sobre el arreglo elige el último sin ordenar cada grupo.
+    if fuente == "cruda":
+        lectura = models.Lectura
+        sensor_id, instante = lectura.sensor_id, lectura.fecha_hora
+        columnas = [func.count(lectura.valor), func.sum(lectura.valor), func.min(lectura.valor), func.max(lectura.valor)]
+        ultimo = array([func.date_part("epoch", lectura.fecha_hora), lectura.valor])
+        filtros = [lectura.valor.isnot(None)]
+    else:
+        agregado = models.LecturaAgregada
+        sensor_id, instante = agregado.sensor_id, agregado.inicio
+        columnas = [cast(func.sum(agregado.cantidad), BigInteger), func.sum(agregado.suma), func.min(agregado.minimo), func.max(agregado.maximo)]
+        ultimo = array([func.date_part("epoch", agregado.fecha_ultimo), agregado.ultimo])
+        filtros = [agregado.resolucion == fuente]
+    indice = func.floor((func.date_part("epoch", instante) - origen.timestamp()) / ancho.total_seconds())
+    return (
+        select(sensor_id, indice, *columnas, func.max(ultimo, type_=ARRAY(Float)))
+        .where(sensor_id.in_(sensor_ids), instante >= origen, instante < fecha_fin, *filtros)
+        .group_by(sensor_id, indice)
+    )
+
+
+def combinar_intervalos(filas):
+    # {(sensor_id, índice): [cantidad, suma, mínimo, máximo, epoch del último, último]}; un mismo intervalo
+    # puede venir de la base y del archivo frío
+    intervalos = {}
+    for sensor_id, indice, cantidad, suma, minimo, maximo, (instante, ultimo) in filas:
+        clave = (sensor_id, int(indice))
+        actual = intervalos.get(clave)
+        if actual is None:
+            intervalos[clave] = [cantidad, suma, minimo, maximo, instante, ultimo]
+            continue
+        actual[0] += cantidad
+        actual[1] += suma
+        actual[2] = min(actual[2], minimo)
+        actual[3] = max(actual[3], maximo)
+        if instante >= actual[4]:
+            actual[4], actual[5] = instante, ultimo
+    return intervalos
+
+
+def desviacion_estandar(agregado):
+    if agregado.cantidad < 2:
+        return 0.0
+    media = agregado.suma / agregado.cantidad
+    varianza = (agregado.suma_cuadrados - agregado.cantidad * media * media) / (agregado.cantidad - 1)
+    return math.sqrt(max(varianza, 0.0))
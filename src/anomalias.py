@@ -0,0 +1,114 @@
+import os
+from sqlalchemy import func
+from sqlalchemy.future import select
+from . import models
+from .detectores import DETECTORES, crear_detector
+
+ANOMALIAS_VENTANA = int(os.getenv("ANOMALIAS_VENTANA", 100))
+ANOMALIAS_UMBRAL_Z = float(os.getenv("ANOMALIAS_UMBRAL_Z", 3))
+ANOMALIAS_DETECTOR = os.getenv("ANOMALIAS_DETECTOR", "zscore")
+
+
+def resolver_detector(config_tipo, config_sensor=None):
+    # config_tipo: (ventana, umbral, detector, parametros) del tipo de sensor;
+    # config_sensor: (detector, parametros) propios del sensor, que tienen prioridad.
+    # ventana_anomalias y umbral_z del tipo se aplican a los detectores que usan esos parámetros.
+    ventana, umbral, detector, parametros = config_tipo or (None, None, None, None)
+    if config_sensor and config_sensor[0]:
+        detector, parametros = config_sensor
+    detector = detector or ANOMALIAS_DETECTOR
+    clase = DETECTORES.get(detector)
+    if clase is None:
+        raise ValueError(f"Detector desconocido: {detector}")
+    if detector == "zscore":
+        # ANOMALIAS_VENTANA y ANOMALIAS_UMBRAL_Z son los valores por defecto del Z-score
+        ventana, umbral = ventana or ANOMALIAS_VENTANA, umbral or ANOMALIAS_UMBRAL_Z
+    base = {
+        clave: valor for clave, valor in (("ventana", ventana), ("umbral", umbral))
+        if valor is not None and clave in clase.parametros
+    }
+    return crear_detector(detector, {**base, **(parametros or {})})
+
+
+class MotorAnomalias:
+    # Un detector en memoria por sensor del registro (máquina/tipo/nombre), sembrado una sola vez
+    # desde el historial y luego actualizado incrementalmente con cada lectura.
+    def __init__(self):
+        self.estados = {}
+        self.config_tipos = {}
+        self.config_sensores = {}
+
+    async def cargar_configuracion(self):
+        async with models.get_async_session() as sesion:
+            tipos = await sesion.execute(
+                select(
+                    models.TipoSensor.id, models.TipoSensor.ventana_anomalias, models.TipoSensor.umbral_z,
+                    models.TipoSensor.detector, models.TipoSensor.parametros_detector
+                )
+            )
+            sensores = await sesion.execute(
+                select(models.Sensor.id, models.Sensor.detector, models.Sensor.parametros_detector)
+                .where(models.Sensor.detector.isnot(None))
+            )
+            self.config_tipos = {tipo_id: tuple(config) for tipo_id, *config in tipos.all()}
+            self.config_sensores = {sensor_id: tuple(config) for sensor_id, *config in sensores.all()}
+
+    def configurar_tipo(self, tipo_sensor):
+        self.config_tipos[tipo_sensor.id] = (
+            tipo_sensor.ventana_anomalias, tipo_sensor.umbral_z, tipo_sensor.detector, tipo_sensor.parametros_detector
+        )
+        # Los detectores con otra configuración se vuelven a sembrar en la próxima lectura
+        for clave in [clave for clave in self.estados if clave[0] == tipo_sensor.id]:
+            del self.estados[clave]
+
+    def configurar_sensor(self, sensor):
+        self.config_sensores[sensor.id] = (sensor.detector, sensor.parametros_detector)
+        for clave in [clave for clave in self.estados if clave[1] == sensor.id]:
+            del self.estados[clave]
+
+    async def _config_tipo(self, sesion_db, tipo_sensor_id):
+        if tipo_sensor_id not in self.config_tipos:
+            tipo_sensor = await sesion_db.get(models.TipoSensor, tipo_sensor_id)
+            self.config_tipos[tipo_sensor_id] = (
+                (tipo_sensor.ventana_anomalias, tipo_sensor.umbral_z, tipo_sensor.detector, tipo_sensor.parametros_detector)
+                if tipo_sensor else None
+            )
+        return self.config_tipos[tipo_sensor_id]
+
+    async def crear_detector(self, sesion_db, tipo_sensor_id, sensor_id, detector=None):
+        # Con 'detector' se ignora el configurado para el sensor (p. ej. para comparar detectores)
+        config_sensor = (detector, None) if detector else self.config_sensores.get(sensor_id)
+        return resolver_detector(await self._config_tipo(sesion_db, tipo_sensor_id), config_sensor)
+
+    async def _sembrar(self, sesion_db, lectura, detector):
+        if detector.historial <= 0:
+            return
+        historial = await sesion_db.execute(
+            select(models.Lectura.valor, func.date_part("epoch", models.Lectura.fecha_hora))
+            .filter(
+                models.Lectura.sensor_id == lectura.sensor_id,
+                models.Lectura.id < lectura.id,
+                models.Lectura.valor.isnot(None)
+            )
+            .order_by(models.Lectura.fecha_hora.desc())
+            .limit(detector.historial)
+        )
+        filas = historial.all()[::-1]
+        detector.sembrar([valor for valor, _ in filas], [instante for _, instante in filas])
+
+    async def evaluar(self, sesion_db, lectura, tipo_sensor_id):
+        # Devuelve (detector, puntaje) si la lectura es anómala para el detector del sensor, o None
+        clave = (tipo_sensor_id, lectura.sensor_id)
+        detector = self.estados.get(clave)
+        if detector is None:
+            detector = await self.crear_detector(sesion_db, tipo_sensor_id, lectura.sensor_id)
+            await self._sembrar(sesion_db, lectura, detector)
+            self.estados[clave] = detector
+
+        puntaje = detector.actualizar(lectura.valor, lectura.fecha_hora.timestamp())
+        if detector.es_anomalo(puntaje):
+            return detector, puntaje
+        return None
+
+
+motor_anomalias = MotorAnomalias()
@@ -0,0 +1,435 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict, namedtuple
+from datetime import date, datetime, time as hora, timedelta, timezone
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+from sqlalchemy import text
+from sqlalchemy.future import select
+from . import models
+from .agregados import a_utc
+from .exportacion import ESQUEMA_ARROW, EXPORTACION_FILAS_POR_BLOQUE
+from .retencion import INICIO, RETENCION_LOCK_TIMEOUT_MS, RETENCION_LOTE, RETENCION_PAUSA_MS, retencion
+
+logger = logging.getLogger("SensorApi")
+
+# Archivo frío de lecturas crudas: <ARCHIVO_DIR>/maquina_<id>/<AAAA-MM-DD>.parquet, un archivo por máquina
+# y día UTC. Con varios procesos o nodos debe ser un directorio compartido.
+ARCHIVO_DIR = os.path.abspath(os.getenv("ARCHIVO_DIR", "archivo"))
+# Las lecturas con más de ARCHIVO_DIAS días se mueven de 'lecturas' al archivo; vacío = no se archiva
+ARCHIVO_DIAS = int(os.getenv("ARCHIVO_DIAS") or 0) or None
+ARCHIVO_INTERVALO_H = float(os.getenv("ARCHIVO_INTERVALO_H", 24))
+ARCHIVO_COMPRESION = os.getenv("ARCHIVO_COMPRESION", "zstd")
+# Los archivos se ordenan por sensor y fecha: las estadísticas de cada row group permiten saltear
+# los que no tienen el sensor o el rango pedidos sin descomprimirlos
+ARCHIVO_FILAS_POR_GRUPO = int(os.getenv("ARCHIVO_FILAS_POR_GRUPO", 65536))
+BLOQUEO_ARCHIVO = 7261003
+# <ARCHIVO_DIR>/marca: fin (exclusivo, en UTC) de los días archivados por completo. Las lecturas anteriores
+# se leen solo del archivo y las posteriores solo de la base, así una lectura nunca se cuenta dos veces.
+NOMBRE_MARCA = "marca"
+
+# Los archivos se leen con mmap: las páginas las comparte y libera el sistema operativo
+SISTEMA_ARCHIVOS = pafs.LocalFileSystem(use_mmap=True)
+COLUMNAS_FILA = ["id", "sensor_id", "fecha_hora", "valor", "estado"]
+ORDEN_ARCHIVO = [("sensor_id", "ascending"), ("fecha_hora", "ascending"), ("id", "ascending")]
+TIPO_FECHA = ESQUEMA_ARROW.field("fecha_hora").type
+
+CONSULTA_PENDIENTES = text(
+    "SELECT s.maquina_id, (l.fecha_hora AT TIME ZONE 'UTC')::date, count(*) "
+    "FROM lecturas l JOIN sensores s ON s.id = l.sensor_id WHERE l.fecha_hora < :corte "
+    "GROUP BY 1, 2 ORDER BY 2, 1"
+)
+BORRAR_ARCHIVADAS = text(
+    "DELETE FROM lecturas WHERE id = ANY(:ids) AND fecha_hora >= :inicio AND fecha_hora < :fin"
+)
+
+# Lectura leída del archivo; tiene los mismos atributos que models.Lectura que usan las rutas
+FilaArchivo = namedtuple("FilaArchivo", COLUMNAS_FILA)
+
+
+def inicio_dia(dia):
+    return datetime.combine(dia, hora(), tzinfo=timezone.utc)
+
+
+def filtro_lecturas(sensor_ids, fecha_inicio=None, fecha_fin=None, antes=None):
+    filtro = ds.field("sensor_id").isin(sensor_ids)
+    if fecha_inicio:
+        filtro &= ds.field("fecha_hora") >= pa.scalar(a_utc(fecha_inicio), TIPO_FECHA)
+    if fecha_fin:
+        filtro &= ds.field("fecha_hora") <= pa.scalar(a_utc(fecha_fin), TIPO_FECHA)
+    if antes:
+        # Paginación por clave: (fecha_hora, id) < cursor
+        fecha = pa.scalar(a_utc(antes[0]), TIPO_FECHA)
+        filtro &= (ds.field("fecha_hora") < fecha) | ((ds.field("fecha_hora") == fecha) & (ds.field("id") < antes[1]))
+    return filtro
+
+
+def leer(rutas, filtro, columnas):
+    # El filtro se empuja a cada archivo: row groups descartados por estadísticas y solo las columnas pedidas
+    dataset = ds.dataset(rutas, schema=ESQUEMA_ARROW, format="parquet", filesystem=SISTEMA_ARCHIVOS)
+    return dataset.to_table(columns=columnas, filter=filtro)
+
+
+def filas(tabla):
+    return [FilaArchivo(*fila) for fila in zip(*(tabla.column(columna).to_pylist() for columna in COLUMNAS_FILA))]
+
+
+def sincronizar(ruta):
+    with open(ruta, "rb") as archivo:
+        os.fsync(archivo.fileno())
+
+
+def reemplazar(temporal, ruta):
+    sincronizar(temporal)
+    os.replace(temporal, ruta)
+    return os.path.getsize(ruta)
+
+
+class Archivo:
+    # Lecturas crudas antiguas en Parquet comprimido, fuera de la tabla viva. Las rutas de historial,
+    # tendencias y exportación combinan la base con estos archivos, que solo se abren si el rango los alcanza.
+    def __init__(self, directorio):
+        self.directorio = directorio
+        self.ultimo_informe = None
+        self.ejecuciones = 0
+        # Copia en memoria de la marca: se lee del disco al arrancar y en cada ejecución, y se actualiza al guardarla
+        self._marca = None
+        # Gancho para avisar a los demás procesos que la marca avanzó (main.py lo conecta al tema de control)
+        self.difundir = None
+
+    def ruta(self, maquina_id, dia):
+        return os.path.join(self.directorio, f"maquina_{maquina_id}", f"{dia.isoformat()}.parquet")
+
+    def marca(self):
+        # None: todavía no terminó ninguna ejecución y todo se lee de la base
+        return self._marca
+
+    def cargar_marca(self):
+        # Lectura bloqueante del disco: fuera del bucle de eventos (asyncio.to_thread)
+        try:
+            with open(os.path.join(self.directorio, NOMBRE_MARCA)) as archivo:
+                self.actualizar_marca(datetime.fromisoformat(archivo.read().strip()))
+        except FileNotFoundError:
+            pass
+        return self._marca
+
+    def actualizar_marca(self, marca):
+        # La marca solo avanza: un aviso atrasado de otro proceso no la hace retroceder
+        if self._marca is None or marca > self._marca:
+            self._marca = marca
+
+    def _guardar_marca(self, marca):
+        ruta = os.path.join(self.directorio, NOMBRE_MARCA)
+        os.makedirs(self.directorio, exist_ok=True)
+        with open(ruta + ".tmp", "w") as archivo:
+            archivo.write(marca.isoformat())
+        reemplazar(ruta + ".tmp", ruta)
+        self.actualizar_marca(marca)
+
+    async def _avanzar_marca(self, marca):
+        await asyncio.to_thread(self._guardar_marca, marca)
+        if self.difundir:
+            # Se espera el aviso antes de borrar de la base: los demás procesos dejan de leer esos días de ella
+            try:
+                await self.difundir(marca)
+            except Exception as e:
+                logger.error(f"Error al difundir la marca del archivo: {e}")
+
+    def limite_retencion(self):
+        # Con el archivo activo, lo que está desde la marca todavía no se archivó y la retención no lo toca
+        if not ARCHIVO_DIAS:
+            return None
+        return self.marca() or INICIO
+
+    def dias(self, maquina_id, marca, fecha_inicio=None, fecha_fin=None):
+        # [(día, ruta)] en orden cronológico de los archivos de la máquina que tocan el rango. Los días desde
+        # la marca se ignoran: pueden tener un archivo escrito cuyas lecturas siguen vigentes en la base.
+        if marca is None:
+            return []
+        try:
+            nombres = os.listdir(os.path.join(self.directorio, f"maquina_{maquina_id}"))
+        except FileNotFoundError:
+            return []
+        desde = a_utc(fecha_inicio).date() if fecha_inicio else date.min
+        hasta = min(a_utc(fecha_fin).date() if fecha_fin else date.max, marca.date() - timedelta(days=1))
+        archivos = []
+        for nombre in nombres:
+            if not nombre.endswith(".parquet"):
+                continue
+            try:
+                dia = date.fromisoformat(nombre.removesuffix(".parquet"))
+            except ValueError:
+                continue
+            if desde <= dia <= hasta:
+                archivos.append((dia, self.ruta(maquina_id, dia)))
+        return sorted(archivos)
+
+    def ultimas(self, maquina_id, marca, sensor_ids, fecha_inicio, fecha_fin, antes, cantidad, cota=None):
+        # Las `cantidad` lecturas más recientes (fecha_hora, id descendente). Recorre los días del más nuevo
+        # al más viejo y se detiene al juntar suficientes; cota: la base ya aportó `cantidad` lecturas
+        # desde esa fecha, así que los días que terminan antes no pueden entrar en la página.
+        hasta = fecha_fin
+        if antes and (hasta is None or a_utc(antes[0]) < a_utc(hasta)):
+            hasta = antes[0]
+        filtro = filtro_lecturas(sensor_ids, fecha_inicio, fecha_fin, antes)
+        tablas = []
+        reunidas = 0
+        for dia, ruta in reversed(self.dias(maquina_id, marca, fecha_inicio, hasta)):
+            if cota is not None and inicio_dia(dia + timedelta(days=1)) <= cota:
+                break
+            tabla = leer([ruta], filtro, COLUMNAS_FILA)
+            tablas.append(tabla)
+            reunidas += tabla.num_rows
+            if reunidas >= cantidad:
+                break
+        if not reunidas:
+            return []
+        tabla = pa.concat_tables(tablas).sort_by([("fecha_hora", "descending"), ("id", "descending")])
+        return filas(tabla.slice(0, cantidad))
+
+    def contar(self, maquina_id, marca, sensor_ids, fecha_inicio=None, fecha_fin=None, estimado=False):
+        archivos = [ruta for _, ruta in self.dias(maquina_id, marca, fecha_inicio, fecha_fin)]
+        if not archivos:
+            return 0
+        if not estimado:
+            dataset = ds.dataset(archivos, schema=ESQUEMA_ARROW, format="parquet", filesystem=SISTEMA_ARCHIVOS)
+            return dataset.count_rows(filter=filtro_lecturas(sensor_ids, fecha_inicio, fecha_fin))
+        # Solo metadatos: filas de los row groups cuyo rango de sensor_id incluye alguno de los pedidos
+        columna = ESQUEMA_ARROW.get_field_index("sensor_id")
+        total = 0
+        for ruta in archivos:
+            metadatos = pq.ParquetFile(ruta, memory_map=True).metadata
+            for indice in range(metadatos.num_row_groups):
+                grupo = metadatos.row_group(indice)
+                estadisticas = grupo.column(columna).statistics
+                if estadisticas is None or not estadisticas.has_min_max or any(
+                    estadisticas.min <= sensor_id <= estadisticas.max for sensor_id in sensor_ids
+                ):
+                    total += grupo.num_rows
+        return total
+
+    def series(self, maquina_id, marca, sensor_ids, fecha_inicio):
+        # {sensor_id: (instantes epoch, valores)} como leer_series de tendencias.py
+        archivos = [ruta for _, ruta in self.dias(maquina_id, marca, fecha_inicio)]
+        if not archivos:
+            return {}
+        filtro = filtro_lecturas(sensor_ids, fecha_inicio) & ds.field("valor").is_valid()
+        tabla = leer(archivos, filtro, ["sensor_id", "fecha_hora", "valor"])
+        sensores = tabla.column("sensor_id").to_numpy()
+        instantes = pc.cast(tabla.column("fecha_hora"), pa.int64()).to_numpy() / 1e6
+        valores = tabla.column("valor").to_numpy()
+        return {
+            int(sensor_id): (instantes[sensores == sensor_id], valores[sensores == sensor_id])
+            for sensor_id in np.unique(sensores)
+        }
+
+    def intervalos(self, maquina_id, marca, sensor_ids, origen, fecha_fin, ancho):
+        # Mismas filas que agregados.consulta_intervalos con fuente cruda, calculadas sobre el archivo
+        archivos = [ruta for _, ruta in self.dias(maquina_id, marca, origen, fecha_fin)]
+        if not archivos:
+            return []
+        filtro = (
+            filtro_lecturas(sensor_ids, origen) & (ds.field("fecha_hora") < pa.scalar(a_utc(fecha_fin), TIPO_FECHA))
+            & ds.field("valor").is_valid()
+        )
+        tabla = leer(archivos, filtro, ["sensor_id", "fecha_hora", "valor"])
+        if not tabla.num_rows:
+            return []
+        sensores = tabla.column("sensor_id").to_numpy()
+        instantes = pc.cast(tabla.column("fecha_hora"), pa.int64()).to_numpy() / 1e6
+        valores = tabla.column("valor").to_numpy()
+        indices = np.floor((instantes - origen.timestamp()) / ancho.total_seconds()).astype(np.int64)
+        orden = np.lexsort((instantes, indices, sensores))
+        sensores, indices, instantes, valores = sensores[orden], indices[orden], instantes[orden], valores[orden]
+        inicios = np.flatnonzero(np.r_[True, (sensores[1:] != sensores[:-1]) | (indices[1:] != indices[:-1])])
+        finales = np.r_[inicios[1:], len(valores)] - 1
+        return list(zip(
+            sensores[inicios].tolist(), indices[inicios].tolist(), (finales - inicios + 1).tolist(),
+            np.add.reduceat(valores, inicios).tolist(), np.minimum.reduceat(valores, inicios).tolist(),
+            np.maximum.reduceat(valores, inicios).tolist(),
+            zip(instantes[finales].tolist(), valores[finales].tolist()),
+        ))
+
+    async def bloques(self, maquina_id, marca, sensor_ids, fecha_inicio, fecha_fin, sensores):
+        # Mismas tuplas que exportacion.bloques_lecturas, en orden cronológico y un día a la vez
+        filtro = filtro_lecturas(sensor_ids, fecha_inicio, fecha_fin)
+        for _, ruta in await asyncio.to_thread(self.dias, maquina_id, marca, fecha_inicio, fecha_fin):
+            tabla = await asyncio.to_thread(leer, [ruta], filtro, COLUMNAS_FILA)
+            tabla = tabla.sort_by([("fecha_hora", "ascending"), ("id", "ascending")])
+            for lote in tabla.to_batches(EXPORTACION_FILAS_POR_BLOQUE):
+                yield [
+                    (fila.id, fila.sensor_id, *sensores[fila.sensor_id], fila.fecha_hora, fila.valor, fila.estado)
+                    for fila in filas(pa.Table.from_batches([lote]))
+                ]
+
+    async def ejecutar(self):
+        async with models.engine.connect() as conexion:
+            if not await conexion.scalar(text("SELECT pg_try_advisory_lock(:clave)"), {"clave": BLOQUEO_ARCHIVO}):
+                return {"omitida": "hay otra ejecución en curso"}
+            try:
+                informe = await self._ejecutar()
+            finally:
+                await conexion.execute(text("SELECT pg_advisory_unlock(:clave)"), {"clave": BLOQUEO_ARCHIVO})
+                await conexion.commit()
+        self.ejecuciones += 1
+        self.ultimo_informe = informe
+        return informe
+
+    async def _ejecutar(self):
+        inicio = time.perf_counter()
+        corte = inicio_dia(datetime.now(timezone.utc).date() - timedelta(days=ARCHIVO_DIAS))
+        # Con el bloqueo tomado se relee del disco: otro proceso pudo haberla avanzado
+        marca = await asyncio.to_thread(self.cargar_marca)
+        async with models.engine.connect() as conexion:
+            pendientes = (await conexion.execute(CONSULTA_PENDIENTES, {"corte": corte})).all()
+        por_dia = defaultdict(list)
+        for maquina_id, dia, _ in pendientes:
+            por_dia[dia].append(maquina_id)
+        informe = {"corte": corte.isoformat(), "archivos": 0, "lecturas": 0, "bytes": 0, "errores": []}
+        detenido = False
+        # Día por día en orden: se escriben los archivos de todas las máquinas, se avanza la marca y recién
+        # entonces se borran de la base. Si un día falla la marca queda antes de él y su base sigue vigente.
+        for dia, maquinas in sorted(por_dia.items()):
+            escritos = []
+            fallido = False
+            for maquina_id in maquinas:
+                try:
+                    escritos.append(await self._escribir_dia(maquina_id, dia))
+                except Exception as e:
+                    logger.error(f"Error al archivar las lecturas de la máquina {maquina_id} del {dia}: {e}")
+                    informe["errores"].append(f"maquina {maquina_id} {dia}: {e}")
+                    fallido = True
+            # Un día anterior a la marca solo tenía lecturas atrasadas: su falla no detiene a los siguientes
+            nuevo = marca is None or inicio_dia(dia) >= marca
+            if fallido and nuevo:
+                detenido = True
+                break
+            if nuevo:
+                marca = inicio_dia(dia + timedelta(days=1))
+                await self._avanzar_marca(marca)
+            for ids, tamano in escritos:
+                if not len(ids):
+                    continue
+                await self._borrar(ids, dia)
+                informe["archivos"] += 1
+                informe["lecturas"] += len(ids)
+                informe["bytes"] += tamano
+        if not detenido and (marca is None or marca < corte):
+            # Los días sin lecturas hasta el corte también quedan archivados
+            marca = corte
+            await self._avanzar_marca(marca)
+        informe["marca"] = marca.isoformat() if marca else None
+        informe["duracion_s"] = round(time.perf_counter() - inicio, 3)
+        logger.info(
+            f"Archivo: {informe['lecturas']} lecturas movidas a {informe['archivos']} archivos "
+            f"({informe['bytes']} bytes) en {informe['duracion_s']} s."
+        )
+        return informe
+
+    async def _escribir_dia(self, maquina_id, dia):
+        # Devuelve los ids escritos y el tamaño del archivo; las lecturas siguen en la base
+        desde, hasta = inicio_dia(dia), inicio_dia(dia + timedelta(days=1))
+        ruta = self.ruta(maquina_id, dia)
+        temporal = ruta + ".tmp"
+        await asyncio.to_thread(os.makedirs, os.path.dirname(ruta), exist_ok=True)
+        consulta = (
+            select(
+                models.Lectura.id, models.Lectura.sensor_id, models.Sensor.nombre, models.TipoSensor.tipo,
+                models.Lectura.fecha_hora, models.Lectura.valor, models.Lectura.estado
+            )
+            .join(models.Sensor, models.Sensor.id == models.Lectura.sensor_id)
+            .outerjoin(models.TipoSensor, models.TipoSensor.id == models.Sensor.tipo_sensor_id)
+            .where(models.Sensor.maquina_id == maquina_id, models.Lectura.fecha_hora >= desde, models.Lectura.fecha_hora < hasta)
+            .order_by(models.Lectura.sensor_id, models.Lectura.fecha_hora, models.Lectura.id)
+        )
+        ids = []
+        pendientes = []
+        # La escritura, compresión y fsync corren en hilos para no frenar el bucle de eventos
+        escritor = await asyncio.to_thread(pq.ParquetWriter, temporal, ESQUEMA_ARROW, compression=ARCHIVO_COMPRESION)
+        try:
+            # Se escribe a medida que llega del cursor: en memoria solo queda un row group
+            async with models.get_async_session() as sesion:
+                resultado = await sesion.stream(consulta.execution_options(yield_per=EXPORTACION_FILAS_POR_BLOQUE))
+                async for bloque in resultado.partitions():
+                    lote = pa.record_batch(list(zip(*bloque)), schema=ESQUEMA_ARROW)
+                    ids.append(lote.column(0).to_numpy())
+                    pendientes.append(lote)
+                    if sum(lote.num_rows for lote in pendientes) >= ARCHIVO_FILAS_POR_GRUPO:
+                        await asyncio.to_thread(
+                            escritor.write_table, pa.Table.from_batches(pendientes), row_group_size=ARCHIVO_FILAS_POR_GRUPO
+                        )
+                        pendientes = []
+            if pendientes:
+                await asyncio.to_thread(
+                    escritor.write_table, pa.Table.from_batches(pendientes), row_group_size=ARCHIVO_FILAS_POR_GRUPO
+                )
+        finally:
+            await asyncio.to_thread(escritor.close)
+        if not ids:
+            await asyncio.to_thread(os.remove, temporal)
+            return np.array([], dtype=np.int64), 0
+        if os.path.exists(ruta):
+            # Lecturas atrasadas de un día ya archivado, o una ejecución anterior interrumpida antes de borrar
+            await asyncio.to_thread(self._fusionar, ruta, temporal)
+        tamano = await asyncio.to_thread(reemplazar, temporal, ruta)
+        return np.concatenate(ids), tamano
+
+    async def _borrar(self, ids, dia):
+        # Solo las filas escritas: lo que llegó a la base después se archiva en la próxima ejecución
+        desde, hasta = inicio_dia(dia), inicio_dia(dia + timedelta(days=1))
+        for posicion in range(0, len(ids), RETENCION_LOTE):
+            async with models.engine.begin() as conexion:
+                await conexion.execute(text(f"SET LOCAL lock_timeout = {RETENCION_LOCK_TIMEOUT_MS}"))
+                await conexion.execute(
+                    BORRAR_ARCHIVADAS, {"ids": ids[posicion:posicion + RETENCION_LOTE].tolist(), "inicio": desde, "fin": hasta}
+                )
+            await asyncio.sleep(RETENCION_PAUSA_MS / 1000)
+
+    def _fusionar(self, ruta, temporal):
+        tabla = pa.concat_tables([pq.read_table(ruta, schema=ESQUEMA_ARROW), pq.read_table(temporal, schema=ESQUEMA_ARROW)])
+        _, unicas = np.unique(tabla.column("id").to_numpy(), return_index=True)
+        tabla = tabla.take(unicas).sort_by(ORDEN_ARCHIVO)
+        pq.write_table(tabla, temporal, compression=ARCHIVO_COMPRESION, row_group_size=ARCHIVO_FILAS_POR_GRUPO)
+
+    def estado(self):
+        archivos = 0
+        tamano = 0
+        if os.path.isdir(self.directorio):
+            for directorio in os.scandir(self.directorio):
+                if directorio.is_dir():
+                    for entrada in os.scandir(directorio.path):
+                        if entrada.name.endswith(".parquet"):
+                            archivos += 1
+                            tamano += entrada.stat().st_size
+        marca = self.marca()
+        return {
+            "directorio": self.directorio,
+            "dias": ARCHIVO_DIAS,
+            "intervalo_h": ARCHIVO_INTERVALO_H,
+            "marca": marca.isoformat() if marca else None,
+            "archivos": archivos,
+            "bytes": tamano,
+            "ejecuciones": self.ejecuciones,
+            "ultimo_informe": self.ultimo_informe,
+        }
+
+
+archivo = Archivo(ARCHIVO_DIR)
+retencion.limite_archivo = archivo.limite_retencion
+
+
+async def mantener_archivo():
+    if not ARCHIVO_DIAS or not ARCHIVO_INTERVALO_H:
+        return
+    while True:
+        try:
+            await archivo.ejecutar()
+        except Exception as e:
+            logger.error(f"Error al archivar lecturas: {e}")
+        await asyncio.sleep(ARCHIVO_INTERVALO_H * 3600)
@@ -0,0 +1,65 @@
+import argparse
+import time
+import numpy as np
+from .detectores import DETECTORES, crear_detector
+
+# Costo por lectura de cada detector en modo streaming y por lote, sobre una serie sintética con
+# ciclo diario, muestreo irregular y anomalías inyectadas. Solo CPU, sin base de datos:
+#   python -m src.benchmark_detectores --lecturas 100000
+
+
+def serie_sintetica(lecturas, anomalias, semilla):
+    rng = np.random.default_rng(semilla)
+    instantes = 1.7e9 + np.cumsum(rng.uniform(5, 60, lecturas))
+    valores = 50 + 10 * np.sin(2 * np.pi * instantes / 86400) + rng.normal(0, 1, lecturas)
+    inyectadas = np.sort(rng.choice(np.arange(lecturas // 10, lecturas), anomalias, replace=False))
+    valores[inyectadas] += rng.choice([-1, 1], anomalias) * rng.uniform(8, 15, anomalias)
+    return instantes, valores, inyectadas
+
+
+def medir(nombre, instantes, valores, inyectadas):
+    detector = crear_detector(nombre)
+    inicio = time.perf_counter()
+    puntajes = [detector.actualizar(valor, instante) for valor, instante in zip(valores.tolist(), instantes.tolist())]
+    streaming = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    puntajes_lote = crear_detector(nombre).puntuar_lote(valores, instantes)
+    lote = time.perf_counter() - inicio
+
+    puntajes = np.array(puntajes)
+    iguales = np.isclose(puntajes, puntajes_lote, rtol=1e-6, atol=1e-9, equal_nan=True).mean()
+    anomalos = detector.anomalos_lote(puntajes_lote)
+    detectadas = anomalos[inyectadas].sum()
+    return {
+        "detector": nombre,
+        "us_streaming": streaming / len(valores) * 1e6,
+        "us_lote": lote / len(valores) * 1e6,
+        "coincidencia": iguales,
+        "detectadas": int(detectadas),
+        "falsos_positivos": int(anomalos.sum() - detectadas),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Costo por lectura de los detectores de anomalías")
+    parser.add_argument("--lecturas", type=int, default=50000)
+    parser.add_argument("--anomalias", type=int, default=50)
+    parser.add_argument("--detectores", nargs="*", default=list(DETECTORES))
+    parser.add_argument("--semilla", type=int, default=1)
+    args = parser.parse_args()
+
+    instantes, valores, inyectadas = serie_sintetica(args.lecturas, args.anomalias, args.semilla)
+    print(f"{args.lecturas} lecturas, {args.anomalias} anomalías inyectadas")
+    print(f"{'detector':<12} {'us/lectura':>11} {'us/lectura':>11} {'streaming':>10} {'detectadas':>11} {'falsos':>7}")
+    print(f"{'':<12} {'streaming':>11} {'lote':>11} {'= lote':>10} {'':>11} {'positivos':>7}")
+    for nombre in args.detectores:
+        resultado = medir(nombre, instantes, valores, inyectadas)
+        print(
+            f"{resultado['detector']:<12} {resultado['us_streaming']:>11.2f} {resultado['us_lote']:>11.2f} "
+            f"{resultado['coincidencia']:>10.2%} {resultado['detectadas']:>11} {resultado['falsos_positivos']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
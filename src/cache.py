@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import zlib
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.future import select
+from . import models
+from .respuestas import cache_respuestas
+
+logger = logging.getLogger("SensorApi")
+
+
+class CacheDimensiones:
+    # Ids residentes de máquinas, tipos de sensor y registro de sensores: el conjunto casi
+    # nunca cambia, así que se resuelven en memoria en lugar de consultar la base por cada lectura.
+    def __init__(self):
+        self.maquinas = {}
+        self.tipos = {}
+        self.sensores = {}
+        self._bloqueos = {}
+
+    async def calentar(self):
+        async with models.get_async_session() as sesion:
+            maquinas = await sesion.execute(select(models.Maquina.nombre, models.Maquina.id))
+            tipos = await sesion.execute(select(models.TipoSensor.tipo, models.TipoSensor.id))
+            sensores = await sesion.execute(
+                select(models.Sensor.maquina_id, models.Sensor.tipo_sensor_id, models.Sensor.nombre, models.Sensor.id)
+            )
+            self.maquinas = dict(maquinas.all())
+            self.tipos = dict(tipos.all())
+            self.sensores = {(maquina_id, tipo_id, nombre): sensor_id for maquina_id, tipo_id, nombre, sensor_id in sensores.all()}
+        logger.info(
+            f"Cache de dimensiones cargada: {len(self.maquinas)} máquinas, {len(self.tipos)} tipos de sensor, "
+            f"{len(self.sensores)} sensores."
+        )
+
+    def invalidar(self):
+        self.maquinas = {}
+        self.tipos = {}
+        self.sensores = {}
+
+    async def id_maquina(self, nombre):
+        return await self._obtener_id(self.maquinas, nombre, models.Maquina, {"nombre": nombre}, etiquetas=("maquinas",))
+
+    async def id_tipo_sensor(self, tipo):
+        return await self._obtener_id(
+            self.tipos, tipo, models.TipoSensor, {"tipo": tipo}, {"unidad": "sin unidad"}, etiquetas=("tipos",)
+        )
+
+    async def id_sensor(self, maquina_id, tipo_sensor_id, nombre):
+        return await self._obtener_id(
+            self.sensores,
+            (maquina_id, tipo_sensor_id, nombre),
+            models.Sensor,
+            {"maquina_id": maquina_id, "tipo_sensor_id": tipo_sensor_id, "nombre": nombre},
+            etiquetas=("maquinas", f"maquina:{maquina_id}"),
+        )
+
+    async def _obtener_id(self, ids, valor, modelo, clave, por_defecto=None, etiquetas=()):
+        id_cacheado = ids.get(valor)
+        if id_cacheado is not None:
+            return id_cacheado
+
+        # Un bloqueo por clave evita que dos lotes concurrentes creen la misma fila
+        bloqueo = self._bloqueos.setdefault((modelo.__tablename__, valor), asyncio.Lock())
+        async with bloqueo:
+            if valor not in ids:
+                ids[valor] = await self._obtener_o_crear(modelo, clave, por_defecto or {}, etiquetas)
+        self._bloqueos.pop((modelo.__tablename__, valor), None)
+        return ids[valor]
+
+    async def _obtener_o_crear(self, modelo, clave, por_defecto, etiquetas):
+        # Sesión propia: solo se cachean ids ya confirmados, aunque el lote que los pidió falle
+        async with models.get_async_session() as sesion:
+            # Entre procesos: maquinas y tipos_sensor no tienen restricción única por nombre
+            await models.bloquear(sesion, zlib.crc32(f"{modelo.__tablename__}:{sorted(clave.items())}".encode()))
+            resultado = await sesion.execute(select(modelo.id).filter_by(**clave))
+            id_existente = resultado.scalars().first()
+            if id_existente is not None:
+                return id_existente
+            instancia = modelo(**clave, **por_defecto)
+            sesion.add(instancia)
+            try:
+                await sesion.commit()
+            except IntegrityError:
+                # Otro proceso la creó en paralelo (restricción única del registro de sensores)
+                await sesion.rollback()
+                resultado = await sesion.execute(select(modelo.id).filter_by(**clave))
+                return resultado.scalars().one()
+            # Alta nueva: las respuestas cacheadas que listan máquinas, sensores o tipos quedan viejas
+            cache_respuestas.invalidar(*etiquetas)
+            return instancia.id
+
+
+cache_dimensiones = CacheDimensiones()
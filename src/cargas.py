@@ -0,0 +1,158 @@
+import json
+import logging
+import math
+import struct
+from datetime import datetime, timezone
+import msgpack
+import numpy as np
+
+logger = logging.getLogger("SensorApi")
+
+# Lotes de lecturas de varios sensores de una máquina en un solo mensaje:
+#   lotes/<maquina>/json     [{"tipo": "energia", "nombre": "torcha", "valor": 51.2, "ts": 1760000000.5}, ...]
+#   lotes/<maquina>/msgpack  la misma estructura codificada con MessagePack
+#   lotes/<maquina>/struct   binario de tamaño fijo, ver decodificar_struct
+# Cada lectura también puede ser una lista [tipo, nombre, valor, ts]. 'ts' es opcional (segundos
+# epoch o ISO 8601); sin él se usa la hora de recepción.
+FORMATOS_LOTE = ("json", "msgpack", "struct")
+
+# struct: cabecera, tabla de sensores (tipo y nombre como UTF-8 con longitud u8) y registros
+CABECERA_STRUCT = struct.Struct("<4sHI")
+MAGIA_STRUCT = b"SLT1"
+REGISTRO_STRUCT = np.dtype([("sensor", "<u2"), ("ts", "<f8"), ("valor", "<f8")])
+
+
+def convertir_a_booleano(datos_sensor):
+    if isinstance(datos_sensor, str):
+        return datos_sensor.lower() in ['true', '1', 't', 'y', 'yes']
+    return bool(datos_sensor)
+
+def convertir_a_float(datos_sensor):
+    if isinstance(datos_sensor, str) and datos_sensor.lower() in ['true', 'false']:
+        return 1.0 if datos_sensor.lower() == 'true' else 0.0
+    try:
+        return float(datos_sensor)
+    except ValueError:
+        logger.error(f"No se pudo convertir datos a float: '{datos_sensor}'")
+        return 0.0
+
+
+def convertir_valor(valor):
+    # (estado, valor) con la misma semántica que la carga de texto de un solo sensor
+    if isinstance(valor, str):
+        return convertir_a_booleano(valor), convertir_a_float(valor)
+    if isinstance(valor, bool):
+        return valor, float(valor)
+    valor = float(valor)
+    return valor == 1, valor
+
+
+def convertir_instante(instante, recepcion):
+    if instante is None:
+        return recepcion
+    if isinstance(instante, str):
+        fecha_hora = datetime.fromisoformat(instante)
+        return fecha_hora if fecha_hora.tzinfo else fecha_hora.replace(tzinfo=timezone.utc)
+    if not math.isfinite(instante):
+        raise ValueError(f"Instante inválido: {instante}")
+    return datetime.fromtimestamp(instante, timezone.utc)
+
+
+def decodificar_elementos(maquina, elementos, recepcion):
+    if not isinstance(elementos, list):
+        raise ValueError("El lote debe ser una lista de lecturas")
+    lecturas = []
+    invalidas = 0
+    for elemento in elementos:
+        try:
+            if isinstance(elemento, dict):
+                tipo, nombre, valor, instante = elemento["tipo"], elemento["nombre"], elemento["valor"], elemento.get("ts")
+            else:
+                tipo, nombre, valor, instante = (*elemento, None)[:4]
+            estado, valor = convertir_valor(valor)
+            lecturas.append({
+                "maquina": maquina,
+                "tipo": str(tipo),
+                "nombre": str(nombre),
+                "estado": estado,
+                "valor": valor,
+                "fecha_hora": convertir_instante(instante, recepcion),
+            })
+        except (KeyError, TypeError, ValueError, OverflowError, OSError):
+            invalidas += 1
+    if invalidas:
+        logger.warning(f"Lote de {maquina}: {invalidas} lecturas inválidas descartadas")
+    return lecturas
+
+
+def decodificar_struct(maquina, carga_util, recepcion):
+    # <4sHI> magia "SLT1", cantidad de sensores, cantidad de registros
+    # por sensor: u8 largo + tipo, u8 largo + nombre
+    # por registro <Hdd>: índice del sensor, instante epoch (NaN = hora de recepción), valor
+    magia, cantidad_sensores, cantidad_registros = CABECERA_STRUCT.unpack_from(carga_util)
+    if magia != MAGIA_STRUCT:
+        raise ValueError("Cabecera struct inválida")
+    posicion = CABECERA_STRUCT.size
+    sensores = []
+    for _ in range(cantidad_sensores):
+        campos = []
+        for _ in range(2):
+            largo = carga_util[posicion]
+            campos.append(bytes(carga_util[posicion + 1:posicion + 1 + largo]).decode())
+            posicion += 1 + largo
+        sensores.append(tuple(campos))
+    if len(carga_util) - posicion != cantidad_registros * REGISTRO_STRUCT.itemsize:
+        raise ValueError("Largo de registros struct inválido")
+
+    # Los registros se leen de una vez, sin copiar, como arreglo estructurado
+    registros = np.frombuffer(carga_util, REGISTRO_STRUCT, cantidad_registros, posicion)
+    if cantidad_registros and registros["sensor"].max() >= cantidad_sensores:
+        raise ValueError("Índice de sensor fuera de rango")
+    instante_recepcion = recepcion.timestamp()
+    instantes = np.where(np.isnan(registros["ts"]), instante_recepcion, registros["ts"])
+    orden = np.argsort(instantes, kind="stable")
+    indices, instantes, valores = registros["sensor"][orden].tolist(), instantes[orden].tolist(), registros["valor"][orden].tolist()
+    return [
+        {
+            "maquina": maquina,
+            "tipo": sensores[indice][0],
+            "nombre": sensores[indice][1],
+            "estado": valor == 1,
+            "valor": valor,
+            "fecha_hora": datetime.fromtimestamp(instante, timezone.utc),
+        }
+        for indice, instante, valor in zip(indices, instantes, valores)
+    ]
+
+
+def codificar_struct(lecturas):
+    # Inversa de decodificar_struct; lecturas: [(tipo, nombre, valor, ts)] con ts None o segundos epoch
+    sensores = {}
+    registros = np.empty(len(lecturas), REGISTRO_STRUCT)
+    for posicion, (tipo, nombre, valor, instante) in enumerate(lecturas):
+        registros[posicion] = (sensores.setdefault((tipo, nombre), len(sensores)), math.nan if instante is None else instante, valor)
+    tabla = b"".join(
+        bytes([len(campo)]) + campo
+        for sensor in sensores for campo in (sensor[0].encode(), sensor[1].encode())
+    )
+    return CABECERA_STRUCT.pack(MAGIA_STRUCT, len(sensores), len(lecturas)) + tabla + registros.tobytes()
+
+
+def decodificar_lote(maquina, formato, carga_util, recepcion=None):
+    # Lecturas decodificadas de un lote, ordenadas por instante para que el detector de anomalías
+    # las reciba en orden aunque el dispositivo las haya enviado mezcladas
+    recepcion = recepcion or datetime.now(timezone.utc)
+    if formato == "struct":
+        try:
+            # Ya vuelve ordenado (argsort sobre los instantes)
+            return decodificar_struct(maquina, memoryview(carga_util), recepcion)
+        except (struct.error, IndexError, OverflowError, OSError) as e:
+            raise ValueError(f"Lote struct inválido: {e}")
+    if formato == "json":
+        lecturas = decodificar_elementos(maquina, json.loads(carga_util), recepcion)
+    elif formato == "msgpack":
+        lecturas = decodificar_elementos(maquina, msgpack.unpackb(carga_util), recepcion)
+    else:
+        raise ValueError(f"Formato de lote desconocido: {formato}")
+    lecturas.sort(key=lambda lectura: lectura["fecha_hora"])
+    return lecturas
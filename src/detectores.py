@@ -0,0 +1,485 @@
+import math
+import random
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import lfilter
+
+# Registro de detectores de anomalías por nombre. Cada detector tiene dos modos equivalentes:
+# actualizar() puntúa una lectura y actualiza su estado en tiempo constante (ingesta), y
+# puntuar_lote() puntúa un arreglo completo de forma vectorizada, con el mismo resultado que
+# llamar a actualizar() con cada valor sobre un detector nuevo (análisis histórico, pruebas).
+DETECTORES = {}
+# Filas de la ventana deslizante que se materializan a la vez en los cálculos por lote
+FILAS_POR_BLOQUE = 1_000_000
+
+
+def registrar_detector(clase):
+    DETECTORES[clase.nombre] = clase
+    return clase
+
+
+def crear_detector(nombre, parametros=None):
+    clase = DETECTORES.get(nombre)
+    if clase is None:
+        raise ValueError(f"Detector desconocido: {nombre}")
+    parametros = parametros or {}
+    desconocidos = set(parametros) - set(clase.parametros)
+    if desconocidos:
+        raise ValueError(f"Parámetros desconocidos para {nombre}: {', '.join(sorted(desconocidos))}")
+    for clave, valor in parametros.items():
+        entero = isinstance(clase.parametros[clave], int)
+        if isinstance(valor, bool) or not isinstance(valor, int if entero else (int, float)) or valor <= 0:
+            raise ValueError(f"El parámetro {clave} debe ser un número {'entero ' if entero else ''}positivo")
+        if (clave == "ventana" and valor < 2) or (clave == "alfa" and valor > 1):
+            raise ValueError(f"Valor fuera de rango para {clave}: {valor}")
+    return clase(**{**clase.parametros, **parametros})
+
+
+class Detector:
+    nombre = None
+    etiqueta = None
+    parametros = {}
+
+    def __init__(self, **parametros):
+        for clave, valor in parametros.items():
+            setattr(self, clave, valor)
+
+    @property
+    def historial(self):
+        # Lecturas previas con las que se siembra el estado antes de la primera evaluación
+        return self.ventana - 1
+
+    def sembrar(self, valores, instantes):
+        for valor, instante in zip(valores, instantes):
+            self.actualizar(valor, instante)
+
+    def actualizar(self, valor, instante):
+        # Devuelve el puntaje de la lectura, o nan mientras no hay datos suficientes
+        raise NotImplementedError
+
+    def puntuar_lote(self, valores, instantes):
+        raise NotImplementedError
+
+    def es_anomalo(self, puntaje):
+        return abs(puntaje) > self.umbral
+
+    def anomalos_lote(self, puntajes):
+        # nan nunca supera el umbral
+        return np.abs(puntajes) > self.umbral
+
+
+class EstadisticaMovil:
+    # Ventana circular con media y varianza (Welford) actualizadas en O(1) por lectura.
+    # Cada 'ventana' reemplazos se recalcula desde el buffer para acotar el error acumulado.
+    def __init__(self, ventana, valores=()):
+        self.valores = deque(maxlen=ventana)
+        self.media = 0.0
+        self.m2 = 0.0
+        self._reemplazos = 0
+        for valor in valores:
+            self.agregar(valor)
+
+    def agregar(self, valor):
+        if len(self.valores) < self.valores.maxlen:
+            self.valores.append(valor)
+            delta = valor - self.media
+            self.media += delta / len(self.valores)
+            self.m2 += delta * (valor - self.media)
+            return
+
+        saliente = self.valores[0]
+        self.valores.append(valor)
+        media_anterior = self.media
+        self.media += (valor - saliente) / len(self.valores)
+        self.m2 += (valor - saliente) * (valor - self.media + saliente - media_anterior)
+        self._reemplazos += 1
+        if self._reemplazos >= self.valores.maxlen:
+            self._recalcular()
+
+    def _recalcular(self):
+        self.media = math.fsum(self.valores) / len(self.valores)
+        self.m2 = math.fsum((valor - self.media) ** 2 for valor in self.valores)
+        self._reemplazos = 0
+
+    def desviacion_estandar(self):
+        # Desviación muestral (ddof=1), igual que np.std(..., ddof=1)
+        n = len(self.valores)
+        if n < 2:
+            return 0.0
+        desviacion = math.sqrt(max(self.m2, 0.0) / (n - 1))
+        if desviacion <= 1e-12 * max(1.0, abs(self.media)):
+            return 0.0
+        return desviacion
+
+
+@registrar_detector
+class DetectorZScore(Detector):
+    # Z-score sobre las últimas 'ventana' lecturas, incluida la nueva
+    nombre = "zscore"
+    etiqueta = "Z-score"
+    parametros = {"ventana": 100, "umbral": 3.0}
+
+    def __init__(self, **parametros):
+        super().__init__(**parametros)
+        self.estadistica = EstadisticaMovil(self.ventana)
+
+    def actualizar(self, valor, instante=None):
+        self.estadistica.agregar(valor)
+        desviacion_estandar = self.estadistica.desviacion_estandar()
+        if desviacion_estandar == 0:
+            return math.nan
+        return (valor - self.estadistica.media) / desviacion_estandar
+
+    def puntuar_lote(self, valores, instantes=None):
+        x = np.asarray(valores, dtype=np.float64)
+        if len(x) == 0:
+            return np.empty(0)
+        # Sumas acumuladas sobre valores centrados para no perder precisión
+        centro = x.mean()
+        centrados = x - centro
+        suma = np.concatenate(([0.0], np.cumsum(centrados)))
+        suma_cuadrados = np.concatenate(([0.0], np.cumsum(centrados * centrados)))
+        fin = np.arange(1, len(x) + 1)
+        inicio = np.maximum(fin - self.ventana, 0)
+        n = fin - inicio
+        media_centrada = (suma[fin] - suma[inicio]) / n
+        m2 = np.maximum(suma_cuadrados[fin] - suma_cuadrados[inicio] - n * media_centrada ** 2, 0.0)
+        media = media_centrada + centro
+        # Ventanas sin ningún cambio de valor: desviación nula exacta, sin ruido de redondeo
+        cambios = np.concatenate(([0], np.cumsum(x[1:] != x[:-1])))
+        constante = cambios[fin - 1] == cambios[inicio]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            desviacion = np.sqrt(m2 / (n - 1))
+            desviacion[(n < 2) | constante | (desviacion <= 1e-12 * np.maximum(1.0, np.abs(media)))] = np.nan
+            return (x - media) / desviacion
+
+
+def ewma_lote(x, alfa, calentamiento):
+    # Versión vectorizada (filtros IIR) de la media y varianza exponenciales de DetectorEWMA
+    puntajes = np.full(len(x), np.nan)
+    if len(x) < 2:
+        return puntajes
+    medias = np.concatenate(([x[0]], lfilter([alfa], [1.0, alfa - 1.0], x[1:], zi=[(1.0 - alfa) * x[0]])[0]))
+    desvios = x[1:] - medias[:-1]
+    varianzas = np.concatenate(([0.0], lfilter([(1.0 - alfa) * alfa], [1.0, alfa - 1.0], desvios * desvios)))
+    previas = varianzas[:-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        puntajes[1:] = np.where(
+            (np.arange(1, len(x)) >= calentamiento) & (previas > 1e-24),
+            desvios / np.sqrt(previas),
+            np.nan
+        )
+    return puntajes
+
+
+@registrar_detector
+class DetectorEWMA(Detector):
+    # Desvío de la lectura respecto de la media exponencial previa, en desviaciones exponenciales
+    nombre = "ewma"
+    etiqueta = "EWMA"
+    parametros = {"alfa": 0.1, "umbral": 3.0, "calentamiento": 10}
+
+    def __init__(self, **parametros):
+        super().__init__(**parametros)
+        self.n = 0
+        self.media = 0.0
+        self.varianza = 0.0
+
+    @property
+    def historial(self):
+        # Suficiente para que el peso de los valores no vistos sea despreciable
+        return self.calentamiento + int(5 / self.alfa)
+
+    def actualizar(self, valor, instante=None):
+        if self.n == 0:
+            self.n, self.media = 1, valor
+            return math.nan
+        desvio = valor - self.media
+        puntaje = math.nan
+        if self.n >= self.calentamiento and self.varianza > 1e-24:
+            puntaje = desvio / math.sqrt(self.varianza)
+        self.media += self.alfa * desvio
+        self.varianza = (1.0 - self.alfa) * (self.varianza + self.alfa * desvio * desvio)
+        self.n += 1
+        return puntaje
+
+    def puntuar_lote(self, valores, instantes=None):
+        return ewma_lote(np.asarray(valores, dtype=np.float64), self.alfa, self.calentamiento)
+
+
+def kesimo_de_dos(a, na, b, nb, k):
+    # k-ésimo menor (desde 0) de la unión de dos secuencias ordenadas, en O(log n)
+    bajo, alto = max(0, k + 1 - nb), min(k + 1, na)
+    while True:
+        i = (bajo + alto) // 2
+        j = k + 1 - i
+        if i < na and j > 0 and b(j - 1) > a(i):
+            bajo = i + 1
+        elif i > 0 and j < nb and a(i - 1) > b(j):
+            alto = i - 1
+        else:
+            return max(a(i - 1) if i > 0 else -math.inf, b(j - 1) if j > 0 else -math.inf)
+
+
+@registrar_detector
+class DetectorMAD(Detector):
+    # Z robusto: desvío respecto de la mediana de la ventana en unidades de MAD
+    nombre = "mad"
+    etiqueta = "Z robusto (MAD)"
+    parametros = {"ventana": 100, "umbral": 3.5}
+    ESCALA = 0.6745
+
+    def __init__(self, **parametros):
+        super().__init__(**parametros)
+        self.valores = deque()
+        self.ordenados = []
+
+    def actualizar(self, valor, instante=None):
+        if len(self.valores) == self.ventana:
+            del self.ordenados[bisect_left(self.ordenados, self.valores.popleft())]
+        self.valores.append(valor)
+        insort(self.ordenados, valor)
+        n = len(self.ordenados)
+        if n < 3:
+            return math.nan
+        ordenados = self.ordenados
+        mediana = (ordenados[(n - 1) // 2] + ordenados[n // 2]) / 2
+        # Los desvíos absolutos a cada lado de la mediana ya están ordenados: la mediana de los
+        # desvíos se obtiene combinando ambas mitades sin recorrer la ventana
+        corte = bisect_left(ordenados, mediana)
+        izquierda = lambda j: mediana - ordenados[corte - 1 - j]
+        derecha = lambda j: ordenados[corte + j] - mediana
+        mad = (
+            kesimo_de_dos(izquierda, corte, derecha, n - corte, (n - 1) // 2)
+            + kesimo_de_dos(izquierda, corte, derecha, n - corte, n // 2)
+        ) / 2
+        if mad <= 1e-12 * max(1.0, abs(mediana)):
+            return math.nan
+        return self.ESCALA * (valor - mediana) / mad
+
+    def puntuar_lote(self, valores, instantes=None):
+        x = np.asarray(valores, dtype=np.float64)
+        puntajes = np.full(len(x), np.nan)
+        medianas = np.full(len(x), np.nan)
+        mads = np.full(len(x), np.nan)
+        # Ventanas incompletas del comienzo
+        for i in range(min(self.ventana - 1, len(x))):
+            if i >= 2:
+                medianas[i] = np.median(x[:i + 1])
+                mads[i] = np.median(np.abs(x[:i + 1] - medianas[i]))
+        if len(x) >= self.ventana:
+            ventanas = sliding_window_view(x, self.ventana)
+            paso = max(1, FILAS_POR_BLOQUE // self.ventana)
+            for desde in range(0, len(ventanas), paso):
+                bloque = ventanas[desde:desde + paso]
+                mediana = np.median(bloque, axis=1)
+                medianas[self.ventana - 1 + desde:self.ventana - 1 + desde + len(bloque)] = mediana
+                mads[self.ventana - 1 + desde:self.ventana - 1 + desde + len(bloque)] = np.median(
+                    np.abs(bloque - mediana[:, None]), axis=1
+                )
+        validos = mads > 1e-12 * np.maximum(1.0, np.abs(medianas))
+        puntajes[validos] = self.ESCALA * (x[validos] - medianas[validos]) / mads[validos]
+        return puntajes
+
+
+@registrar_detector
+class DetectorEstacional(Detector):
+    # Línea base por franja del ciclo (por defecto, por hora del día en UTC): una media y varianza
+    # exponenciales por franja, así un valor normal a las 14 h no se compara con la noche
+    nombre = "estacional"
+    etiqueta = "Línea base estacional"
+    parametros = {"periodo_s": 86400, "franjas": 24, "alfa": 0.1, "umbral": 3.0, "calentamiento": 5, "historial_lecturas": 5000}
+
+    def __init__(self, **parametros):
+        super().__init__(**parametros)
+        self.franjas_ewma = {}
+
+    @property
+    def historial(self):
+        return self.historial_lecturas
+
+    def franja(self, instante):
+        return int((instante % self.periodo_s) * self.franjas // self.periodo_s)
+
+    def actualizar(self, valor, instante):
+        franja = self.franja(instante)
+        detector = self.franjas_ewma.get(franja)
+        if detector is None:
+            detector = self.franjas_ewma[franja] = DetectorEWMA(alfa=self.alfa, umbral=self.umbral, calentamiento=self.calentamiento)
+        return detector.actualizar(valor, instante)
+
+    def puntuar_lote(self, valores, instantes):
+        x = np.asarray(valores, dtype=np.float64)
+        t = np.asarray(instantes, dtype=np.float64)
+        franjas = ((t % self.periodo_s) * self.franjas // self.periodo_s).astype(np.int64)
+        puntajes = np.full(len(x), np.nan)
+        for franja in np.unique(franjas):
+            indices = np.flatnonzero(franjas == franja)
+            puntajes[indices] = ewma_lote(x[indices], self.alfa, self.calentamiento)
+        return puntajes
+
+
+def longitud_promedio(n):
+    # Largo medio de una búsqueda sin éxito en un árbol binario de n elementos
+    if n <= 1:
+        return 0.0
+    if n == 2:
+        return 1.0
+    return 2.0 * (math.log(n - 1) + 0.5772156649) - 2.0 * (n - 1) / n
+
+
+class BosqueAislamiento:
+    # Sobre valores escalares cada árbol de aislamiento parte la recta en intervalos con un largo de
+    # camino fijo. El bosque completo se compila a la unión ordenada de los cortes con el puntaje
+    # promedio de cada tramo, así puntuar una lectura es una búsqueda binaria.
+    def __init__(self, valores, arboles, semilla, tamano_muestra=256):
+        aleatorio = random.Random(semilla)
+        valores = list(valores)
+        self.tamano = min(len(valores), tamano_muestra)
+        self.altura_maxima = max(1, math.ceil(math.log2(max(self.tamano, 2))))
+        self.arboles = []
+        for _ in range(arboles):
+            arbol = {"cortes": [], "largos": [], "rangos_izquierda": [], "rangos_derecha": []}
+            ordenados = sorted(aleatorio.sample(valores, self.tamano))
+            self._partir(ordenados, 0, self.tamano, 0, aleatorio, arbol)
+            arbol["minimo"], arbol["maximo"] = ordenados[0], ordenados[-1]
+            for clave in ("cortes", "largos"):
+                arbol[clave] = np.array(arbol[clave])
+            self.arboles.append(arbol)
+
+        self.cortes = np.unique(np.concatenate([arbol["cortes"] for arbol in self.arboles]))
+        # Un punto de cada tramo: todos los puntos del tramo caen en la misma hoja de cada árbol
+        representantes = np.concatenate(([-np.inf], self.cortes))
+        self.largos_tramos = np.array([
+            arbol["largos"][np.searchsorted(arbol["cortes"], representantes, side="right")] for arbol in self.arboles
+        ])
+        # Puntaje en (0, 1): cerca de 1 es anómalo, bastante menos de 0.5 es normal
+        self.normalizacion = longitud_promedio(self.tamano)
+        self.puntajes = 2.0 ** (-self.largos_tramos.mean(axis=0) / self.normalizacion)
+        self._cortes_lista = self.cortes.tolist()
+        self._puntajes_lista = self.puntajes.tolist()
+
+        # Tramo en el que los valores quedan dentro del rango de la muestra de todos los árboles
+        self.minimos = np.array([[arbol["minimo"]] for arbol in self.arboles])
+        self.maximos = np.array([[arbol["maximo"]] for arbol in self.arboles])
+        self.desde = self.minimos.max()
+        self.hasta = self.maximos.min()
+        self.extremos = {}
+        for lado, hoja in (("izquierda", 0), ("derecha", -1)):
+            rangos = np.full((arboles, self.altura_maxima), np.inf)
+            for indice, arbol in enumerate(self.arboles):
+                rangos[indice, :len(arbol[f"rangos_{lado}"])] = arbol[f"rangos_{lado}"]
+            self.extremos[lado] = (rangos, np.array([arbol["largos"][hoja] for arbol in self.arboles]))
+        # Fuera de ese tramo el puntaje crece con la distancia: se tabula una vez por entrenamiento
+        # en una grilla geométrica y luego se interpola
+        escala = max(float(self.maximos.max() - self.minimos.min()), 1e-9)
+        distancias = np.concatenate(([0.0], np.geomspace(1e-3, 1e3, 127))) * escala
+        self.tabla_izquierda = (self.desde - distancias[::-1], self._puntuar_fuera(self.desde - distancias[::-1]))
+        self.tabla_derecha = (self.hasta + distancias, self._puntuar_fuera(self.hasta + distancias))
+
+    def _partir(self, ordenados, desde, hasta, profundidad, aleatorio, arbol):
+        # Recorrido en orden: los cortes quedan ordenados y 'largos' tiene el camino de cada hoja
+        if hasta - desde <= 1 or profundidad >= self.altura_maxima or ordenados[desde] == ordenados[hasta - 1]:
+            arbol["largos"].append(profundidad + longitud_promedio(hasta - desde))
+            return
+        rango = ordenados[hasta - 1] - ordenados[desde]
+        # Rangos de los nodos del camino hacia cada extremo, para puntuar valores fuera de la muestra
+        if desde == 0:
+            arbol["rangos_izquierda"].append(rango)
+        if hasta == self.tamano:
+            arbol["rangos_derecha"].append(rango)
+        corte = aleatorio.uniform(ordenados[desde], ordenados[hasta - 1])
+        medio = bisect_left(ordenados, corte, desde, hasta)
+        self._partir(ordenados, desde, medio, profundidad + 1, aleatorio, arbol)
+        arbol["cortes"].append(corte)
+        self._partir(ordenados, medio, hasta, profundidad + 1, aleatorio, arbol)
+
+    def _largo_fuera(self, x, lado, distancia):
+        # Largo esperado si el valor hubiera estado en la muestra: en cada nodo del camino hacia el
+        # extremo queda aislado con probabilidad distancia / (rango del nodo + distancia)
+        rangos, largo_hoja = self.extremos[lado]
+        d = distancia[:, None, :]
+        aislado = d / (rangos[:, :, None] + d)
+        sigue = np.cumprod(1.0 - aislado, axis=1)
+        previo = np.concatenate((np.ones_like(sigue[:, :1]), sigue[:, :-1]), axis=1)
+        niveles = np.arange(1, self.altura_maxima + 1)[None, :, None]
+        return (aislado * previo * niveles).sum(axis=1) + sigue[:, -1] * largo_hoja[:, None]
+
+    def _puntuar_fuera(self, x):
+        largos = self.largos_tramos[:, np.searchsorted(self.cortes, x, side="right")]
+        minimos, maximos = self.minimos, self.maximos
+        debajo = x[None, :] < minimos
+        encima = x[None, :] > maximos
+        if debajo.any():
+            largos = np.where(debajo, self._largo_fuera(x, "izquierda", np.maximum(minimos - x[None, :], 0.0)), largos)
+        if encima.any():
+            largos = np.where(encima, self._largo_fuera(x, "derecha", np.maximum(x[None, :] - maximos, 0.0)), largos)
+        return 2.0 ** (-largos.mean(axis=0) / self.normalizacion)
+
+    def puntuar(self, x):
+        puntajes = self.puntajes[np.searchsorted(self.cortes, x, side="right")]
+        debajo = x < self.desde
+        encima = ~debajo & (x > self.hasta)
+        if debajo.any():
+            puntajes[debajo] = np.interp(x[debajo], *self.tabla_izquierda)
+        if encima.any():
+            puntajes[encima] = np.interp(x[encima], *self.tabla_derecha)
+        return puntajes
+
+    def puntuar_valor(self, valor):
+        if valor < self.desde:
+            return float(np.interp(valor, *self.tabla_izquierda))
+        if valor > self.hasta:
+            return float(np.interp(valor, *self.tabla_derecha))
+        return self._puntajes_lista[bisect_right(self._cortes_lista, valor)]
+
+
+@registrar_detector
+class DetectorAislamiento(Detector):
+    # Estilo isolation forest: cada 'reentrenar' lecturas se entrena un bosque con muestras de las
+    # últimas 'ventana' y con él se puntúan las lecturas siguientes
+    nombre = "aislamiento"
+    etiqueta = "Aislamiento"
+    parametros = {"ventana": 512, "muestra": 128, "arboles": 32, "reentrenar": 256, "umbral": 0.85}
+
+    def __init__(self, **parametros):
+        super().__init__(**parametros)
+        self.valores = deque(maxlen=self.ventana)
+        self.n = 0
+        self.bosque = None
+
+    @property
+    def historial(self):
+        return self.ventana
+
+    def actualizar(self, valor, instante=None):
+        puntaje = math.nan if self.bosque is None else self.bosque.puntuar_valor(valor)
+        self.valores.append(valor)
+        self.n += 1
+        if self.n % self.reentrenar == 0:
+            self.bosque = BosqueAislamiento(self.valores, self.arboles, self.n, self.muestra)
+        return puntaje
+
+    def puntuar_lote(self, valores, instantes=None):
+        # Un tramo por modelo: cada tramo entre reentrenamientos se puntúa entero con el bosque vigente
+        x = np.asarray(valores, dtype=np.float64)
+        puntajes = np.full(len(x), np.nan)
+        bosque = None
+        desde = 0
+        for hasta in [*range(self.reentrenar, len(x) + 1, self.reentrenar), len(x)]:
+            if hasta == desde:
+                continue
+            if bosque is not None:
+                puntajes[desde:hasta] = bosque.puntuar(x[desde:hasta])
+            if hasta % self.reentrenar == 0:
+                bosque = BosqueAislamiento(x[max(0, hasta - self.ventana):hasta], self.arboles, hasta, self.muestra)
+            desde = hasta
+        return puntajes
+
+    def es_anomalo(self, puntaje):
+        return puntaje > self.umbral
+
+    def anomalos_lote(self, puntajes):
+        return puntajes > self.umbral
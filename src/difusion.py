@@ -0,0 +1,198 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict, defaultdict, deque
+
+logger = logging.getLogger("SensorApi")
+
+# Mensajes pendientes por cliente; al llenarse se descartan los más antiguos
+DIFUSION_BUFFER_CLIENTE = int(os.getenv("DIFUSION_BUFFER_CLIENTE", 1000))
+# Segundos sin mensajes tras los que se envía un latido para mantener viva la conexión
+DIFUSION_LATIDO_S = float(os.getenv("DIFUSION_LATIDO_S", 15))
+# Con la API en varios procesos, cada cuánto se envían al broker las lecturas y eventos acumulados
+DIFUSION_REENVIO_MS = float(os.getenv("DIFUSION_REENVIO_MS", 100))
+# Máximo de lecturas y eventos acumulados entre envíos al broker; al llenarse se descartan los más antiguos
+DIFUSION_REENVIO_MAX = int(os.getenv("DIFUSION_REENVIO_MAX", 10000))
+
+
+class Suscripcion:
+    # Buffer acotado de un cliente. Mientras el cliente no consume, una lectura nueva de un sensor
+    # reemplaza a la pendiente del mismo sensor (solo importa el último valor); los eventos críticos
+    # tienen clave propia y no se combinan.
+    def __init__(self, maquina_id=None, nombre_sensor=None, tamano=DIFUSION_BUFFER_CLIENTE):
+        self.maquina_id = maquina_id
+        self.nombre_sensor = nombre_sensor
+        self.tamano = tamano
+        self.pendientes = OrderedDict()
+        self.combinados = 0
+        self.descartados = 0
+        self.enviados = 0
+        self._aviso = asyncio.Event()
+
+    def poner(self, clave, texto):
+        if clave in self.pendientes:
+            self.pendientes[clave] = texto
+            self.combinados += 1
+        else:
+            if len(self.pendientes) >= self.tamano:
+                self.pendientes.popitem(last=False)
+                self.descartados += 1
+            self.pendientes[clave] = texto
+        self._aviso.set()
+
+    async def recibir(self, espera=DIFUSION_LATIDO_S):
+        # Devuelve todo lo pendiente, o una lista vacía si no llegó nada en 'espera' segundos
+        if not self.pendientes:
+            self._aviso.clear()
+            try:
+                await asyncio.wait_for(self._aviso.wait(), espera)
+            except asyncio.TimeoutError:
+                return []
+        mensajes = list(self.pendientes.values())
+        self.pendientes.clear()
+        self.enviados += len(mensajes)
+        return mensajes
+
+
+class Difusor:
+    # Reparte en el proceso las lecturas y eventos recién registrados a los clientes suscritos
+    def __init__(self):
+        self.suscripciones = defaultdict(set)
+        self.publicados = 0
+        # Cola acotada cuando la difusión pasa por el broker (ver activar_reenvio)
+        self.salientes = None
+        self.reenviados = 0
+        self.descartados = 0
+        self.errores = 0
+        # Procesos de la API con clientes conectados, según sus anuncios de presencia
+        self.proceso = uuid.uuid4().hex
+        self.remotos = set()
+        # Con reenvío, callback para anunciar a los demás procesos si este tiene clientes
+        self.anunciar = None
+
+    def suscribir(self, maquina_id=None, nombre_sensor=None):
+        suscripcion = Suscripcion(maquina_id, nombre_sensor)
+        primero = not self.suscripciones
+        self.suscripciones[maquina_id].add(suscripcion)
+        if primero and self.anunciar:
+            self.anunciar()
+        return suscripcion
+
+    def desuscribir(self, suscripcion):
+        conjunto = self.suscripciones.get(suscripcion.maquina_id)
+        if conjunto is None:
+            return
+        conjunto.discard(suscripcion)
+        if not conjunto:
+            del self.suscripciones[suscripcion.maquina_id]
+            if not self.suscripciones and self.anunciar:
+                self.anunciar()
+
+    def hay_clientes(self):
+        # Con reenvío los clientes pueden estar en cualquier proceso
+        return bool(self.suscripciones) or bool(self.remotos)
+
+    def registrar_presencia(self, proceso, carga_util):
+        # Carga vacía: el proceso se quedó sin clientes o terminó (mensaje de última voluntad)
+        if carga_util:
+            self.remotos.add(proceso)
+        else:
+            self.remotos.discard(proceso)
+
+    def activar_reenvio(self, maximo=DIFUSION_REENVIO_MAX):
+        self.salientes = deque(maxlen=maximo)
+
+    def publicar(self, clave, maquina_id, nombre_sensor, datos):
+        if self.salientes is not None:
+            # La entrega la hace cada proceso al recibir el lote desde el broker, incluido este
+            if len(self.salientes) == self.salientes.maxlen:
+                self.descartados += 1
+            self.salientes.append([list(clave), maquina_id, nombre_sensor, datos])
+            return
+        self.entregar(clave, maquina_id, nombre_sensor, datos)
+
+    async def reenviar(self, cliente, tema, intervalo_ms=DIFUSION_REENVIO_MS):
+        # Un mensaje MQTT por intervalo con todo lo acumulado, no uno por lectura
+        while True:
+            await asyncio.sleep(intervalo_ms / 1000)
+            if not self.salientes:
+                continue
+            salientes = list(self.salientes)
+            self.salientes.clear()
+            try:
+                await cliente.publish(tema, json.dumps(salientes))
+            except Exception as e:
+                # Son datos en vivo: el lote se pierde y el próximo intervalo sigue con lo nuevo
+                self.errores += 1
+                self.descartados += len(salientes)
+                logger.error(f"Error al reenviar la difusión al broker: {e}")
+            else:
+                self.reenviados += len(salientes)
+
+    def recibir(self, carga_util):
+        if not self.suscripciones:
+            return
+        for clave, maquina_id, nombre_sensor, datos in json.loads(carga_util):
+            self.entregar(tuple(clave), maquina_id, nombre_sensor, datos)
+
+    def entregar(self, clave, maquina_id, nombre_sensor, datos):
+        # Las suscripciones con maquina_id None reciben todas las máquinas
+        destinos = [
+            suscripcion
+            for conjunto in (self.suscripciones.get(maquina_id, ()), self.suscripciones.get(None, ()))
+            for suscripcion in conjunto
+            if suscripcion.nombre_sensor is None or suscripcion.nombre_sensor == nombre_sensor
+        ]
+        if not destinos:
+            return
+        # Se serializa una sola vez para todos los clientes
+        texto = json.dumps(datos)
+        for suscripcion in destinos:
+            suscripcion.poner(clave, texto)
+        self.publicados += 1
+
+    def publicar_lectura(self, id_lectura, maquina_id, nombre_sensor, tipo_sensor, fila):
+        self.publicar(("lectura", fila["sensor_id"]), maquina_id, nombre_sensor, {
+            "evento": "lectura",
+            "id": id_lectura,
+            "maquina_id": maquina_id,
+            "sensor_id": fila["sensor_id"],
+            "nombre": nombre_sensor,
+            "tipo": tipo_sensor,
+            "valor": fila["valor"],
+            "estado": fila["estado"],
+            "fecha_hora": fila["fecha_hora"].isoformat(),
+        })
+
+    def publicar_evento(self, evento_critico, maquina_id, nombre_sensor, tipo_sensor):
+        self.publicar(("evento", evento_critico.id), maquina_id, nombre_sensor, {
+            "evento": "evento_critico",
+            "id": evento_critico.id,
+            "maquina_id": maquina_id,
+            "sensor_id": evento_critico.sensor_id,
+            "lectura_id": evento_critico.lectura_id,
+            "nombre": nombre_sensor,
+            "tipo": tipo_sensor,
+            "valor": evento_critico.value,
+            "descripcion": evento_critico.description,
+            "fecha_hora": evento_critico.timestamp.isoformat() if evento_critico.timestamp else None,
+        })
+
+    def estado(self):
+        clientes = [suscripcion for conjunto in self.suscripciones.values() for suscripcion in conjunto]
+        return {
+            "clientes": len(clientes),
+            "publicados": self.publicados,
+            "reenviados": self.reenviados,
+            "descartados_reenvio": self.descartados,
+            "errores_reenvio": self.errores,
+            "procesos_con_clientes": len(self.remotos),
+            "pendientes": sum(len(suscripcion.pendientes) for suscripcion in clientes),
+            "combinados": sum(suscripcion.combinados for suscripcion in clientes),
+            "descartados": sum(suscripcion.descartados for suscripcion in clientes),
+        }
+
+
+difusor = Difusor()
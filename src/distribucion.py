@@ -0,0 +1,91 @@
+import os
+import zlib
+
+# completo: ingesta y API (un solo proceso) | ingesta: solo consume MQTT | api: solo atiende HTTP
+MODO_PROCESO = os.getenv("MODO_PROCESO", "completo")
+MODOS_PROCESO = ("completo", "ingesta", "api")
+# Grupo de suscripción compartida ($share/<grupo>/...): el broker reparte los mensajes entre los
+# procesos del grupo. El orden por sensor solo se conserva si el broker reparte por tema
+# (p. ej. EMQX con shared_subscription_strategy = hash_topic); con reparto round robin usar particiones.
+INGESTA_GRUPO = os.getenv("INGESTA_GRUPO")
+# Partición fija por máquina: cada proceso atiende las máquinas con crc32(nombre) % INGESTA_PARTICIONES
+# entre sus INGESTA_PARTICION (índices separados por coma). Todas las lecturas de una máquina las
+# procesa un único proceso, en orden. El filtro es del lado del cliente: cada proceso recibe todos los
+# temas de ingesta y descarta los ajenos (los dispositivos no publican por partición). La partición
+# sale del entorno, así que cada proceso se lanza por separado con su propio INGESTA_PARTICION; los
+# workers de uvicorn --workers comparten el entorno y para ellos la opción es INGESTA_GRUPO ($share).
+INGESTA_PARTICIONES = int(os.getenv("INGESTA_PARTICIONES", 1))
+INGESTA_PARTICION = os.getenv("INGESTA_PARTICION", "0")
+
+TEMAS_INGESTA = ("maquinas/+/+/+", "lotes/+/+")
+# Temas entre procesos de la API; no los publican los dispositivos
+PREFIJO_INTERNO = "interno/"
+TEMA_DIFUSION = "interno/difusion"
+TEMA_CONTROL = "interno/control"
+# interno/presencia/<proceso>: mensaje retenido de cada proceso de la API indicando si tiene
+# clientes en vivo; la ingesta solo reenvía la difusión mientras alguno los tenga
+TEMA_PRESENCIA = "interno/presencia"
+
+
+def particion_de(maquina, particiones):
+    return zlib.crc32(maquina.encode()) % particiones
+
+
+class Distribucion:
+    # Qué parte del trabajo hace este proceso cuando la API corre en varios procesos o nodos
+    def __init__(self, modo=MODO_PROCESO, grupo=INGESTA_GRUPO, particiones=INGESTA_PARTICIONES, propias=INGESTA_PARTICION):
+        if modo not in MODOS_PROCESO:
+            raise ValueError(f"Modo de proceso inválido: {modo}")
+        propias = {int(indice) for indice in str(propias).split(",") if indice.strip()}
+        if particiones < 1 or not propias or not all(0 <= indice < particiones for indice in propias):
+            raise ValueError(f"Particiones de ingesta inválidas: {sorted(propias)} de {particiones}")
+        self.modo = modo
+        self.grupo = grupo
+        self.particiones = particiones
+        self.propias = propias
+        self.ajenos = 0
+
+    @property
+    def ingiere(self):
+        return self.modo != "api"
+
+    @property
+    def atiende_api(self):
+        return self.modo != "ingesta"
+
+    @property
+    def distribuida(self):
+        # Con más de un proceso las lecturas en vivo y los cambios de configuración viajan por el broker
+        return self.modo != "completo" or self.particiones > 1 or bool(self.grupo)
+
+    def suscripciones(self):
+        temas = []
+        if self.ingiere:
+            temas += [f"$share/{self.grupo}/{tema}" if self.grupo else tema for tema in TEMAS_INGESTA]
+        if self.distribuida:
+            # Todos los procesos reciben la difusión y el control, sin compartir
+            temas += [TEMA_DIFUSION, TEMA_CONTROL]
+            if self.ingiere:
+                temas.append(f"{TEMA_PRESENCIA}/+")
+        return temas
+
+    def es_propia(self, tema):
+        # Los mensajes de máquinas de otra partición se descartan sin decodificar la carga
+        if self.particiones == 1:
+            return True
+        if particion_de(tema.split("/", 2)[1], self.particiones) in self.propias:
+            return True
+        self.ajenos += 1
+        return False
+
+    def estado(self):
+        return {
+            "modo": self.modo,
+            "grupo": self.grupo,
+            "particiones": self.particiones,
+            "propias": sorted(self.propias),
+            "ajenos": self.ajenos,
+        }
+
+
+distribucion = Distribucion()
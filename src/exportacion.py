@@ -0,0 +1,139 @@
+import csv
+import io
+import json
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy.future import select
+from . import models
+
+# Filas que se traen del cursor del servidor por vuelta; acota la memoria de cada exportación
+EXPORTACION_FILAS_POR_BLOQUE = int(os.getenv("EXPORTACION_FILAS_POR_BLOQUE", 10000))
+FORMATOS_EXPORTACION = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+COLUMNAS_EXPORTACION = ["id", "sensor_id", "nombre", "tipo", "fecha_hora", "valor", "estado"]
+ESQUEMA_ARROW = pa.schema([
+    ("id", pa.int64()),
+    ("sensor_id", pa.int32()),
+    ("nombre", pa.string()),
+    ("tipo", pa.string()),
+    ("fecha_hora", pa.timestamp("us", tz="UTC")),
+    ("valor", pa.float64()),
+    ("estado", pa.bool_()),
+])
+
+
+def consulta_exportacion(sensor_ids, fecha_inicio=None, fecha_fin=None):
+    consulta = select(
+        models.Lectura.id, models.Lectura.sensor_id, models.Lectura.fecha_hora,
+        models.Lectura.valor, models.Lectura.estado
+    ).where(models.Lectura.sensor_id.in_(sensor_ids))
+    if fecha_inicio:
+        consulta = consulta.filter(models.Lectura.fecha_hora >= fecha_inicio)
+    if fecha_fin:
+        consulta = consulta.filter(models.Lectura.fecha_hora <= fecha_fin)
+    return consulta.order_by(models.Lectura.fecha_hora, models.Lectura.id)
+
+
+async def bloques_lecturas(consulta, sensores):
+    # Sesión propia: la de la dependencia ya está cerrada cuando se envía el cuerpo de la respuesta.
+    # stream() abre un cursor del lado del servidor y solo hay un bloque de filas en memoria a la vez.
+    async with models.get_async_session() as sesion:
+        resultado = await sesion.stream(consulta.execution_options(yield_per=EXPORTACION_FILAS_POR_BLOQUE))
+        async for bloque in resultado.partitions():
+            yield [
+                (id_fila, sensor_id, *sensores[sensor_id], fecha_hora, valor, estado)
+                for id_fila, sensor_id, fecha_hora, valor, estado in bloque
+            ]
+
+
+async def encadenar(*fuentes):
+    for fuente in fuentes:
+        async for bloque in fuente:
+            yield bloque
+
+
+def exportar(formato, consulta, sensores, anteriores=None):
+    # sensores: {sensor_id: (nombre, tipo)}; anteriores: bloques del archivo frío, que van antes que los de la base
+    bloques = bloques_lecturas(consulta, sensores)
+    if anteriores is not None:
+        bloques = encadenar(anteriores, bloques)
+    if formato == "csv":
+        return exportar_csv(bloques)
+    if formato == "ndjson":
+        return exportar_ndjson(bloques)
+    return exportar_columnar(bloques, formato)
+
+
+async def exportar_csv(bloques):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(COLUMNAS_EXPORTACION)
+    yield buffer.getvalue()
+    async for bloque in bloques:
+        buffer.seek(0)
+        buffer.truncate()
+        escritor.writerows(
+            (id_fila, sensor_id, nombre, tipo, fecha_hora.isoformat(), valor, estado)
+            for id_fila, sensor_id, nombre, tipo, fecha_hora, valor, estado in bloque
+        )
+        yield buffer.getvalue()
+
+
+async def exportar_ndjson(bloques):
+    async for bloque in bloques:
+        yield "".join(
+            json.dumps({
+                "id": id_fila,
+                "sensor_id": sensor_id,
+                "nombre": nombre,
+                "tipo": tipo,
+                "fecha_hora": fecha_hora.isoformat(),
+                "valor": valor,
+                "estado": estado,
+            }) + "\n"
+            for id_fila, sensor_id, nombre, tipo, fecha_hora, valor, estado in bloque
+        )
+
+
+class SumideroBytes:
+    # Archivo de solo escritura que acumula lo que produce el escritor de Arrow/Parquet
+    # hasta que el generador lo entrega al cliente
+    closed = False
+
+    def __init__(self):
+        self.partes = []
+
+    def write(self, datos):
+        self.partes.append(bytes(datos))
+        return len(datos)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def vaciar(self):
+        datos = b"".join(self.partes)
+        self.partes = []
+        return datos
+
+
+async def exportar_columnar(bloques, formato):
+    sumidero = SumideroBytes()
+    if formato == "parquet":
+        # Cada bloque se escribe como un row group; el pie del archivo va al cerrar
+        escritor = pq.ParquetWriter(sumidero, ESQUEMA_ARROW, compression="zstd")
+    else:
+        escritor = pa.ipc.new_stream(sumidero, ESQUEMA_ARROW)
+    async for bloque in bloques:
+        columnas = list(zip(*bloque))
+        escritor.write_batch(pa.record_batch(columnas, schema=ESQUEMA_ARROW))
+        yield sumidero.vaciar()
+    escritor.close()
+    yield sumidero.vaciar()
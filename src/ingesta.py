@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import time
+import zlib
+from collections import deque
+from sqlalchemy.exc import DataError, IntegrityError, InterfaceError, OperationalError, ProgrammingError
+
+logger = logging.getLogger("SensorApi")
+
+INGESTA_POR_LOTES = os.getenv("INGESTA_POR_LOTES", "True").lower() == "true"
+INGESTA_LOTE_MAX_FILAS = int(os.getenv("INGESTA_LOTE_MAX_FILAS", 500))
+INGESTA_LOTE_MAX_MS = int(os.getenv("INGESTA_LOTE_MAX_MS", 50))
+# Lecturas en espera por lote; al llegar al tope el trabajador se detiene y la contrapresión llega a la cola
+INGESTA_LOTE_MAX_PENDIENTES = int(os.getenv("INGESTA_LOTE_MAX_PENDIENTES", 20 * INGESTA_LOTE_MAX_FILAS))
+# Intentos de un lote que falla por un error desconocido antes de partirlo para aislar las filas inválidas
+INGESTA_LOTE_REINTENTOS = int(os.getenv("INGESTA_LOTE_REINTENTOS", 3))
+# Últimas lecturas descartadas que se conservan para inspección (ver /ingesta/metricas)
+INGESTA_DESCARTADAS_MAX = int(os.getenv("INGESTA_DESCARTADAS_MAX", 100))
+ESPERA_MAX_S = 5.0
+
+# Errores que dependen de las filas: reintentarlas no sirve, se aíslan partiendo el lote
+ERRORES_DE_DATOS = (DataError, IntegrityError, ProgrammingError, TypeError, ValueError, KeyError)
+# Errores de conexión: el lote se reintenta sin límite, con espera creciente
+ERRORES_TRANSITORIOS = (InterfaceError, OperationalError, OSError, asyncio.TimeoutError)
+
+
+def es_transitorio(error):
+    if getattr(error, "connection_invalidated", False):
+        return True
+    return isinstance(error, ERRORES_TRANSITORIOS) and not isinstance(error, ERRORES_DE_DATOS)
+
+
+class LoteIngesta:
+    # Acumula lecturas decodificadas en memoria y las vuelca en una sola transacción
+    # cuando se alcanza el tamaño máximo del lote o vence la ventana de tiempo.
+    def __init__(self, volcar, max_filas=INGESTA_LOTE_MAX_FILAS, max_ms=INGESTA_LOTE_MAX_MS, max_pendientes=INGESTA_LOTE_MAX_PENDIENTES):
+        self.volcar = volcar
+        self.max_filas = max_filas
+        self.max_ms = max_ms
+        self.max_pendientes = max(max_pendientes, max_filas)
+        self.pendientes = []
+        self._bloqueo = asyncio.Lock()
+        self._hay_pendientes = asyncio.Event()
+        self._hay_lugar = asyncio.Event()
+        self._hay_lugar.set()
+        self._tarea = None
+        # Fallos seguidos del lote al frente de pendientes y momento del próximo intento
+        self.fallos = 0
+        self._reintentar_en = 0.0
+        self.descartadas = deque(maxlen=INGESTA_DESCARTADAS_MAX)
+        self.metricas = {
+            "lotes": 0,
+            "filas": 0,
+            "errores": 0,
+            "descartadas": 0,
+            "ultimo_lote_filas": 0,
+            "ultimo_lote_ms": 0.0,
+            "max_lote_ms": 0.0,
+        }
+
+    def iniciar(self):
+        self._tarea = asyncio.get_event_loop().create_task(self._temporizador())
+
+    async def detener(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+        # Vaciado final para no perder lecturas al apagar
+        await self.vaciar(forzar=True)
+
+    async def agregar(self, lectura):
+        await self.agregar_varias([lectura])
+
+    async def agregar_varias(self, lecturas):
+        # Con la base caída el lote no se vacía: el trabajador espera acá en lugar de acumular sin límite
+        while len(self.pendientes) >= self.max_pendientes:
+            self._hay_lugar.clear()
+            await self._hay_lugar.wait()
+        self.pendientes.extend(lecturas)
+        if len(self.pendientes) >= self.max_filas:
+            await self.vaciar()
+        else:
+            self._hay_pendientes.set()
+
+    async def _temporizador(self):
+        while True:
+            await self._hay_pendientes.wait()
+            await asyncio.sleep(self.max_ms / 1000)
+            self._hay_pendientes.clear()
+            # Al detener se cancela el temporizador: el volcado en curso termina igual
+            await asyncio.shield(self.vaciar())
+
+    async def vaciar(self, forzar=False):
+        async with self._bloqueo:
+            if not forzar and time.monotonic() < self._reintentar_en:
+                # Todavía en la espera tras un fallo; el temporizador vuelve a intentar
+                self._hay_pendientes.set()
+                return
+            lote, self.pendientes = self.pendientes, []
+            if not lote:
+                return
+            inicio = time.perf_counter()
+            try:
+                await self.volcar(lote)
+            except Exception as e:
+                self.metricas["errores"] += 1
+                self.fallos += 1
+                logger.error(f"Error al volcar lote de {len(lote)} lecturas (intento {self.fallos}): {e}")
+                if es_transitorio(e) or (not isinstance(e, ERRORES_DE_DATOS) and self.fallos < INGESTA_LOTE_REINTENTOS):
+                    # Se reencolan las lecturas para reintentar después de una espera creciente
+                    self.pendientes[:0] = lote
+                    self._reintentar_en = time.monotonic() + min(self.max_ms / 1000 * 2 ** self.fallos, ESPERA_MAX_S)
+                    self._hay_pendientes.set()
+                    return
+                # Error de los datos (o persistente): se parte el lote y se descartan solo las filas que fallan
+                await self._aislar(lote)
+                self._liberar()
+                return
+            duracion_ms = (time.perf_counter() - inicio) * 1000
+            self.fallos = 0
+            self._reintentar_en = 0.0
+            self._liberar()
+
+        self.metricas["lotes"] += 1
+        self.metricas["filas"] += len(lote)
+        self.metricas["ultimo_lote_filas"] = len(lote)
+        self.metricas["ultimo_lote_ms"] = round(duracion_ms, 3)
+        self.metricas["max_lote_ms"] = round(max(self.metricas["max_lote_ms"], duracion_ms), 3)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Lote de {len(lote)} lecturas volcado en {duracion_ms:.1f} ms")
+
+    async def _aislar(self, lote):
+        # Bisección: cada mitad se vuelca en su propia transacción; una lectura que falla sola se descarta.
+        # Si la base se cae a mitad de camino, lo que falta se reencola como un lote normal.
+        partes = [lote]
+        while partes:
+            parte = partes.pop()
+            try:
+                await self.volcar(parte)
+                self.metricas["filas"] += len(parte)
+            except Exception as e:
+                if es_transitorio(e):
+                    self.pendientes[:0] = parte + [lectura for resto in reversed(partes) for lectura in resto]
+                    self._reintentar_en = time.monotonic() + min(self.max_ms / 1000 * 2 ** self.fallos, ESPERA_MAX_S)
+                    self._hay_pendientes.set()
+                    return
+                if len(parte) == 1:
+                    self.metricas["descartadas"] += 1
+                    self.descartadas.append({"lectura": repr(parte[0]), "error": str(e)})
+                    logger.error(f"Lectura descartada tras {self.fallos} intentos: {parte[0]!r}: {e}")
+                    continue
+                mitad = len(parte) // 2
+                # Se apila primero la segunda mitad para volcar en orden
+                partes += [parte[mitad:], parte[:mitad]]
+        self.fallos = 0
+        self._reintentar_en = 0.0
+
+    def _liberar(self):
+        if len(self.pendientes) < self.max_pendientes:
+            self._hay_lugar.set()
+
+    def estado(self):
+        return {
+            **self.metricas,
+            "pendientes": len(self.pendientes),
+            "fallos_seguidos": self.fallos,
+            "ultimas_descartadas": list(self.descartadas),
+        }
+
+
+INGESTA_TRABAJADORES = int(os.getenv("INGESTA_TRABAJADORES", 4))
+INGESTA_COLA_TAMANO = int(os.getenv("INGESTA_COLA_TAMANO", 10000))
+# bloquear: el lector MQTT espera (contrapresión) | descartar_nuevo | descartar_antiguo
+INGESTA_COLA_POLITICA = os.getenv("INGESTA_COLA_POLITICA", "bloquear")
+POLITICAS_COLA = ("bloquear", "descartar_nuevo", "descartar_antiguo")
+
+
+class ColaIngesta:
+    # Colas acotadas entre el lector MQTT y un grupo de trabajadores. Cada tema se asigna
+    # siempre al mismo trabajador, así se conserva el orden de las lecturas de cada sensor.
+    def __init__(self, procesar, trabajadores=INGESTA_TRABAJADORES, tamano=INGESTA_COLA_TAMANO, politica=INGESTA_COLA_POLITICA):
+        if politica not in POLITICAS_COLA:
+            raise ValueError(f"Política de cola inválida: {politica}")
+        self.procesar = procesar
+        self.politica = politica
+        self.colas = [asyncio.Queue(maxsize=tamano) for _ in range(trabajadores)]
+        self._tareas = []
+        self.descartados = 0
+        self.procesados = [0] * trabajadores
+        self.lag_ms = [0.0] * trabajadores
+
+    def iniciar(self):
+        bucle = asyncio.get_event_loop()
+        self._tareas = [bucle.create_task(self._trabajador(indice, cola)) for indice, cola in enumerate(self.colas)]
+
+    def indice_para(self, tema):
+        return zlib.crc32(tema.encode()) % len(self.colas)
+
+    async def encolar(self, tema, carga_util):
+        cola = self.colas[self.indice_para(tema)]
+        item = (tema, carga_util, time.monotonic())
+        if self.politica == "bloquear":
+            await cola.put(item)
+            return
+        if cola.full():
+            self.descartados += 1
+            if self.politica == "descartar_nuevo":
+                return
+            cola.get_nowait()
+            cola.task_done()
+        cola.put_nowait(item)
+
+    async def _trabajador(self, indice, cola):
+        while True:
+            tema, carga_util, encolado = await cola.get()
+            self.lag_ms[indice] = (time.monotonic() - encolado) * 1000
+            try:
+                await self.procesar(indice, tema, carga_util)
+                self.procesados[indice] += 1
+            except Exception as e:
+                logger.error(f"Error al procesar datos del sensor: {e}")
+            finally:
+                cola.task_done()
+
+    async def drenar(self):
+        # Espera a que se procesen los mensajes ya encolados antes de detener los trabajadores
+        for cola in self.colas:
+            await cola.join()
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+
+    def estado(self):
+        return {
+            "politica": self.politica,
+            "profundidad": sum(cola.qsize() for cola in self.colas),
+            "descartados": self.descartados,
+            "trabajadores": [
+                {
+                    "profundidad": cola.qsize(),
+                    "capacidad": cola.maxsize,
+                    "procesados": self.procesados[indice],
+                    "lag_ms": round(self.lag_ms[indice], 3),
+                }
+                for indice, cola in enumerate(self.colas)
+            ],
+        }
@@ -1,12 +1,19 @@
 from contextlib import asynccontextmanager
+import base64
+import binascii
+import heapq
+import math
 import json
 from typing import List
-from fastapi import APIRouter, FastAPI, Depends, HTTPException, status, Query, BackgroundTasks
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, status, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.orm import selectinload, joinedload
 from . import models, schemas,users
 from datetime import datetime, timezone, timedelta
 from fastapi.security import OAuth2PasswordBearer
 import asyncio
+import time
+import uuid
 import aiomqtt
 from logging.config import dictConfig
 import logging
@@ -14,84 +21,299 @@ import os
 from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi_users.authentication import BearerTransport
 from sqlalchemy.future import select
-from sqlalchemy import and_, desc, func
+from sqlalchemy import and_, desc, func, insert, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from .users import auth_backend, current_active_user, fastapi_users
-from scipy import stats
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
-from fpdf import FPDF
+from fastapi_mail import ConnectionConfig
 import numpy as np
+from .ingesta import LoteIngesta, ColaIngesta, INGESTA_POR_LOTES, INGESTA_TRABAJADORES
+from .cache import cache_dimensiones
+from .anomalias import motor_anomalias, resolver_detector
+from .detectores import DETECTORES
+from .agregados import (
+    AGREGADOS_MAX_PUNTOS, a_utc, actualizar_agregados, combinar_intervalos, consulta_agregados, consulta_intervalos,
+    RESOLUCIONES, desviacion_estandar, elegir_resolucion, fuente_intervalos, truncar
+)
+from .exportacion import FORMATOS_EXPORTACION, consulta_exportacion, exportar
+from .difusion import difusor
+from .distribucion import PREFIJO_INTERNO, TEMA_CONTROL, TEMA_DIFUSION, TEMA_PRESENCIA, distribucion
+from .respuestas import RESPUESTAS_TTL_RESUMEN_S, RESPUESTAS_TTL_S, cache_respuestas
+from .retencion import mantener_retencion, retencion
+from .archivo import archivo, ARCHIVO_DIAS, mantener_archivo
+from .tendencias import calcular_tendencias, instantes_iso, leer_series
+from .notificaciones import DespachadorNotificaciones, registrar_notificaciones
+from .reportes import generador_pdf
+from .cargas import FORMATOS_LOTE, convertir_a_booleano, convertir_a_float, decodificar_lote
+from .metricas import (
+    ETAPA_ANOMALIAS, ETAPA_DECODIFICACION, ETAPA_ESCRITURA, LECTURAS, MENSAJES, METRICAS_TOKEN,
+    MetricasHTTP, ResumenPeriodico, colector_estado, medir_lag_bucle
+)
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 bearer_transport = BearerTransport(tokenUrl="auth/jwt/login")
 dictConfig(schemas.LogConfig().model_dump())
 logger = logging.getLogger("SensorApi")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 tareas_fondo = set()
 cliente = None
+cola_ingesta = None
+PATRON_RESOLUCION = "^(auto|cruda|minuto|hora|dia)$"
+lotes_ingesta = []
+resumen_lecturas = ResumenPeriodico("{cantidad} nuevas lecturas de sensores registradas en {segundos:.0f} s.")
 
 USE_EMAILING = os.getenv("USE_EMAILING", False)
 if USE_EMAILING:
     conf_correo = ConnectionConfig(
         MAIL_USERNAME = str(os.getenv("MAIL_USERNAME")),
         MAIL_PASSWORD = str(os.getenv("MAIL_PASSWORD")),
-        MAIL_FROM = str("sistemas@bauduccosa.com.ar"),
-        MAIL_PORT = 25,
+        MAIL_FROM = str(os.getenv("MAIL_FROM", "sistemas@bauduccosa.com.ar")),
+        MAIL_PORT = int(os.getenv("MAIL_PORT", 25)),
         MAIL_SERVER = str(os.getenv("MAIL_SERVER")),
         MAIL_STARTTLS = os.getenv("MAIL_STARTTLS", "True").lower() == "true",
         MAIL_SSL_TLS = os.getenv("MAIL_SSL_TLS", "False").lower() == "true",
-        USE_CREDENTIALS = True,
+        USE_CREDENTIALS = os.getenv("MAIL_USE_CREDENTIALS", "True").lower() == "true",
         VALIDATE_CERTS = True
     )
 
-    fastmail = FastMail(conf_correo)
+    despachador_notificaciones = DespachadorNotificaciones(conf_correo)
+else:
+    despachador_notificaciones = None
+
+
+def estado_pool():
+    pool = models.engine.pool
+    return [(("en_uso",), pool.checkedout()), (("libres",), pool.checkedin()), (("desborde",), max(pool.overflow(), 0))]
+
+# Se leen al consultar /metrics
+colector_estado.agregar("sensores_db_pool_conexiones", "Conexiones del pool de la base por estado", estado_pool, ("estado",))
+colector_estado.agregar(
+    "sensores_cola_ingesta_profundidad", "Mensajes esperando en cada cola de ingesta",
+    lambda: [((indice,), cola.qsize()) for indice, cola in enumerate(cola_ingesta.colas)] if cola_ingesta else [],
+    ("trabajador",)
+)
+colector_estado.agregar(
+    "sensores_cola_ingesta_descartados", "Mensajes descartados por cola llena",
+    lambda: cola_ingesta.descartados if cola_ingesta else 0
+)
+colector_estado.agregar(
+    "sensores_lote_ingesta_pendientes", "Lecturas acumuladas en cada lote a la espera de volcarse",
+    lambda: [((indice,), len(lote.pendientes)) for indice, lote in enumerate(lotes_ingesta)],
+    ("trabajador",)
+)
+colector_estado.agregar(
+    "sensores_ingesta_mensajes_ajenos", "Mensajes descartados por pertenecer a otra partición de ingesta",
+    lambda: distribucion.ajenos
+)
+colector_estado.agregar("sensores_difusion_clientes", "Clientes conectados al canal en vivo", lambda: difusor.estado()["clientes"])
+colector_estado.agregar("sensores_pdf_cache_bytes", "Bytes en la cache de PDFs", lambda: generador_pdf.cache.bytes)
 
+def iniciar_ingesta(procesar=None, volcar=None):
+    # Colas de trabajadores y lotes de escritura; el benchmark de carga las arranca sin broker
+    # ni servidor HTTP, envolviendo procesar/volcar para medir la latencia
+    global cola_ingesta, lotes_ingesta
+    if INGESTA_POR_LOTES:
+        # Un lote por trabajador: las lecturas de un sensor nunca se reparten entre lotes
+        lotes_ingesta = [LoteIngesta(volcar or volcar_lote) for _ in range(INGESTA_TRABAJADORES)]
+        for lote in lotes_ingesta:
+            lote.iniciar()
+    cola_ingesta = ColaIngesta(procesar or procesar_mensaje)
+    cola_ingesta.iniciar()
+
+async def detener_ingesta():
+    # Procesa lo ya encolado y vuelca los lotes pendientes
+    if cola_ingesta:
+        await cola_ingesta.drenar()
+    for lote in lotes_ingesta:
+        await lote.detener()
 
 @asynccontextmanager
 async def lifespan(app):
     await models.create_db_and_tables()
     await models.initialize_sensor_types()
+    await cache_dimensiones.calentar()
+    await motor_anomalias.cargar_configuracion()
+    await asyncio.to_thread(archivo.cargar_marca)
     global cliente
-    async with aiomqtt.Client(os.getenv('HOST_IP', 'localhost'), 1883) as c:
+    if distribucion.ingiere:
+        iniciar_ingesta()
+    if distribucion.distribuida:
+        difusor.activar_reenvio()
+        cache_respuestas.difundir = lambda etiquetas: crear_tarea_fondo(publicar_control({"invalidar": etiquetas}))
+        users.cache_usuarios.difundir = lambda usuario_id: crear_tarea_fondo(publicar_control({"usuario": usuario_id}))
+        archivo.difundir = lambda marca: publicar_control({"marca": marca.isoformat()})
+    if despachador_notificaciones:
+        despachador_notificaciones.iniciar()
+    presencia = None
+    if distribucion.distribuida and distribucion.atiende_api:
+        # Si el proceso cae, el broker borra su presencia retenida con el mensaje de última voluntad
+        presencia = aiomqtt.Will(f"{TEMA_PRESENCIA}/{difusor.proceso}", b"", qos=1, retain=True)
+        difusor.anunciar = lambda: crear_tarea_fondo(anunciar_presencia())
+    async with aiomqtt.Client(os.getenv('HOST_IP', 'localhost'), 1883, will=presencia) as c:
         cliente = c
-        await cliente.subscribe("maquinas/+/+/+")
+        # maquinas/+/+/+ y lotes/<maquina>/<formato> (salvo en modo api), más los temas internos
+        # si hay varios procesos; ver distribucion.py
+        for tema in distribucion.suscripciones():
+            await cliente.subscribe(tema)
         bucle = asyncio.get_event_loop()
-        tarea = bucle.create_task(escuchar(cliente))
-        tareas_fondo.add(tarea)
-        tarea.add_done_callback(tareas_fondo.discard)
+        tareas = [
+            bucle.create_task(escuchar(cliente)),
+            bucle.create_task(mantener_particiones()),
+            bucle.create_task(medir_lag_bucle()),
+        ]
+        if distribucion.ingiere:
+            # Un bloqueo consultivo evita que dos procesos de ingesta apliquen la retención o archiven a la vez
+            tareas.append(bucle.create_task(mantener_retencion()))
+            tareas.append(bucle.create_task(mantener_archivo()))
+        if distribucion.distribuida and distribucion.ingiere:
+            tareas.append(bucle.create_task(difusor.reenviar(cliente, TEMA_DIFUSION)))
+        for tarea in tareas:
+            tareas_fondo.add(tarea)
+            tarea.add_done_callback(tareas_fondo.discard)
         yield
-        tarea.cancel()
-        try:
-            await tarea
-        except asyncio.CancelledError:
-            pass
+        for tarea in tareas:
+            tarea.cancel()
+            try:
+                await tarea
+            except asyncio.CancelledError:
+                pass
+        if presencia:
+            await cliente.publish(presencia.topic, b"", qos=1, retain=True)
+    await detener_ingesta()
+    if despachador_notificaciones:
+        await despachador_notificaciones.detener()
+    generador_pdf.cerrar()
 
 app = FastAPI(lifespan=lifespan, root_path="/api/")
+# Rutas que conserva un proceso en modo ingesta (ver el final del módulo)
+RUTAS_INGESTA = {"/metrics", "/ingesta/metricas"}
+app.add_middleware(MetricasHTTP)
 
 @asynccontextmanager
 async def obtener_db():
     async with models.get_async_session() as sesion:
         yield sesion
 
+async def mantener_particiones():
+    # Crea por adelantado las particiones mensuales de 'lecturas'
+    while True:
+        await asyncio.sleep(24 * 3600)
+        try:
+            creadas = await models.asegurar_particiones_lecturas()
+            if creadas:
+                logger.info(f"{creadas} particiones nuevas creadas para la tabla de lecturas.")
+        except Exception as e:
+            logger.error(f"Error al crear particiones de lecturas: {e}")
+
 async def escuchar(cliente):
     async for mensaje in cliente.messages:
         #logger.info(f"Tema: {mensaje.topic}")
         #logger.info(f"Carga útil: {mensaje.payload.decode()}")
 
         tema_str = str(mensaje.topic)
-        if not validar_tema(tema_str):
+        if tema_str.startswith(PREFIJO_INTERNO):
+            await atender_interno(tema_str, mensaje.payload)
+            continue
+        if not validar_tema(tema_str) or not distribucion.es_propia(tema_str):
             continue
 
-        maquina, tipo_sensor_nombre, nombre_sensor = analizar_tema(tema_str)
+        # El lector solo encola; la escritura y el análisis corren en los trabajadores
+        await cola_ingesta.encolar(tema_str, mensaje.payload)
 
-        try:
-            datos_sensor = mensaje.payload.decode()
+def crear_tarea_fondo(corrutina):
+    tarea = asyncio.get_event_loop().create_task(corrutina)
+    tareas_fondo.add(tarea)
+    tarea.add_done_callback(tareas_fondo.discard)
+
+async def atender_interno(tema_str, carga_util):
+    try:
+        if tema_str == TEMA_DIFUSION:
+            difusor.recibir(carga_util)
+        elif tema_str == TEMA_CONTROL:
+            await aplicar_control(json.loads(carga_util))
+        elif tema_str.startswith(f"{TEMA_PRESENCIA}/"):
+            difusor.registrar_presencia(tema_str.rsplit("/", 1)[1], carga_util)
+    except Exception as e:
+        logger.error(f"Mensaje interno inválido en {tema_str}: {e}")
+
+async def anunciar_presencia():
+    # Se publica el estado actual, no el del cambio que lo disparó: si varios anuncios se cruzan gana el último
+    if cliente is None:
+        return
+    try:
+        await cliente.publish(
+            f"{TEMA_PRESENCIA}/{difusor.proceso}", b"1" if difusor.suscripciones else b"", qos=1, retain=True
+        )
+    except Exception as e:
+        logger.error(f"Error al anunciar la presencia de clientes en vivo: {e}")
+
+async def publicar_control(datos):
+    # Avisa a los demás procesos de un cambio hecho en este: configuración, caches o marca del archivo
+    if distribucion.distribuida and cliente is not None:
+        await cliente.publish(TEMA_CONTROL, json.dumps(datos))
+
+async def aplicar_control(datos):
+    if "invalidar" in datos:
+        cache_respuestas.invalidar(*datos["invalidar"], difundir=False)
+    if "usuario" in datos:
+        users.cache_usuarios.invalidar(uuid.UUID(datos["usuario"]), difundir=False)
+    if "marca" in datos:
+        archivo.actualizar_marca(datetime.fromisoformat(datos["marca"]))
+    if not distribucion.ingiere:
+        return
+    async with obtener_db() as sesion_db:
+        if "tipo_sensor_id" in datos:
+            tipo_sensor = await sesion_db.get(models.TipoSensor, datos["tipo_sensor_id"])
+            if tipo_sensor:
+                motor_anomalias.configurar_tipo(tipo_sensor)
+        if "sensor_id" in datos:
+            sensor = await sesion_db.get(models.Sensor, datos["sensor_id"])
+            if sensor:
+                motor_anomalias.configurar_sensor(sensor)
+
+async def procesar_mensaje(indice_trabajador, tema_str, carga_util):
+    if tema_str.startswith("lotes/"):
+        await procesar_lote(indice_trabajador, tema_str, carga_util)
+        return
+
+    maquina, tipo_sensor_nombre, nombre_sensor = analizar_tema(tema_str)
+
+    MENSAJES.labels("texto").inc()
+    try:
+        datos_sensor = carga_util.decode()
+        if lotes_ingesta:
+            with ETAPA_DECODIFICACION.time():
+                lectura = decodificar_lectura(maquina, tipo_sensor_nombre, nombre_sensor, datos_sensor)
+            await lotes_ingesta[indice_trabajador].agregar(lectura)
+        else:
             async with obtener_db() as sesion_db:
                 await procesar_datos_sensor(sesion_db, maquina, tipo_sensor_nombre, nombre_sensor, datos_sensor)
-        except (json.JSONDecodeError, KeyError) as e:
-            logger.error(f"Datos de carga útil inválidos: {e}")
-        except Exception as e:
-            logger.error(f"Error al procesar datos del sensor: {e}")
+    except (json.JSONDecodeError, KeyError, UnicodeDecodeError) as e:
+        logger.error(f"Datos de carga útil inválidos: {e}")
+
+async def procesar_lote(indice_trabajador, tema_str, carga_util):
+    _, maquina, formato = tema_str.split('/')
+    MENSAJES.labels(formato).inc()
+    try:
+        with ETAPA_DECODIFICACION.time():
+            lecturas = decodificar_lote(maquina, formato, carga_util)
+    except ValueError as e:
+        logger.error(f"Lote inválido en {tema_str}: {e}")
+        return
+    if not lecturas:
+        return
+    # Las lecturas decodificadas van directo al lote del trabajador (o a una única inserción multi-fila)
+    if lotes_ingesta:
+        await lotes_ingesta[indice_trabajador].agregar_varias(lecturas)
+    else:
+        async with obtener_db() as sesion_db:
+            await registrar_lecturas(sesion_db, lecturas)
 
 def validar_tema(tema):
     partes = tema.split('/')
+    if partes[0] == "lotes" and len(partes) == 3:
+        if partes[2] not in FORMATOS_LOTE:
+            logger.error(f"Formato de lote desconocido: {tema}")
+            return False
+        return True
     if len(partes) != 4:
         logger.error(f"Formato de tema inválido: {tema}")
         return False
@@ -102,133 +324,116 @@ def analizar_tema(tema):
     return maquina, tipo_sensor_nombre, nombre_sensor
 
 async def procesar_datos_sensor(sesion_db, maquina, tipo_sensor_nombre, nombre_sensor, datos_sensor):
-    maquina_obj = await obtener_o_crear(sesion_db, models.Maquina, nombre=maquina)
-    tipo_sensor = await obtener_o_crear(sesion_db, models.TipoSensor, tipo=tipo_sensor_nombre)
-
-    nuevos_datos_sensor = models.Sensor(
-        maquina_id=maquina_obj.id,
-        tipo_sensor_id=tipo_sensor.id,
-        nombre=nombre_sensor,
-        estado=convertir_a_booleano(datos_sensor),
-        valor=convertir_a_float(datos_sensor),
-        fecha_hora=datetime.now(timezone.utc)
+    with ETAPA_DECODIFICACION.time():
+        lectura = decodificar_lectura(maquina, tipo_sensor_nombre, nombre_sensor, datos_sensor)
+    await registrar_lecturas(sesion_db, [lectura])
+
+def decodificar_lectura(maquina, tipo_sensor_nombre, nombre_sensor, datos_sensor):
+    return {
+        "maquina": maquina,
+        "tipo": tipo_sensor_nombre,
+        "nombre": nombre_sensor,
+        "estado": convertir_a_booleano(datos_sensor),
+        "valor": convertir_a_float(datos_sensor),
+        "fecha_hora": datetime.now(timezone.utc),
+    }
+
+async def volcar_lote(lecturas):
+    async with obtener_db() as sesion_db:
+        await registrar_lecturas(sesion_db, lecturas)
+
+async def registrar_lecturas(sesion_db, lecturas):
+    filas = []
+    tipos = []
+    origenes = []
+    for lectura in lecturas:
+        maquina_id = await cache_dimensiones.id_maquina(lectura["maquina"])
+        tipo_sensor_id = await cache_dimensiones.id_tipo_sensor(lectura["tipo"])
+        filas.append({
+            "sensor_id": await cache_dimensiones.id_sensor(maquina_id, tipo_sensor_id, lectura["nombre"]),
+            "fecha_hora": lectura["fecha_hora"],
+            "valor": lectura["valor"],
+            "estado": lectura["estado"],
+        })
+        tipos.append(tipo_sensor_id)
+        origenes.append((maquina_id, lectura["nombre"], lectura["tipo"]))
+
+    # Inserción multi-fila en una única transacción
+    inicio = time.perf_counter()
+    resultado = await sesion_db.execute(
+        insert(models.Lectura).returning(models.Lectura.id, sort_by_parameter_order=True),
+        filas
     )
-    sesion_db.add(nuevos_datos_sensor)
+    ids = resultado.scalars().all()
+    await actualizar_ultimas_lecturas(sesion_db, ids, filas)
+    await actualizar_agregados(sesion_db, filas)
     await sesion_db.commit()
-    
-    # Analizar anomalías
-    await analizar_anomalias(sesion_db, nuevos_datos_sensor)
+    ETAPA_ESCRITURA.observe(time.perf_counter() - inicio)
+    LECTURAS.inc(len(filas))
 
-    logger.info(f"Nuevos datos de sensor registrados para '{nombre_sensor}' en la máquina '{maquina}' con tipo '{tipo_sensor_nombre}'.")
+    if difusor.hay_clientes():
+        for id_lectura, fila, origen in zip(ids, filas, origenes):
+            difusor.publicar_lectura(id_lectura, *origen, fila)
 
-def convertir_a_booleano(datos_sensor):
-    if isinstance(datos_sensor, str):
-        return datos_sensor.lower() in ['true', '1', 't', 'y', 'yes']
-    return bool(datos_sensor)
+    # Analizar anomalías; las lecturas ya están confirmadas, un error aquí no debe reencolar el lote
+    inicio = time.perf_counter()
+    for id_lectura, fila, tipo_sensor_id, origen in zip(ids, filas, tipos, origenes):
+        try:
+            await analizar_anomalias(sesion_db, models.Lectura(id=id_lectura, **fila), tipo_sensor_id, origen)
+        except Exception as e:
+            await sesion_db.rollback()
+            logger.error(f"Error al analizar anomalías de la lectura {id_lectura}: {e}")
+    ETAPA_ANOMALIAS.observe(time.perf_counter() - inicio)
 
-def convertir_a_float(datos_sensor):
-    if isinstance(datos_sensor, str) and datos_sensor.lower() in ['true', 'false']:
-        return 1.0 if datos_sensor.lower() == 'true' else 0.0
-    try:
-        return float(datos_sensor)
-    except ValueError:
-        logger.error(f"No se pudo convertir datos a float: '{datos_sensor}'")
-        return 0.0
-
-async def obtener_o_crear(sesion_db, modelo, **kwargs):
-    instancia = await sesion_db.execute(select(modelo).filter_by(**kwargs))
-    instancia = instancia.scalars().first()
-    if not instancia:
-        instancia = modelo(**kwargs)
-        sesion_db.add(instancia)
-        await sesion_db.flush()
-        await sesion_db.refresh(instancia)
-    return instancia
-
-async def analizar_anomalias(sesion_db, nuevo_dato):
-    # Obtener datos históricos del mismo sensor
-    datos_historicos = await sesion_db.execute(
-        select(models.Sensor.valor)
-        .filter(
-            models.Sensor.maquina_id == nuevo_dato.maquina_id,
-            models.Sensor.tipo_sensor_id == nuevo_dato.tipo_sensor_id,
-            models.Sensor.nombre == nuevo_dato.nombre
-        )
-        .order_by(models.Sensor.fecha_hora.desc())
-        .limit(100)
-    )
-    valores_historicos = [row[0] for row in datos_historicos.fetchall()]
+    resumen_lecturas.sumar(len(filas))
 
-    if len(valores_historicos) < 2:
-        return  # No hay suficientes datos para análisis
+async def actualizar_ultimas_lecturas(sesion_db, ids, filas):
+    # Una fila por sensor: la lectura más reciente del lote
+    ultimas = {}
+    for id_lectura, fila in zip(ids, filas):
+        actual = ultimas.get(fila["sensor_id"])
+        if actual is None or fila["fecha_hora"] >= actual["fecha_hora"]:
+            ultimas[fila["sensor_id"]] = {**fila, "lectura_id": id_lectura}
 
-    # Calcular Z-score
-    media = np.mean(valores_historicos)
-    desviacion_estandar = np.std(valores_historicos, ddof=1)  # ddof=1 para muestra
-    
-    if desviacion_estandar == 0:
-        return  # Evitar división por cero
-    
-    z_score = (nuevo_dato.valor - media) / desviacion_estandar
+    consulta = pg_insert(models.UltimaLectura).values(list(ultimas.values()))
+    consulta = consulta.on_conflict_do_update(
+        index_elements=[models.UltimaLectura.sensor_id],
+        set_={
+            "lectura_id": consulta.excluded.lectura_id,
+            "fecha_hora": consulta.excluded.fecha_hora,
+            "valor": consulta.excluded.valor,
+            "estado": consulta.excluded.estado,
+        },
+        where=consulta.excluded.fecha_hora >= models.UltimaLectura.fecha_hora
+    )
+    await sesion_db.execute(consulta)
 
-    # Definir umbral para eventos críticos
-    umbral_z_score = 3
+async def analizar_anomalias(sesion_db, nueva_lectura, tipo_sensor_id, origen=None):
+    # Detector incremental en memoria del sensor (Z-score por defecto)
+    anomalia = await motor_anomalias.evaluar(sesion_db, nueva_lectura, tipo_sensor_id)
 
-    if abs(z_score) > umbral_z_score:
-        descripcion = f"Valor anómalo detectado: {nuevo_dato.valor} (Z-score: {z_score:.2f})"
+    if anomalia is not None:
+        detector, puntaje = anomalia
+        descripcion = f"Valor anómalo detectado: {nueva_lectura.valor} ({detector.etiqueta}: {puntaje:.2f})"
         evento_critico = models.EventosCriticos(
-            sensor_id=nuevo_dato.id,
-            value=nuevo_dato.valor,
+            sensor_id=nueva_lectura.sensor_id,
+            lectura_id=nueva_lectura.id,
+            value=nueva_lectura.valor,
             description=descripcion
         )
         sesion_db.add(evento_critico)
+        await sesion_db.flush()
+        # El evento y sus notificaciones pendientes se confirman juntos; el correo lo envía el despachador
+        await registrar_notificaciones(sesion_db, evento_critico.id)
         await sesion_db.commit()
+        if origen:
+            # El resumen de la máquina lista los eventos recientes
+            cache_respuestas.invalidar(f"maquina:{origen[0]}")
+        if origen and difusor.hay_clientes():
+            difusor.publicar_evento(evento_critico, *origen)
+        if despachador_notificaciones:
+            despachador_notificaciones.avisar()
 
-        # Generar notificación
-        await generar_notificacion(sesion_db, evento_critico)
-async def generar_notificacion(sesion_db, evento_critico,usuario: models.User = Depends(current_active_user)):
-    notificacion = models.Notificaciones(
-        event_id=evento_critico.id,
-        sent_to=usuario.email,
-        status="pendiente"
-    )
-    sesion_db.add(notificacion)
-    await sesion_db.commit()
-
-    if USE_EMAILING:
-        await enviar_correo_notificacion(evento_critico, notificacion)
-
-async def enviar_correo_notificacion(evento_critico, notificacion):
-    contenido_pdf = generar_pdf_evento(evento_critico)
-    
-    mensaje = MessageSchema(
-        subject="Notificación de Evento Crítico",
-        recipients=[notificacion.sent_to],
-        body="Se ha detectado un evento crítico. Por favor, revise el archivo adjunto para más detalles.",
-        attachments=[{
-            "file": contenido_pdf,
-            "filename": "evento_critico.pdf",
-            "mime_type": "application/pdf",
-        }]
-    )
-
-    await fastmail.send_message(mensaje)
-    
-    # Actualizar estado de notificación
-    async with obtener_db() as sesion:
-        notificacion.status = "enviado"
-        await sesion.commit()
-
-def generar_pdf_evento(evento_critico):
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    pdf.cell(200, 10, txt=f"Evento Crítico ID: {evento_critico.id}", ln=1, align="C")
-    pdf.cell(200, 10, txt=f"Fecha y Hora: {evento_critico.timestamp}", ln=1)
-    pdf.cell(200, 10, txt=f"Sensor ID: {evento_critico.sensor_id}", ln=1)
-    pdf.cell(200, 10, txt=f"Valor: {evento_critico.value}", ln=1)
-    pdf.cell(200, 10, txt=f"Descripción: {evento_critico.description}", ln=1)
-    return pdf.output(dest="S").encode("latin1")
 verify_router = APIRouter()
 # Rutas de autenticación y usuarios
 app.include_router(
@@ -265,113 +470,296 @@ app.include_router(
     prefix="/users",
     tags=["users"],
 )
+@app.get("/ingesta/metricas")
+async def metricas_ingesta(usuario: models.User = Depends(current_active_user)):
+    return {
+        "modo": "lotes" if lotes_ingesta else "directo",
+        "cola": cola_ingesta.estado() if cola_ingesta else None,
+        "lotes": [lote.estado() for lote in lotes_ingesta],
+        "difusion": difusor.estado(),
+        "distribucion": distribucion.estado(),
+        "respuestas": cache_respuestas.estado(),
+        "usuarios": users.cache_usuarios.estado(),
+        "retencion": retencion.estado(),
+        "archivo": await asyncio.to_thread(archivo.estado),
+        "notificaciones": despachador_notificaciones.estado() if despachador_notificaciones else None,
+        "pdf": generador_pdf.estado(),
+    }
+
+@app.get("/metrics", include_in_schema=False)
+async def metricas_prometheus(request: Request):
+    if METRICAS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICAS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Token de métricas inválido")
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/en-vivo/lecturas")
+async def transmitir_lecturas(
+    request: Request,
+    maquina_id: int = Query(None, description="sin maquina_id se reciben todas las máquinas"),
+    nombre_sensor: str = Query(None),
+    usuario: models.User = Depends(current_active_user)
+):
+    # Server-Sent Events: un mensaje 'data' por lectura o evento crítico
+    async def eventos():
+        suscripcion = difusor.suscribir(maquina_id, nombre_sensor)
+        try:
+            while not await request.is_disconnected():
+                mensajes = await suscripcion.recibir()
+                if not mensajes:
+                    yield ": latido\n\n"
+                    continue
+                yield "".join(f"data: {mensaje}\n\n" for mensaje in mensajes)
+        finally:
+            difusor.desuscribir(suscripcion)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/en-vivo/ws")
+async def transmitir_lecturas_ws(
+    websocket: WebSocket,
+    maquina_id: int = Query(None),
+    nombre_sensor: str = Query(None),
+    token: str = Query(None, description="JWT de /auth/jwt/login; alternativa a la cabecera Authorization")
+):
+    token = token or websocket.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    if await users.usuario_activo_desde_token(token) is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    suscripcion = difusor.suscribir(maquina_id, nombre_sensor)
+
+    async def enviar():
+        try:
+            while True:
+                # Cada envío es una lista JSON con todo lo pendiente; una lista vacía es un latido
+                mensajes = await suscripcion.recibir()
+                await websocket.send_text(f"[{','.join(mensajes)}]")
+        except WebSocketDisconnect:
+            pass
+
+    async def recibir():
+        # Lo que envíe el cliente se descarta; solo interesa detectar el cierre
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    # La conexión termina cuando el cliente se desconecta o cuando falla un envío
+    tareas = [asyncio.create_task(enviar()), asyncio.create_task(recibir())]
+    try:
+        await asyncio.wait(tareas, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        difusor.desuscribir(suscripcion)
+        for tarea in tareas:
+            tarea.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+
 @app.get("/tipo-sensor/", response_model=schemas.TipoSensorList)
-async def listar_tipos_sensor(db: AsyncSession = Depends(models.get_async_no_context_session),usuario: models.User = Depends(current_active_user)):
-    resultado = await db.execute(select(models.TipoSensor))
-    tipos_sensor = resultado.scalars().all()
-    return schemas.TipoSensorList(tipos=tipos_sensor)
+async def listar_tipos_sensor(request: Request, usuario: models.User = Depends(current_active_user)):
+    async def calcular(db):
+        resultado = await db.execute(select(models.TipoSensor))
+        tipos_sensor = resultado.scalars().all()
+        return schemas.TipoSensorList(tipos=tipos_sensor)
+
+    return await cache_respuestas.responder(request, ("tipos",), ("tipos",), RESPUESTAS_TTL_S, calcular)
 
 @app.post("/tipo-sensor/", response_model=schemas.TipoSensorCreate)
 async def crear_tipo_sensor(datos_sensor: schemas.TipoSensorCreate, db: AsyncSession = Depends(models.get_async_no_context_session),usuario: models.User = Depends(current_active_user)):
-    tipo_sensor_existente = await db.execute(select(models.TipoSensor).filter(models.TipoSensor.nombre == datos_sensor.nombre))
+    tipo_sensor_existente = await db.execute(select(models.TipoSensor).filter(models.TipoSensor.tipo == datos_sensor.tipo))
     if tipo_sensor_existente.scalars().first():
         raise HTTPException(status_code=400, detail="Ya existe este tipo de sensor")
-    nuevo_tipo_sensor = models.TipoSensor(nombre=datos_sensor.nombre, unidad=datos_sensor.unidad)
+    validar_detector((datos_sensor.ventana_anomalias, datos_sensor.umbral_z, datos_sensor.detector, datos_sensor.parametros_detector))
+    nuevo_tipo_sensor = models.TipoSensor(**datos_sensor.model_dump())
     db.add(nuevo_tipo_sensor)
     await db.commit()
     await db.refresh(nuevo_tipo_sensor)
+    cache_dimensiones.tipos[nuevo_tipo_sensor.tipo] = nuevo_tipo_sensor.id
+    cache_respuestas.invalidar("tipos")
     return nuevo_tipo_sensor
 
-@app.get("/maquinas/lista", response_model=List[schemas.MaquinaListaRead])
-async def listar_maquinas_y_sensores(
+@app.put("/tipo-sensor/{tipo_sensor_id}/anomalias", response_model=schemas.TipoSensorRead)
+async def configurar_anomalias_tipo_sensor(
+    tipo_sensor_id: int,
+    configuracion: schemas.ConfiguracionAnomalias,
+    db: AsyncSession = Depends(models.get_async_no_context_session),
+    usuario: models.User = Depends(current_active_user)
+):
+    tipo_sensor = await db.get(models.TipoSensor, tipo_sensor_id)
+    if not tipo_sensor:
+        raise HTTPException(status_code=404, detail="Tipo de sensor no encontrado")
+    validar_detector((configuracion.ventana_anomalias, configuracion.umbral_z, configuracion.detector, configuracion.parametros_detector))
+    tipo_sensor.ventana_anomalias = configuracion.ventana_anomalias
+    tipo_sensor.umbral_z = configuracion.umbral_z
+    tipo_sensor.detector = configuracion.detector
+    tipo_sensor.parametros_detector = configuracion.parametros_detector
+    await db.commit()
+    await db.refresh(tipo_sensor)
+    motor_anomalias.configurar_tipo(tipo_sensor)
+    cache_respuestas.invalidar("tipos")
+    await publicar_control({"tipo_sensor_id": tipo_sensor.id})
+    return tipo_sensor
+
+@app.put("/tipo-sensor/{tipo_sensor_id}/retencion", response_model=schemas.TipoSensorRead)
+async def configurar_retencion_tipo_sensor(
+    tipo_sensor_id: int,
+    configuracion: schemas.ConfiguracionRetencion,
+    db: AsyncSession = Depends(models.get_async_no_context_session),
+    usuario: models.User = Depends(current_active_user)
+):
+    tipo_sensor = await db.get(models.TipoSensor, tipo_sensor_id)
+    if not tipo_sensor:
+        raise HTTPException(status_code=404, detail="Tipo de sensor no encontrado")
+    tipo_sensor.retencion_dias = configuracion.retencion_dias
+    tipo_sensor.retencion_minuto_dias = configuracion.retencion_minuto_dias
+    await db.commit()
+    await db.refresh(tipo_sensor)
+    cache_respuestas.invalidar("tipos")
+    return tipo_sensor
+
+@app.get("/retencion/")
+async def estado_retencion(db: AsyncSession = Depends(models.get_async_no_context_session), usuario: models.User = Depends(current_active_user)):
+    politicas = await retencion.politicas(db)
+    return {
+        "politicas": [
+            {"tipo_sensor_id": tipo_id, "tipo": tipo, "retencion_dias": dias, "retencion_minuto_dias": dias_minuto, "sensores": len(sensores)}
+            for tipo_id, tipo, dias, dias_minuto, sensores in politicas
+        ],
+        **retencion.estado(),
+    }
+
+@app.post("/retencion/ejecutar")
+async def ejecutar_retencion(simulacion: bool = Query(True), usuario: models.User = Depends(current_active_user)):
+    # Por defecto solo informa qué se eliminaría; simulacion=false borra
+    informe = await retencion.ejecutar(simulacion)
+    if informe.get("omitida"):
+        raise HTTPException(status_code=409, detail=informe["omitida"])
+    return informe
+
+@app.get("/archivo/")
+async def estado_archivo(usuario: models.User = Depends(current_active_user)):
+    return await asyncio.to_thread(archivo.estado)
+
+@app.post("/archivo/ejecutar")
+async def ejecutar_archivo(usuario: models.User = Depends(current_active_user)):
+    if not ARCHIVO_DIAS:
+        raise HTTPException(status_code=400, detail="El archivo de lecturas no está configurado (ARCHIVO_DIAS)")
+    informe = await archivo.ejecutar()
+    if informe.get("omitida"):
+        raise HTTPException(status_code=409, detail=informe["omitida"])
+    return informe
+
+@app.put("/sensores/{sensor_id}/anomalias", response_model=schemas.SensorRead)
+async def configurar_anomalias_sensor(
+    sensor_id: int,
+    configuracion: schemas.ConfiguracionDetectorSensor,
     db: AsyncSession = Depends(models.get_async_no_context_session),
     usuario: models.User = Depends(current_active_user)
 ):
+    sensor = await db.get(models.Sensor, sensor_id)
+    if not sensor:
+        raise HTTPException(status_code=404, detail="Sensor no encontrado")
+    if configuracion.detector:
+        validar_detector(None, (configuracion.detector, configuracion.parametros_detector))
+    sensor.detector = configuracion.detector
+    sensor.parametros_detector = configuracion.parametros_detector if configuracion.detector else None
+    await db.commit()
+    await db.refresh(sensor)
+    motor_anomalias.configurar_sensor(sensor)
+    await publicar_control({"sensor_id": sensor.id})
+    return sensor
+
+@app.get("/detectores/", response_model=List[schemas.DetectorRead])
+async def listar_detectores(usuario: models.User = Depends(current_active_user)):
+    return [
+        schemas.DetectorRead(nombre=nombre, etiqueta=clase.etiqueta, parametros=clase.parametros)
+        for nombre, clase in DETECTORES.items()
+    ]
+
+def validar_detector(config_tipo, config_sensor=None):
+    try:
+        return resolver_detector(config_tipo, config_sensor)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def buscar_sensores(db, maquina_id, nombre_sensor=None, tipo_sensor=None):
+    # Resuelve sobre el registro (pocas filas) los sensores a consultar en 'lecturas'
     consulta = (
-        select(models.Maquina)
-        .options(selectinload(models.Maquina.sensores).joinedload(models.Sensor.tipo_sensor))
+        select(models.Sensor)
+        .options(joinedload(models.Sensor.tipo_sensor))
+        .where(models.Sensor.maquina_id == maquina_id)
     )
-
+    if nombre_sensor:
+        consulta = consulta.filter(models.Sensor.nombre == nombre_sensor)
+    if tipo_sensor:
+        consulta = consulta.filter(models.Sensor.tipo_sensor.has(tipo=tipo_sensor))
     resultado = await db.execute(consulta)
-    maquinas = resultado.unique().scalars().all()
-
-    maquinas_lista = []
-    for maquina in maquinas:
-        sensores_unicos = {}
-        for sensor in maquina.sensores:
-            if sensor.nombre not in sensores_unicos:
-                sensores_unicos[sensor.nombre] = schemas.SensorListaRead(
-                    nombre=sensor.nombre,
-                    tipo=sensor.tipo_sensor.tipo
-                )
-        
-        maquinas_lista.append(
+    return resultado.unique().scalars().all()
+
+@app.get("/maquinas/lista", response_model=List[schemas.MaquinaListaRead])
+async def listar_maquinas_y_sensores(
+    request: Request,
+    usuario: models.User = Depends(current_active_user)
+):
+    async def calcular(db):
+        consulta = (
+            select(models.Maquina)
+            .options(selectinload(models.Maquina.sensores).joinedload(models.Sensor.tipo_sensor))
+        )
+
+        resultado = await db.execute(consulta)
+        maquinas = resultado.unique().scalars().all()
+
+        return [
             schemas.MaquinaListaRead(
                 id=maquina.id,
                 nombre=maquina.nombre,
-                sensores=list(sensores_unicos.values())
+                sensores=[
+                    schemas.SensorListaRead(nombre=sensor.nombre, tipo=sensor.tipo_sensor.tipo)
+                    for sensor in maquina.sensores
+                ]
             )
-        )
+            for maquina in maquinas
+        ]
 
-    return maquinas_lista
+    # Se invalida cuando la ingesta registra una máquina o un sensor nuevo
+    return await cache_respuestas.responder(request, ("maquinas",), ("maquinas",), RESPUESTAS_TTL_S, calcular)
 @app.get("/maquinas/{maquina_id}")
 async def leer_maquina(maquina_id: int, db: AsyncSession = Depends(models.get_async_no_context_session),usuario: models.User = Depends(current_active_user)):
     async with db as sesion:
-        subconsulta = (
-            select(
-                models.Sensor.tipo_sensor_id,
-                models.Sensor.nombre,
-                func.max(models.Sensor.fecha_hora).label("max_fecha_hora")
-            )
-            .where(models.Sensor.maquina_id == maquina_id)
-            .group_by(models.Sensor.tipo_sensor_id, models.Sensor.nombre)
-            .subquery()
-        )
-
-        consulta_ultimo_sensor = (
-            select(models.Sensor)
-            .join(
-                subconsulta,
-                (models.Sensor.tipo_sensor_id == subconsulta.c.tipo_sensor_id) &
-                (models.Sensor.nombre == subconsulta.c.nombre) &
-                (models.Sensor.fecha_hora == subconsulta.c.max_fecha_hora)
-            )
-            .order_by(desc(models.Sensor.fecha_hora))
-            .options(joinedload(models.Sensor.tipo_sensor))
-        )
-
-        resultado_maquina = await sesion.execute(
-            select(models.Maquina)
-            .where(models.Maquina.id == maquina_id)
-            .options(selectinload(models.Maquina.sensores).joinedload(models.Sensor.tipo_sensor))
-        )
-        maquina = resultado_maquina.scalars().first()
+        maquina = await sesion.get(models.Maquina, maquina_id)
         if not maquina:
             raise HTTPException(status_code=404, detail="Máquina no encontrada")
 
-        datos_ultimo_sensor = await sesion.execute(consulta_ultimo_sensor)
-        ultimos_sensores = datos_ultimo_sensor.scalars().all()
+        # Último valor por sensor desde la tabla mantenida por la ingesta
+        datos_ultima_lectura = await sesion.execute(
+            select(models.UltimaLectura)
+            .join(models.Sensor)
+            .where(models.Sensor.maquina_id == maquina_id)
+            .order_by(desc(models.UltimaLectura.fecha_hora))
+            .options(joinedload(models.UltimaLectura.sensor).joinedload(models.Sensor.tipo_sensor))
+        )
+        ultimas_lecturas = datos_ultima_lectura.unique().scalars().all()
 
         datos_maquina = {
             "id": maquina.id,
             "nombre": maquina.nombre,
             "sensores": [
                 {
-                    "id": sensor.id,
-                    "nombre": sensor.nombre,
-                    "tipo": sensor.tipo_sensor.tipo,
-                    "unidad": sensor.tipo_sensor.unidad,
-                    "estado": sensor.estado,
-                    "valor": sensor.valor,
-                    "fecha_hora": sensor.fecha_hora.isoformat()
-                } for sensor in ultimos_sensores
+                    "id": lectura.sensor_id,
+                    "nombre": lectura.sensor.nombre,
+                    "tipo": lectura.sensor.tipo_sensor.tipo,
+                    "unidad": lectura.sensor.tipo_sensor.unidad,
+                    "estado": lectura.estado,
+                    "valor": lectura.valor,
+                    "fecha_hora": lectura.fecha_hora.isoformat()
+                } for lectura in ultimas_lecturas
             ]
         }
 
         return datos_maquina
 
-from sqlalchemy.orm import selectinload
-
 @app.get("/maquinas/{maquina_id}/sensores/historial")
 async def obtener_historial_sensores(
     maquina_id: int,
@@ -379,50 +767,292 @@ async def obtener_historial_sensores(
     tipo_sensor: str = Query(None),
     fecha_inicio: datetime = Query(None),
     fecha_fin: datetime = Query(None),
+    resolucion: str = Query("auto", pattern=PATRON_RESOLUCION, description="auto elige cruda, minuto, hora o dia según el rango"),
     page: int = Query(1, ge=1),
     page_size: int = Query(100, ge=1, le=1000),
+    cursor: str = Query(None, description="siguiente_cursor de la página anterior; reemplaza a page"),
+    conteo: str = Query(None, pattern="^(exacto|estimado|ninguno)$", description="por defecto exacto con page y ninguno con cursor"),
     db: AsyncSession = Depends(models.get_async_no_context_session),
     usuario: models.User = Depends(current_active_user)
 ):
     skip = (page - 1) * page_size
-    query = select(models.Sensor).options(selectinload(models.Sensor.tipo_sensor)).where(models.Sensor.maquina_id == maquina_id)
+    sensores = {sensor.id: sensor for sensor in await buscar_sensores(db, maquina_id, nombre_sensor, tipo_sensor)}
+    posicion = decodificar_cursor(cursor, resolucion) if cursor else None
+    resolucion = posicion[2] if posicion else elegir_resolucion(resolucion, fecha_inicio, fecha_fin)
 
-    if nombre_sensor:
-        query = query.filter(models.Sensor.nombre == nombre_sensor)
-    if tipo_sensor:
-        query = query.filter(models.Sensor.tipo_sensor.has(tipo=tipo_sensor))
-    if fecha_inicio:
-        query = query.filter(models.Sensor.fecha_hora >= fecha_inicio)
-    if fecha_fin:
-        query = query.filter(models.Sensor.fecha_hora <= fecha_fin)
+    # Lecturas crudas más antiguas que ARCHIVO_DIAS: antes de la marca se leen del archivo frío y desde ella de la base
+    marca = archivo.marca()
+    if resolucion == "cruda":
+        query = select(models.Lectura).where(models.Lectura.sensor_id.in_(list(sensores)))
+        if fecha_inicio:
+            query = query.filter(models.Lectura.fecha_hora >= fecha_inicio)
+        if fecha_fin:
+            query = query.filter(models.Lectura.fecha_hora <= fecha_fin)
+        if marca:
+            query = query.filter(models.Lectura.fecha_hora >= marca)
+        orden = (models.Lectura.fecha_hora, models.Lectura.id)
+    else:
+        query = consulta_agregados(list(sensores), resolucion, fecha_inicio, fecha_fin)
+        orden = (models.LecturaAgregada.inicio, models.LecturaAgregada.sensor_id)
+    query = query.order_by(orden[0].desc(), orden[1].desc())
+    en_archivo = resolucion == "cruda" and bool(await asyncio.to_thread(archivo.dias, maquina_id, marca, fecha_inicio, fecha_fin))
 
-    query = query.order_by(models.Sensor.fecha_hora.desc())
-    
-    # Execute the query to get the total count
-    count_query = select(func.count()).select_from(query.subquery())
-    total = await db.scalar(count_query)
+    conteo = conteo or ("ninguno" if posicion else "exacto")
+    if conteo == "exacto":
+        total = await db.scalar(select(func.count()).select_from(query.subquery()))
+    elif conteo == "estimado":
+        total = await estimar_filas(db, query)
+    else:
+        total = None
+    if total is not None and en_archivo:
+        total += await asyncio.to_thread(
+            archivo.contar, maquina_id, marca, list(sensores), fecha_inicio, fecha_fin, conteo == "estimado"
+        )
 
-    # Apply pagination
-    query = query.offset(skip).limit(page_size)
+    if posicion:
+        # Paginación por clave: busca directamente en el índice desde la última fila entregada
+        query = query.filter(tuple_(*orden) < (posicion[0], posicion[1]))
+    elif not en_archivo:
+        query = query.offset(skip)
+    necesarias = skip + page_size if en_archivo and not posicion else page_size
+    query = query.limit(necesarias)
 
     result = await db.execute(query)
-    sensors = result.unique().scalars().all()
+    filas = result.scalars().all()
+    if en_archivo:
+        # Si la base ya aportó todas las filas necesarias, los días archivados anteriores a la última no se abren
+        cota = filas[-1].fecha_hora if len(filas) == necesarias else None
+        archivadas = await asyncio.to_thread(
+            archivo.ultimas, maquina_id, marca, list(sensores), fecha_inicio, fecha_fin, posicion and posicion[:2],
+            necesarias, cota
+        )
+        # La marca separa la base del archivo: ninguna lectura aparece en los dos lados
+        filas = list(heapq.merge(
+            filas, archivadas, key=lambda fila: (fila.fecha_hora, fila.id), reverse=True
+        ))[necesarias - page_size:necesarias]
+
+    siguiente_cursor = None
+    if len(filas) == page_size:
+        ultima = filas[-1]
+        if resolucion == "cruda":
+            siguiente_cursor = codificar_cursor(ultima.fecha_hora, ultima.id, resolucion)
+        else:
+            siguiente_cursor = codificar_cursor(ultima.inicio, ultima.sensor_id, resolucion)
 
     return {
         "data": [
+            formatear_lectura(fila, sensores[fila.sensor_id]) if resolucion == "cruda"
+            else formatear_agregado(fila, sensores[fila.sensor_id])
+            for fila in filas
+        ],
+        "resolucion": resolucion,
+        "page": None if posicion else page,
+        "page_size": page_size,
+        "total": total,
+        "conteo": conteo,
+        "siguiente_cursor": siguiente_cursor
+    }
+
+@app.get("/maquinas/{maquina_id}/sensores/exportar")
+async def exportar_historial_sensores(
+    maquina_id: int,
+    formato: str = Query("csv", pattern="^(csv|ndjson|parquet|arrow)$"),
+    nombre_sensor: str = Query(None),
+    tipo_sensor: str = Query(None),
+    fecha_inicio: datetime = Query(None),
+    fecha_fin: datetime = Query(None),
+    db: AsyncSession = Depends(models.get_async_no_context_session),
+    usuario: models.User = Depends(current_active_user)
+):
+    sensores = {
+        sensor.id: (sensor.nombre, sensor.tipo_sensor.tipo if sensor.tipo_sensor else None)
+        for sensor in await buscar_sensores(db, maquina_id, nombre_sensor, tipo_sensor)
+    }
+    # Lecturas crudas en orden cronológico, enviadas a medida que se leen del cursor; primero las del archivo
+    # frío (antes de la marca) y después las de la base
+    marca = archivo.marca()
+    consulta = consulta_exportacion(list(sensores), fecha_inicio, fecha_fin)
+    if marca:
+        consulta = consulta.filter(models.Lectura.fecha_hora >= marca)
+    anteriores = archivo.bloques(maquina_id, marca, list(sensores), fecha_inicio, fecha_fin, sensores)
+    contenido = exportar(formato, consulta, sensores, anteriores)
+    return StreamingResponse(
+        contenido,
+        media_type=FORMATOS_EXPORTACION[formato],
+        headers={"Content-Disposition": f'attachment; filename="maquina_{maquina_id}_lecturas.{formato}"'}
+    )
+
+@app.get("/maquinas/sensores/agregados")
+async def agregar_sensores_por_intervalo(
+    maquina_id: List[int] = Query(..., description="Una o varias máquinas"),
+    sensores: List[str] = Query(None, description="Nombres de sensores; por defecto todos los de las máquinas"),
+    tipo_sensor: str = Query(None),
+    fecha_inicio: datetime = Query(...),
+    fecha_fin: datetime = Query(None, description="Excluida; por defecto ahora"),
+    intervalo_s: int = Query(..., ge=1, description="Ancho de cada intervalo en segundos"),
+    db: AsyncSession = Depends(models.get_async_no_context_session),
+    usuario: models.User = Depends(current_active_user)
+):
+    fecha_inicio = a_utc(fecha_inicio)
+    fecha_fin = a_utc(fecha_fin or datetime.now(timezone.utc))
+    if fecha_fin <= fecha_inicio:
+        raise HTTPException(status_code=400, detail="fecha_fin debe ser posterior a fecha_inicio")
+    ancho = timedelta(seconds=intervalo_s)
+    fuente = fuente_intervalos(ancho)
+    # Con agregados como fuente los intervalos empiezan en un borde de sus ventanas (minuto, hora o día UTC)
+    origen = fecha_inicio if fuente == "cruda" else truncar(fecha_inicio, fuente)
+    cantidad = math.ceil((fecha_fin - origen) / ancho)
+    if cantidad > AGREGADOS_MAX_PUNTOS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"El rango abarca {cantidad} intervalos por sensor; el máximo es {AGREGADOS_MAX_PUNTOS}"
+        )
+
+    registro = {}
+    for id_maquina in dict.fromkeys(maquina_id):
+        for sensor in await buscar_sensores(db, id_maquina, tipo_sensor=tipo_sensor):
+            if not sensores or sensor.nombre in sensores:
+                registro[sensor.id] = sensor
+    if not registro:
+        raise HTTPException(status_code=404, detail="No se encontraron sensores")
+
+    consulta = consulta_intervalos(list(registro), fuente, origen, ancho, fecha_fin)
+    marca = archivo.marca() if fuente == "cruda" else None
+    if marca:
+        # Las lecturas anteriores a la marca se agregan desde el archivo frío
+        consulta = consulta.where(models.Lectura.fecha_hora >= marca)
+    resultado = await db.execute(consulta)
+    filas = resultado.all()
+    if fuente == "cruda":
+        for id_maquina in dict.fromkeys(maquina_id):
+            filas += await asyncio.to_thread(
+                archivo.intervalos, id_maquina, marca,
+                [sensor.id for sensor in registro.values() if sensor.maquina_id == id_maquina], origen, fecha_fin, ancho
+            )
+    intervalos = combinar_intervalos(filas)
+
+    series = {sensor_id: [] for sensor_id in registro}
+    for (sensor_id, indice), (cuenta, suma, minimo, maximo, _, ultimo) in sorted(intervalos.items()):
+        series[sensor_id].append({
+            "inicio": (origen + indice * ancho).isoformat(),
+            "cantidad": cuenta,
+            "minimo": minimo,
+            "maximo": maximo,
+            "promedio": suma / cuenta,
+            "ultimo": ultimo,
+        })
+    return {
+        "fuente": fuente,
+        "intervalo_s": intervalo_s,
+        "desde": origen.isoformat(),
+        "hasta": fecha_fin.isoformat(),
+        "series": [
             {
-                "id": sensor.id,
+                "maquina_id": sensor.maquina_id,
+                "sensor_id": sensor.id,
                 "nombre": sensor.nombre,
                 "tipo": sensor.tipo_sensor.tipo if sensor.tipo_sensor else None,
-                "valor": sensor.valor,
-                "fecha_hora": sensor.fecha_hora.isoformat()
+                "intervalos": series[sensor.id],
             }
-            for sensor in sensors
-        ],
-        "page": page,
-        "page_size": page_size,
-        "total": total
+            for sensor in sorted(registro.values(), key=lambda sensor: (sensor.maquina_id, sensor.nombre, sensor.id))
+        ]
+    }
+
+def codificar_cursor(fecha_hora, id_fila, resolucion):
+    datos = json.dumps({"f": fecha_hora.isoformat(), "i": id_fila, "r": resolucion})
+    return base64.urlsafe_b64encode(datos.encode()).decode().rstrip("=")
+
+def decodificar_cursor(cursor, resolucion="auto"):
+    try:
+        datos = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        posicion = datetime.fromisoformat(datos["f"]), int(datos["i"]), datos["r"]
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if posicion[2] not in ("cruda", *RESOLUCIONES):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    # El cursor fija la resolución de la paginación; una resolución explícita distinta no puede continuarla
+    if resolucion != "auto" and resolucion != posicion[2]:
+        raise HTTPException(status_code=400, detail=f"El cursor corresponde a la resolución {posicion[2]}, no a {resolucion}")
+    return posicion
+
+async def estimar_filas(db, consulta):
+    # Estimación del planificador en lugar de un count(*) sobre todo el historial filtrado
+    conexion = await db.connection()
+    sql = consulta.compile(dialect=conexion.dialect, compile_kwargs={"literal_binds": True})
+    resultado = await conexion.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}")
+    plan = resultado.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+def formatear_lectura(lectura, sensor):
+    return {
+        "id": lectura.id,
+        "nombre": sensor.nombre,
+        "tipo": sensor.tipo_sensor.tipo if sensor.tipo_sensor else None,
+        "valor": lectura.valor,
+        "fecha_hora": lectura.fecha_hora.isoformat()
+    }
+
+def formatear_agregado(agregado, sensor):
+    return {
+        "nombre": sensor.nombre,
+        "tipo": sensor.tipo_sensor.tipo if sensor.tipo_sensor else None,
+        "valor": agregado.suma / agregado.cantidad,
+        "fecha_hora": agregado.inicio.isoformat(),
+        "cantidad": agregado.cantidad,
+        "minimo": agregado.minimo,
+        "maximo": agregado.maximo,
+        "desviacion_estandar": desviacion_estandar(agregado),
+        "primero": agregado.primero,
+        "ultimo": agregado.ultimo
     }
+@app.get("/analisis-anomalias/{maquina_id}/{sensor_nombre}")
+async def analizar_anomalias_historial(
+    maquina_id: int,
+    sensor_nombre: str,
+    dias: int = Query(7, description="Número de días para el análisis"),
+    detector: str = Query(None, description="Por defecto el configurado para cada sensor"),
+    limite: int = Query(100, ge=1, le=10000, description="Máximo de anomalías devueltas por sensor (las más recientes)"),
+    db: AsyncSession = Depends(models.get_async_no_context_session),
+    usuario: models.User = Depends(current_active_user)
+):
+    fecha_limite = datetime.now(timezone.utc) - timedelta(days=dias)
+    sensores = await buscar_sensores(db, maquina_id, sensor_nombre)
+    series = await leer_series(db, [sensor.id for sensor in sensores], "cruda", fecha_limite, maquina_id)
+
+    if not series:
+        raise HTTPException(status_code=404, detail="No se encontraron datos para el análisis")
+
+    resultados = []
+    for sensor in sensores:
+        if sensor.id not in series:
+            continue
+        try:
+            detector_sensor = await motor_anomalias.crear_detector(db, sensor.tipo_sensor_id, sensor.id, detector)
+        except (ValueError, TypeError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        # Puntaje vectorizado de todo el rango, equivalente a procesar las lecturas una por una
+        instantes, valores = series[sensor.id]
+        puntajes = detector_sensor.puntuar_lote(valores, instantes)
+        anomalas = np.flatnonzero(detector_sensor.anomalos_lote(puntajes))
+        recientes = anomalas[-limite:]
+        resultados.append({
+            "sensor_id": sensor.id,
+            "tipo": sensor.tipo_sensor.tipo if sensor.tipo_sensor else None,
+            "detector": detector_sensor.nombre,
+            "lecturas": len(valores),
+            "anomalias": len(anomalas),
+            "eventos": [
+                {"fecha": fecha, "valor": valor, "puntaje": puntaje}
+                for fecha, valor, puntaje in zip(
+                    instantes_iso(instantes[recientes]), valores[recientes].tolist(), puntajes[recientes].tolist()
+                )
+            ]
+        })
+
+    return {"sensor": sensor_nombre, "sensores": resultados}
+
 @app.get("/eventos-criticos/", response_model=List[schemas.EventoCriticoRead])
 async def listar_eventos_criticos(
     db: AsyncSession = Depends(models.get_async_no_context_session),
@@ -438,6 +1068,39 @@ async def listar_eventos_criticos(
     eventos = resultado.scalars().all()
     return eventos
 
+@app.get("/eventos-criticos/{evento_id}/pdf")
+async def descargar_pdf_evento(
+    evento_id: int,
+    db: AsyncSession = Depends(models.get_async_no_context_session),
+    usuario: models.User = Depends(current_active_user)
+):
+    evento_critico = await db.get(models.EventosCriticos, evento_id)
+    if not evento_critico:
+        raise HTTPException(status_code=404, detail="Evento crítico no encontrado")
+    contenido = await generador_pdf.pdf_evento(evento_critico)
+    return Response(
+        contenido, media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="evento_critico_{evento_id}.pdf"'}
+    )
+
+@app.get("/reportes/eventos-criticos/{anio}/{mes}")
+async def informe_mensual_eventos(
+    anio: int,
+    mes: int,
+    maquina_id: int = Query(None, description="Solo los eventos de esta máquina"),
+    db: AsyncSession = Depends(models.get_async_no_context_session),
+    usuario: models.User = Depends(current_active_user)
+):
+    # Todas las anomalías del mes en un PDF: resumen por sensor y detalle de cada evento
+    if not 1 <= mes <= 12 or not 2000 <= anio <= 9999:
+        raise HTTPException(status_code=400, detail="Mes o año inválido")
+    contenido = await generador_pdf.informe_mensual(db, anio, mes, maquina_id)
+    nombre = f"eventos_criticos_{anio}_{mes:02d}" + (f"_maquina_{maquina_id}" if maquina_id is not None else "")
+    return Response(
+        contenido, media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{nombre}.pdf"'}
+    )
+
 @app.get("/notificaciones/", response_model=List[schemas.NotificacionRead])
 async def listar_notificaciones(
     db: AsyncSession = Depends(models.get_async_no_context_session),
@@ -456,7 +1119,6 @@ async def listar_notificaciones(
 @app.post("/reenviar-notificacion/{notificacion_id}")
 async def reenviar_notificacion(
     notificacion_id: int,
-    tareas_fondo: BackgroundTasks,
     db: AsyncSession = Depends(models.get_async_no_context_session)
     ,usuario: models.User = Depends(current_active_user)):
     notificacion = await db.get(models.Notificaciones, notificacion_id)
@@ -467,8 +1129,14 @@ async def reenviar_notificacion(
     if not evento_critico:
         raise HTTPException(status_code=404, detail="Evento crítico no encontrado")
 
-    # Reenviar notificación en segundo plano
-    tareas_fondo.add_task(enviar_correo_notificacion, evento_critico, notificacion)
+    # Vuelve al outbox como pendiente; la envía el despachador en el próximo ciclo
+    notificacion.status = "pendiente"
+    notificacion.intentos = 0
+    notificacion.proximo_intento = None
+    notificacion.ultimo_error = None
+    await db.commit()
+    if despachador_notificaciones:
+        despachador_notificaciones.avisar()
 
     return {"mensaje": "Notificación programada para reenvío"}
 
@@ -477,92 +1145,133 @@ async def analizar_tendencias(
     maquina_id: int,
     sensor_nombre: str,
     dias: int = Query(7, description="Número de días para el análisis"),
+    resolucion: str = Query("auto", pattern=PATRON_RESOLUCION, description="auto elige cruda, minuto, hora o dia según el rango"),
     db: AsyncSession = Depends(models.get_async_no_context_session)
 ,usuario: models.User = Depends(current_active_user)):
     fecha_limite = datetime.now(timezone.utc) - timedelta(days=dias)
-    
-    resultado = await db.execute(
-        select(models.Sensor)
-        .filter(
-            models.Sensor.maquina_id == maquina_id,
-            models.Sensor.nombre == sensor_nombre,
-            models.Sensor.fecha_hora >= fecha_limite
-        )
-        .order_by(models.Sensor.fecha_hora)
-    )
-    datos = resultado.scalars().all()
+    sensores = await buscar_sensores(db, maquina_id, sensor_nombre)
+    resolucion = elegir_resolucion(resolucion, fecha_limite)
+    series = await leer_series(db, [sensor.id for sensor in sensores], resolucion, fecha_limite, maquina_id)
 
-    if not datos:
+    if not series:
         raise HTTPException(status_code=404, detail="No se encontraron datos para el análisis")
 
-    valores = np.array([dato.valor for dato in datos])
-    fechas = [dato.fecha_hora for dato in datos]
+    # Los sensores con el mismo nombre (distinto tipo) se analizan como una sola serie
+    instantes = np.concatenate([instantes for instantes, _ in series.values()])
+    valores = np.concatenate([valores for _, valores in series.values()])
+    orden = np.argsort(instantes, kind="stable")
+    instantes, valores = instantes[orden], valores[orden]
 
-    # Calcular tendencia lineal
-    x = np.arange(len(valores))
-    pendiente, intercepto, r_valor, p_valor, error_estandar = stats.linregress(x, valores)
-
-    tendencia = "creciente" if pendiente > 0 else "decreciente" if pendiente < 0 else "estable"
+    # Calcular tendencia lineal contra el tiempo transcurrido real, no contra el número de muestra
+    tendencia = calcular_tendencias({sensor_nombre: (instantes, valores)}, fecha_limite.timestamp())[sensor_nombre]
 
     return {
         "sensor": sensor_nombre,
-        "tendencia": tendencia,
-        "pendiente": float(pendiente),
-        "r_cuadrado": float(r_valor**2),
-        "datos": [{"fecha": fecha.isoformat(), "valor": float(valor)} for fecha, valor in zip(fechas, valores)]
+        "tendencia": tendencia["tendencia"],
+        "resolucion": resolucion,
+        "pendiente": tendencia["pendiente"],
+        "pendiente_unidad": "por hora",
+        "r_cuadrado": tendencia["r_cuadrado"],
+        "datos": [{"fecha": fecha, "valor": valor} for fecha, valor in zip(instantes_iso(instantes), valores.tolist())]
     }
-from sqlalchemy.orm import joinedload
-from sqlalchemy.future import select
 
-@app.get("/resumen-maquina/{maquina_id}")
-async def obtener_resumen_maquina(
+@app.get("/analisis-tendencias/{maquina_id}")
+async def analizar_tendencias_maquina(
     maquina_id: int,
+    sensores: List[str] = Query(None, description="Nombres de sensores; por defecto todos los de la máquina"),
+    tipo_sensor: str = Query(None),
+    dias: int = Query(7, description="Número de días para el análisis"),
+    resolucion: str = Query("auto", pattern=PATRON_RESOLUCION, description="auto elige cruda, minuto, hora o dia según el rango"),
     db: AsyncSession = Depends(models.get_async_no_context_session),
     usuario: models.User = Depends(current_active_user)
 ):
-    
-    resultado_maquina = await db.execute(
-        select(models.Maquina).where(models.Maquina.id == maquina_id)
-    )
-    maquina = resultado_maquina.scalar_one_or_none()
-    if not maquina:
-        raise HTTPException(status_code=404, detail="Máquina no encontrada")
-
-    # Obtener los últimos 10 registros de sensores
-    resultado_sensores = await db.execute(
-        select(models.Sensor)
-        .options(joinedload(models.Sensor.tipo_sensor))
-        .filter(models.Sensor.maquina_id == maquina_id)
-        .order_by(models.Sensor.fecha_hora.desc())
-        .limit(10)
-    )
-    sensores = resultado_sensores.unique().scalars().all()
+    fecha_limite = datetime.now(timezone.utc) - timedelta(days=dias)
+    registro = {
+        sensor.id: sensor for sensor in await buscar_sensores(db, maquina_id, tipo_sensor=tipo_sensor)
+        if not sensores or sensor.nombre in sensores
+    }
+    resolucion = elegir_resolucion(resolucion, fecha_limite)
+    # Una sola consulta para todos los sensores y una regresión vectorizada por sensor
+    series = await leer_series(db, list(registro), resolucion, fecha_limite, maquina_id)
 
-    # Obtener los últimos 5 eventos críticos
-    resultado_eventos = await db.execute(
-        select(models.EventosCriticos)
-        .join(models.Sensor)
-        .filter(models.Sensor.maquina_id == maquina_id)
-        .order_by(models.EventosCriticos.timestamp.desc())
-        .limit(5)
-    )
-    eventos = resultado_eventos.scalars().all()
+    if not series:
+        raise HTTPException(status_code=404, detail="No se encontraron datos para el análisis")
 
+    tendencias = calcular_tendencias(series, fecha_limite.timestamp())
     return {
-        "maquina": maquina.nombre,
-        "ultimo_estado": [
+        "maquina_id": maquina_id,
+        "resolucion": resolucion,
+        "pendiente_unidad": "por hora",
+        "sensores": [
             {
-                "sensor": sensor.nombre,
-                "tipo": sensor.tipo_sensor.tipo,
-                "valor": sensor.valor,
-                "fecha": sensor.fecha_hora.isoformat()
-            } for sensor in sensores
-        ],
-        "eventos_recientes": [
-            {
-                "id": evento.id,
-                "descripcion": evento.description,
-                "fecha": evento.timestamp.isoformat()
-            } for evento in eventos
+                "sensor_id": sensor_id,
+                "nombre": registro[sensor_id].nombre,
+                "tipo": registro[sensor_id].tipo_sensor.tipo if registro[sensor_id].tipo_sensor else None,
+                **tendencia
+            }
+            for sensor_id, tendencia in sorted(tendencias.items())
         ]
     }
+
+@app.get("/resumen-maquina/{maquina_id}")
+async def obtener_resumen_maquina(
+    request: Request,
+    maquina_id: int,
+    usuario: models.User = Depends(current_active_user)
+):
+    async def calcular(db):
+        resultado_maquina = await db.execute(
+            select(models.Maquina).where(models.Maquina.id == maquina_id)
+        )
+        maquina = resultado_maquina.scalar_one_or_none()
+        if not maquina:
+            raise HTTPException(status_code=404, detail="Máquina no encontrada")
+
+        # Obtener las últimas 10 lecturas de sensores
+        sensores = {sensor.id: sensor for sensor in await buscar_sensores(db, maquina_id)}
+        resultado_lecturas = await db.execute(
+            select(models.Lectura)
+            .filter(models.Lectura.sensor_id.in_(list(sensores)))
+            .order_by(models.Lectura.fecha_hora.desc())
+            .limit(10)
+        )
+        lecturas = resultado_lecturas.scalars().all()
+
+        # Obtener los últimos 5 eventos críticos
+        resultado_eventos = await db.execute(
+            select(models.EventosCriticos)
+            .join(models.Sensor)
+            .filter(models.Sensor.maquina_id == maquina_id)
+            .order_by(models.EventosCriticos.timestamp.desc())
+            .limit(5)
+        )
+        eventos = resultado_eventos.scalars().all()
+
+        return {
+            "maquina": maquina.nombre,
+            "ultimo_estado": [
+                {
+                    "sensor": sensores[lectura.sensor_id].nombre,
+                    "tipo": sensores[lectura.sensor_id].tipo_sensor.tipo,
+                    "valor": lectura.valor,
+                    "fecha": lectura.fecha_hora.isoformat()
+                } for lectura in lecturas
+            ],
+            "eventos_recientes": [
+                {
+                    "id": evento.id,
+                    "descripcion": evento.description,
+                    "fecha": evento.timestamp.isoformat()
+                } for evento in eventos
+            ]
+        }
+
+    # Los eventos y sensores nuevos de la máquina invalidan el resumen; las últimas lecturas pueden
+    # tener hasta RESPUESTAS_TTL_RESUMEN_S segundos de antigüedad
+    return await cache_respuestas.responder(
+        request, ("resumen", maquina_id), (f"maquina:{maquina_id}",), RESPUESTAS_TTL_RESUMEN_S, calcular
+    )
+
+if not distribucion.atiende_api:
+    # Proceso solo de ingesta: no expone la API, solo sus métricas para monitoreo
+    app.router.routes[:] = [ruta for ruta in app.router.routes if getattr(ruta, "path", None) in RUTAS_INGESTA]
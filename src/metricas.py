@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+import time
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger("SensorApi")
+
+# Si está definido, GET /metrics exige "Authorization: Bearer <METRICAS_TOKEN>"
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN")
+# Cada cuánto se mide la demora del bucle de eventos
+METRICAS_LAG_INTERVALO_S = float(os.getenv("METRICAS_LAG_INTERVALO_S", 1))
+# Resumen de lecturas registradas en el log, como máximo una línea cada tantos segundos
+LOG_LECTURAS_INTERVALO_S = float(os.getenv("LOG_LECTURAS_INTERVALO_S", 10))
+
+BUCKETS_ETAPA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+LECTURAS = Counter("sensores_lecturas", "Lecturas registradas en la base")
+MENSAJES = Counter("sensores_mensajes_mqtt", "Mensajes MQTT procesados", ["formato"])
+DURACION_ETAPA = Histogram(
+    "sensores_etapa_segundos", "Duración de cada etapa de la ingesta", ["etapa"], buckets=BUCKETS_ETAPA
+)
+# Hijos con etiqueta resueltos una sola vez: observar no busca la etiqueta en cada lectura
+ETAPA_DECODIFICACION = DURACION_ETAPA.labels("decodificacion")
+ETAPA_ESCRITURA = DURACION_ETAPA.labels("escritura_db")
+ETAPA_ANOMALIAS = DURACION_ETAPA.labels("analisis_anomalias")
+ETAPA_NOTIFICACION = DURACION_ETAPA.labels("notificacion")
+DURACION_SOLICITUD = Histogram(
+    "sensores_http_solicitud_segundos", "Duración de las solicitudes HTTP por ruta", ["metodo", "ruta", "estado"],
+    buckets=BUCKETS_ETAPA
+)
+LAG_BUCLE = Histogram(
+    "sensores_bucle_lag_segundos", "Demora del bucle de eventos respecto del intervalo programado",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+LAG_BUCLE_ULTIMO = Gauge("sensores_bucle_lag_ultimo_segundos", "Última demora medida del bucle de eventos")
+
+
+class ColectorEstado:
+    # Medidas que ya existen en memoria (profundidad de colas, pool de conexiones, clientes...):
+    # se leen solo cuando Prometheus consulta /metrics, sin costo mientras nadie consulta.
+    def __init__(self):
+        self.fuentes = []
+
+    def agregar(self, nombre, descripcion, funcion, etiquetas=()):
+        # funcion() devuelve un número, o [(valores_etiquetas, número)] si hay etiquetas
+        self.fuentes.append((nombre, descripcion, funcion, etiquetas))
+
+    def collect(self):
+        for nombre, descripcion, funcion, etiquetas in self.fuentes:
+            familia = GaugeMetricFamily(nombre, descripcion, labels=etiquetas or None)
+            try:
+                valores = funcion()
+            except Exception as e:
+                logger.debug(f"No se pudo leer la métrica {nombre}: {e}")
+                continue
+            if etiquetas:
+                for valores_etiquetas, valor in valores:
+                    familia.add_metric([str(valor_etiqueta) for valor_etiqueta in valores_etiquetas], valor)
+            elif valores is not None:
+                familia.add_metric([], valores)
+            yield familia
+
+
+colector_estado = ColectorEstado()
+REGISTRY.register(colector_estado)
+
+
+class MetricasHTTP:
+    # Middleware ASGI: duración por método, plantilla de ruta y código de estado.
+    # Se etiqueta con la plantilla (/maquinas/{maquina_id}) y no con la URL para acotar las series.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        inicio = time.perf_counter()
+        estado = [500]
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start":
+                estado[0] = mensaje["status"]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            ruta = scope.get("route")
+            DURACION_SOLICITUD.labels(
+                scope["method"], ruta.path if ruta is not None else "sin_ruta", estado[0]
+            ).observe(time.perf_counter() - inicio)
+
+
+async def medir_lag_bucle(intervalo=METRICAS_LAG_INTERVALO_S):
+    # Un sleep que despierta tarde indica que algo bloqueó el bucle durante ese tiempo
+    while True:
+        inicio = time.perf_counter()
+        await asyncio.sleep(intervalo)
+        lag = max(0.0, time.perf_counter() - inicio - intervalo)
+        LAG_BUCLE.observe(lag)
+        LAG_BUCLE_ULTIMO.set(lag)
+
+
+class ResumenPeriodico:
+    # Reemplaza un log por lectura por una línea cada 'intervalo' segundos con el acumulado
+    def __init__(self, mensaje, intervalo=LOG_LECTURAS_INTERVALO_S):
+        self.mensaje = mensaje
+        self.intervalo = intervalo
+        self.acumulado = 0
+        self._desde = time.monotonic()
+
+    def sumar(self, cantidad):
+        self.acumulado += cantidad
+        ahora = time.monotonic()
+        if ahora - self._desde >= self.intervalo:
+            logger.info(self.mensaje.format(cantidad=self.acumulado, segundos=ahora - self._desde))
+            self.acumulado = 0
+            self._desde = ahora
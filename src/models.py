@@ -1,6 +1,6 @@
 from sqlalchemy.future import select
 from fastapi import Depends
-from sqlalchemy import UUID, Column, Integer, Float, Boolean, String, DateTime, ForeignKey, create_engine
+from sqlalchemy import JSON, UUID, BigInteger, Column, Integer, Float, Boolean, String, DateTime, ForeignKey, Index, UniqueConstraint, create_engine, func, text
 from sqlalchemy.orm import relationship, DeclarativeBase, sessionmaker
 from fastapi_users.db import SQLAlchemyBaseUserTableUUID, SQLAlchemyUserDatabase
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
@@ -10,9 +10,16 @@ from dotenv import load_dotenv
 from typing import AsyncGenerator
 from sqlalchemy.types import TIMESTAMP
 from contextlib import asynccontextmanager
+import logging
+from alembic import command
+from alembic.config import Config
 
+logger = logging.getLogger("SensorApi")
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
-DATABASE_URL = f"postgresql+asyncpg://{os.environ['DB_USER']}:{os.environ['DB_PASSWORD']}@db/{os.environ['DB_NAME']}"
+DATABASE_URL = f"postgresql+asyncpg://{os.environ['DB_USER']}:{os.environ['DB_PASSWORD']}@{os.getenv('DB_HOST', 'db')}/{os.environ['DB_NAME']}"
+LECTURAS_MESES_ADELANTE = int(os.getenv("LECTURAS_MESES_ADELANTE", 3))
+# Clave del bloqueo consultivo que serializa los cambios de esquema entre procesos
+BLOQUEO_ESQUEMA = 7261001
 
 class Base(DeclarativeBase):
     pass
@@ -24,12 +31,38 @@ class User(SQLAlchemyBaseUserTableUUID, Base):
 engine = create_async_engine(DATABASE_URL)
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
+async def bloquear(conexion, clave):
+    # Bloqueo consultivo de Postgres hasta el fin de la transacción: varios procesos de la API
+    # (workers, réplicas) arrancan a la vez y no deben migrar ni crear las mismas filas en paralelo
+    await conexion.execute(text("SELECT pg_advisory_xact_lock(:clave)"), {"clave": clave})
+
 async def create_db_and_tables():
+    # El esquema lo administra Alembic (alembic/versions); se aplica al iniciar la API
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await bloquear(conn, BLOQUEO_ESQUEMA)
+        await conn.run_sync(aplicar_migraciones)
+    await asegurar_particiones_lecturas()
+
+def aplicar_migraciones(connection):
+    configuracion = Config(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'alembic.ini'))
+    configuracion.attributes["connection"] = connection
+    command.upgrade(configuracion, "head")
+
+async def asegurar_particiones_lecturas():
+    # Particiones mensuales desde el mes actual hasta LECTURAS_MESES_ADELANTE meses en el futuro
+    async with engine.begin() as conn:
+        await bloquear(conn, BLOQUEO_ESQUEMA)
+        return await conn.scalar(
+            text(
+                "SELECT crear_particiones_lecturas((now() AT TIME ZONE 'UTC')::date, "
+                "((now() AT TIME ZONE 'UTC') + make_interval(months => :meses))::date)"
+            ),
+            {"meses": LECTURAS_MESES_ADELANTE}
+        )
 
 async def initialize_sensor_types():
     async with get_async_session() as db_session:
+        await bloquear(db_session, BLOQUEO_ESQUEMA)
         predefined_sensor_types = [
             {"tipo": "boolean", "unidad": "estado"},
             {"tipo": "distancia", "unidad": "metros"},
@@ -72,38 +105,104 @@ class TipoSensor(Base):
     id = Column(Integer, primary_key=True, index=True)
     tipo = Column(String, nullable=False)  
     unidad = Column(String, nullable=False) 
+    ventana_anomalias = Column(Integer, nullable=True)
+    umbral_z = Column(Float, nullable=True)
+    # Detector de anomalías (ver detectores.DETECTORES) y sus parámetros
+    detector = Column(String, nullable=True)
+    parametros_detector = Column(JSON, nullable=True)
+    # Días que se conservan las lecturas crudas y los agregados por minuto (ver retencion.py);
+    # los agregados por hora y día no vencen
+    retencion_dias = Column(Integer, nullable=True)
+    retencion_minuto_dias = Column(Integer, nullable=True)
     sensores = relationship("Sensor", back_populates="tipo_sensor", lazy="selectin")
 
 class Sensor(Base):
+    # Registro de sensores: una fila por máquina/tipo/nombre
     __tablename__ = 'sensores'
+    __table_args__ = (
+        UniqueConstraint('maquina_id', 'tipo_sensor_id', 'nombre'),
+        Index('ix_sensores_maquina_nombre', 'maquina_id', 'nombre'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     tipo_sensor_id = Column(Integer, ForeignKey('tipos_sensor.id'))
     maquina_id = Column(Integer, ForeignKey('maquinas.id'))
     nombre = Column(String, nullable=False)  
-    estado = Column(Boolean)
-    valor = Column(Float)
-    fecha_hora = Column(type_=TIMESTAMP(timezone=True), default=datetime.now(timezone.utc))
+    # Si se define, reemplaza al detector del tipo de sensor
+    detector = Column(String, nullable=True)
+    parametros_detector = Column(JSON, nullable=True)
     tipo_sensor = relationship("TipoSensor", back_populates="sensores")
     maquina = relationship("Maquina", back_populates="sensores")
+    lecturas = relationship("Lectura", back_populates="sensor")
     eventos_criticos = relationship("EventosCriticos", back_populates="sensor")
 
+class Lectura(Base):
+    # Tabla de hechos angosta con cada lectura recibida, particionada por mes de fecha_hora
+    __tablename__ = 'lecturas'
+    __table_args__ = {"postgresql_partition_by": "RANGE (fecha_hora)"}
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    sensor_id = Column(Integer, ForeignKey('sensores.id'), nullable=False)
+    fecha_hora = Column(type_=TIMESTAMP(timezone=True), primary_key=True)
+    valor = Column(Float)
+    estado = Column(Boolean)
+    sensor = relationship("Sensor", back_populates="lecturas")
+
+Index('ix_lecturas_sensor_fecha', Lectura.sensor_id, Lectura.fecha_hora.desc())
+
+class LecturaAgregada(Base):
+    # Agregados por sensor y ventana (minuto, hora, día), mantenidos por la ingesta
+    __tablename__ = 'lecturas_agregadas'
+    resolucion = Column(String, primary_key=True)
+    sensor_id = Column(Integer, ForeignKey('sensores.id'), primary_key=True)
+    inicio = Column(type_=TIMESTAMP(timezone=True), primary_key=True)
+    cantidad = Column(BigInteger, nullable=False)
+    minimo = Column(Float)
+    maximo = Column(Float)
+    suma = Column(Float)
+    suma_cuadrados = Column(Float)
+    primero = Column(Float)
+    ultimo = Column(Float)
+    fecha_primero = Column(type_=TIMESTAMP(timezone=True))
+    fecha_ultimo = Column(type_=TIMESTAMP(timezone=True))
+
+class UltimaLectura(Base):
+    # Último valor de cada sensor, actualizado por la ingesta en la misma transacción
+    __tablename__ = 'ultimas_lecturas'
+    sensor_id = Column(Integer, ForeignKey('sensores.id'), primary_key=True)
+    lectura_id = Column(BigInteger)
+    fecha_hora = Column(type_=TIMESTAMP(timezone=True), nullable=False)
+    valor = Column(Float)
+    estado = Column(Boolean)
+    sensor = relationship("Sensor")
+
 class EventosCriticos(Base):
     __tablename__ = 'eventos_criticos'
     id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(DateTime(timezone=True), default=datetime.now(timezone.utc))
+    timestamp = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), server_default=func.now())
     sensor_id = Column(Integer, ForeignKey('sensores.id'))
+    lectura_id = Column(BigInteger, nullable=True)
     value = Column(Float)
     description = Column(String)
     
     sensor = relationship("Sensor", back_populates="eventos_criticos")
     notificaciones = relationship("Notificaciones", back_populates="evento_critico")
 
+Index('ix_eventos_criticos_sensor_timestamp', EventosCriticos.sensor_id, EventosCriticos.timestamp.desc())
+
 class Notificaciones(Base):
     __tablename__ = 'notificaciones'
     id = Column(Integer, primary_key=True, index=True)
     event_id = Column(Integer, ForeignKey('eventos_criticos.id'))
     sent_to = Column(String)
-    sent_timestamp = Column(DateTime(timezone=True), default=datetime.now(timezone.utc))
+    sent_timestamp = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), server_default=func.now())
     status = Column(String)
-    
-    evento_critico = relationship("EventosCriticos", back_populates="notificaciones")
\ No newline at end of file
+    intentos = Column(Integer, nullable=False, default=0, server_default="0")
+    proximo_intento = Column(DateTime(timezone=True), nullable=True)
+    ultimo_error = Column(String, nullable=True)
+
+    evento_critico = relationship("EventosCriticos", back_populates="notificaciones")
+
+# El despachador del outbox solo recorre las pendientes
+Index(
+    'ix_notificaciones_pendientes', Notificaciones.proximo_intento,
+    postgresql_where=Notificaciones.status == 'pendiente'
+)
\ No newline at end of file
@@ -0,0 +1,258 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import formataddr
+from fastapi_mail.connection import Connection
+from sqlalchemy import insert, literal, or_, update
+from sqlalchemy.future import select
+from sqlalchemy.orm import selectinload
+from . import models
+from .metricas import ETAPA_NOTIFICACION
+from .reportes import generador_pdf
+
+logger = logging.getLogger("SensorApi")
+
+# Notificaciones pendientes que se toman por ciclo del despachador
+NOTIFICACIONES_LOTE = int(os.getenv("NOTIFICACIONES_LOTE", 100))
+# Segundos entre ciclos cuando no hay avisos de eventos nuevos
+NOTIFICACIONES_INTERVALO_S = float(os.getenv("NOTIFICACIONES_INTERVALO_S", 5))
+NOTIFICACIONES_MAX_INTENTOS = int(os.getenv("NOTIFICACIONES_MAX_INTENTOS", 5))
+# Espera antes del reintento n: base * 2^(n-1) segundos
+NOTIFICACIONES_REINTENTO_BASE_S = float(os.getenv("NOTIFICACIONES_REINTENTO_BASE_S", 30))
+# Las notificaciones tomadas por un despachador quedan reservadas este tiempo mientras se envían;
+# si el proceso cae antes de registrar el resultado, otro las vuelve a tomar al vencer
+NOTIFICACIONES_RESERVA_S = float(os.getenv("NOTIFICACIONES_RESERVA_S", 300))
+# Lista separada por comas; si está vacía se notifica a los usuarios activos y verificados
+NOTIFICACIONES_DESTINATARIOS = [
+    destinatario.strip()
+    for destinatario in os.getenv("NOTIFICACIONES_DESTINATARIOS", "").split(",")
+    if destinatario.strip()
+]
+
+
+async def registrar_notificaciones(sesion_db, evento_id):
+    # Outbox: las notificaciones pendientes se escriben en la misma transacción que el evento
+    # crítico; el envío queda a cargo del despachador. No hace commit.
+    if NOTIFICACIONES_DESTINATARIOS:
+        await sesion_db.execute(insert(models.Notificaciones), [
+            {"event_id": evento_id, "sent_to": destinatario, "status": "pendiente", "sent_timestamp": datetime.now(timezone.utc)}
+            for destinatario in NOTIFICACIONES_DESTINATARIOS
+        ])
+    else:
+        await sesion_db.execute(
+            insert(models.Notificaciones).from_select(
+                ["event_id", "sent_to", "status", "sent_timestamp"],
+                select(literal(evento_id), models.User.email, literal("pendiente"), literal(datetime.now(timezone.utc)))
+                .where(models.User.is_active, models.User.is_verified)
+            )
+        )
+
+
+def describir_evento(evento_critico):
+    sensor = evento_critico.sensor
+    origen = f"máquina {sensor.maquina_id} / {sensor.nombre}" if sensor else f"sensor {evento_critico.sensor_id}"
+    return f"- {evento_critico.timestamp:%Y-%m-%d %H:%M:%S} {origen}: {evento_critico.description}"
+
+
+class DespachadorNotificaciones:
+    # Drena el outbox en segundo plano: reserva lotes de notificaciones pendientes, envía un único
+    # correo resumen por destinatario sobre una sola conexión SMTP, fuera de la transacción, y
+    # actualiza los estados en bloque.
+    # Los envíos fallidos se reprograman con espera exponencial hasta agotar los intentos.
+    def __init__(
+        self, config_correo, lote=NOTIFICACIONES_LOTE, intervalo_s=NOTIFICACIONES_INTERVALO_S,
+        max_intentos=NOTIFICACIONES_MAX_INTENTOS, reintento_base_s=NOTIFICACIONES_REINTENTO_BASE_S,
+        reserva_s=NOTIFICACIONES_RESERVA_S
+    ):
+        self.config_correo = config_correo
+        self.lote = lote
+        self.intervalo_s = intervalo_s
+        self.max_intentos = max_intentos
+        self.reintento_base_s = reintento_base_s
+        self.reserva_s = reserva_s
+        self._aviso = asyncio.Event()
+        self._tarea = None
+        self.metricas = {
+            "ciclos": 0,
+            "correos": 0,
+            "enviadas": 0,
+            "reintentos": 0,
+            "fallidas": 0,
+            "errores": 0,
+            "ultimo_ciclo_ms": 0.0,
+        }
+
+    def iniciar(self):
+        self._tarea = asyncio.get_event_loop().create_task(self._bucle())
+
+    async def detener(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+    def avisar(self):
+        # Hay notificaciones nuevas: se despacha sin esperar al intervalo
+        self._aviso.set()
+
+    async def _bucle(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._aviso.wait(), self.intervalo_s)
+            except asyncio.TimeoutError:
+                pass
+            self._aviso.clear()
+            try:
+                # Un lote enviado completo indica que puede haber más pendientes vencidas;
+                # si el servidor falla se espera al próximo ciclo
+                while await self.despachar() >= self.lote:
+                    pass
+            except Exception as e:
+                self.metricas["errores"] += 1
+                logger.error(f"Error al despachar notificaciones: {e}")
+
+    async def despachar(self):
+        inicio = time.perf_counter()
+        ahora = datetime.now(timezone.utc)
+        async with models.get_async_session() as sesion:
+            # SKIP LOCKED permite varios despachadores (uno por proceso) sin enviar dos veces
+            resultado = await sesion.execute(
+                select(models.Notificaciones)
+                .options(
+                    selectinload(models.Notificaciones.evento_critico)
+                    .selectinload(models.EventosCriticos.sensor)
+                )
+                .where(
+                    models.Notificaciones.status == "pendiente",
+                    or_(models.Notificaciones.proximo_intento.is_(None), models.Notificaciones.proximo_intento <= ahora)
+                )
+                .order_by(models.Notificaciones.id)
+                .limit(self.lote)
+                .with_for_update(skip_locked=True)
+            )
+            notificaciones = resultado.scalars().all()
+            if not notificaciones:
+                return 0
+            # La reserva se confirma antes de enviar: la transacción no queda abierta durante el SMTP
+            await sesion.execute(
+                update(models.Notificaciones)
+                .where(models.Notificaciones.id.in_([notificacion.id for notificacion in notificaciones]))
+                .values(proximo_intento=ahora + timedelta(seconds=self.reserva_s))
+                .execution_options(synchronize_session=False)
+            )
+            await sesion.commit()
+
+        por_destinatario = defaultdict(list)
+        for notificacion in notificaciones:
+            por_destinatario[notificacion.sent_to].append(notificacion)
+        enviadas, fallidas = await self.enviar(por_destinatario)
+
+        async with models.get_async_session() as sesion:
+            await self.actualizar_estados(sesion, enviadas, fallidas, datetime.now(timezone.utc))
+            await sesion.commit()
+
+        duracion = time.perf_counter() - inicio
+        ETAPA_NOTIFICACION.observe(duracion)
+        self.metricas["ciclos"] += 1
+        self.metricas["ultimo_ciclo_ms"] = round(duracion * 1000, 2)
+        return len(enviadas)
+
+    async def enviar(self, por_destinatario):
+        # Devuelve las notificaciones enviadas y las fallidas con su error. Los resúmenes se arman antes
+        # de conectar y se envían todos sobre una sola conexión SMTP por ciclo.
+        enviadas = []
+        fallidas = []
+        restantes = {}
+        for destinatario, grupo in por_destinatario.items():
+            try:
+                restantes[destinatario] = (grupo, await self.resumen(destinatario, grupo))
+            except Exception as e:
+                fallidas.extend((notificacion, str(e)) for notificacion in grupo)
+        if not restantes:
+            return enviadas, fallidas
+        try:
+            async with Connection(self.config_correo) as conexion:
+                for destinatario in list(restantes):
+                    grupo, mensaje = restantes.pop(destinatario)
+                    try:
+                        if not self.config_correo.SUPPRESS_SEND:
+                            await conexion.session.send_message(mensaje)
+                    except Exception as e:
+                        if not conexion.session.is_connected:
+                            # Se cortó la conexión: este resumen y los que faltan se reintentan
+                            restantes[destinatario] = (grupo, mensaje)
+                            raise
+                        fallidas.extend((notificacion, str(e)) for notificacion in grupo)
+                    else:
+                        enviadas.extend(grupo)
+                        self.metricas["correos"] += 1
+        except Exception as e:
+            # Sin conexión con el servidor (ConnectionErrors al conectar): todo lo que no se llegó a enviar se reintenta
+            logger.error(f"Error de conexión SMTP: {e}")
+            fallidas.extend((notificacion, str(e)) for grupo, _ in restantes.values() for notificacion in grupo)
+        return enviadas, fallidas
+
+    async def resumen(self, destinatario, notificaciones):
+        # Un correo por destinatario con todos sus eventos pendientes y un PDF por evento
+        eventos = {notificacion.event_id: notificacion.evento_critico for notificacion in notificaciones}
+        mensaje = EmailMessage()
+        mensaje["From"] = formataddr((self.config_correo.MAIL_FROM_NAME or "", self.config_correo.MAIL_FROM))
+        mensaje["To"] = destinatario
+        if len(eventos) == 1:
+            mensaje["Subject"] = "Notificación de Evento Crítico"
+        else:
+            mensaje["Subject"] = f"Notificación de {len(eventos)} Eventos Críticos"
+        mensaje.set_content(
+            "Se han detectado los siguientes eventos críticos. "
+            "Por favor, revise los archivos adjuntos para más detalles.\n\n"
+            + "\n".join(describir_evento(evento) for evento in eventos.values() if evento is not None)
+        )
+        # Los PDFs se renderizan en paralelo en el pool de reportes (o salen de su cache)
+        eventos = [evento for evento in eventos.values() if evento is not None]
+        pdfs = await asyncio.gather(*(generador_pdf.pdf_evento(evento) for evento in eventos))
+        for evento, contenido in zip(eventos, pdfs):
+            mensaje.add_attachment(
+                contenido, maintype="application", subtype="pdf", filename=f"evento_critico_{evento.id}.pdf"
+            )
+        return mensaje
+
+    async def actualizar_estados(self, sesion, enviadas, fallidas, ahora):
+        if enviadas:
+            await sesion.execute(
+                update(models.Notificaciones)
+                .where(models.Notificaciones.id.in_([notificacion.id for notificacion in enviadas]))
+                .values(
+                    status="enviado",
+                    sent_timestamp=ahora,
+                    intentos=models.Notificaciones.intentos + 1,
+                    proximo_intento=None,
+                    ultimo_error=None
+                )
+                .execution_options(synchronize_session=False)
+            )
+            self.metricas["enviadas"] += len(enviadas)
+        if fallidas:
+            cambios = []
+            for notificacion, error in fallidas:
+                intentos = notificacion.intentos + 1
+                agotada = intentos >= self.max_intentos
+                cambios.append({
+                    "id": notificacion.id,
+                    "status": "fallido" if agotada else "pendiente",
+                    "intentos": intentos,
+                    "proximo_intento": None if agotada else ahora + timedelta(seconds=self.reintento_base_s * 2 ** (intentos - 1)),
+                    "ultimo_error": error[:500],
+                })
+                self.metricas["fallidas" if agotada else "reintentos"] += 1
+            # UPDATE por clave primaria en una sola ejecución (executemany)
+            await sesion.execute(update(models.Notificaciones), cambios)
+
+    def estado(self):
+        return {**self.metricas, "activo": self._tarea is not None and not self._tarea.done()}
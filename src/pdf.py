@@ -0,0 +1,75 @@
+from fpdf import FPDF
+
+# Funciones puras de renderizado: se ejecutan en los procesos del pool de reportes, así que
+# reciben datos simples (no objetos ORM) y no importan nada de la base de datos.
+
+ALTO_FILA = 6
+LIMITE_PAGINA = 275
+COLUMNAS_RESUMEN = (("Máquina", 55), ("Sensor", 55), ("Eventos", 25), ("Mínimo", 27), ("Máximo", 28))
+COLUMNAS_DETALLE = (("Fecha", 36), ("Máquina", 32), ("Sensor", 32), ("Valor", 22), ("Descripción", 68))
+
+
+def texto_pdf(valor):
+    # Las fuentes estándar de FPDF solo admiten latin-1
+    return str(valor).encode("latin-1", "replace").decode("latin-1")
+
+
+def recortar(pdf, texto, ancho):
+    texto = texto_pdf(texto)
+    while texto and pdf.get_string_width(texto) > ancho - 2:
+        texto = texto[:-1]
+    return texto
+
+
+def renderizar_evento(evento):
+    # evento: dict con id, timestamp, sensor_id, value y description
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+    pdf.cell(200, 10, txt=texto_pdf(f"Evento Crítico ID: {evento['id']}"), ln=1, align="C")
+    pdf.cell(200, 10, txt=texto_pdf(f"Fecha y Hora: {evento['timestamp']}"), ln=1)
+    pdf.cell(200, 10, txt=texto_pdf(f"Sensor ID: {evento['sensor_id']}"), ln=1)
+    pdf.cell(200, 10, txt=texto_pdf(f"Valor: {evento['value']}"), ln=1)
+    pdf.cell(200, 10, txt=texto_pdf(f"Descripción: {evento['description']}"), ln=1)
+    return pdf.output(dest="S").encode("latin1")
+
+
+def encabezado_tabla(pdf, columnas):
+    pdf.set_font("Arial", "B", 9)
+    for nombre, ancho in columnas:
+        pdf.cell(ancho, ALTO_FILA, texto_pdf(nombre), border=1)
+    pdf.ln()
+    pdf.set_font("Arial", size=8)
+
+
+def tabla(pdf, columnas, filas):
+    encabezado_tabla(pdf, columnas)
+    for fila in filas:
+        if pdf.get_y() > LIMITE_PAGINA:
+            pdf.add_page()
+            encabezado_tabla(pdf, columnas)
+        for (_, ancho), valor in zip(columnas, fila):
+            pdf.cell(ancho, ALTO_FILA, recortar(pdf, valor, ancho), border=1)
+        pdf.ln()
+
+
+def renderizar_informe_mensual(titulo, resumen, filas, total):
+    # resumen: [(máquina, sensor, eventos, mínimo, máximo)]; filas: [(fecha, máquina, sensor, valor, descripción)]
+    # total: eventos del mes, puede superar a len(filas) si el detalle se recortó
+    pdf = FPDF()
+    pdf.set_auto_page_break(False)
+    pdf.add_page()
+    pdf.set_font("Arial", "B", 14)
+    pdf.cell(190, 10, txt=texto_pdf(titulo), ln=1, align="C")
+    pdf.set_font("Arial", size=10)
+    pdf.cell(190, 8, txt=texto_pdf(f"Total de eventos críticos: {total}"), ln=1)
+    if total > len(filas):
+        pdf.cell(190, 8, txt=texto_pdf(f"El detalle lista los primeros {len(filas)} eventos."), ln=1)
+    if not filas:
+        return pdf.output(dest="S").encode("latin1")
+
+    pdf.ln(2)
+    tabla(pdf, COLUMNAS_RESUMEN, resumen)
+    pdf.add_page()
+    tabla(pdf, COLUMNAS_DETALLE, filas)
+    return pdf.output(dest="S").encode("latin1")
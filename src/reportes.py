@@ -0,0 +1,189 @@
+import asyncio
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from sqlalchemy.future import select
+from . import models
+from .pdf import renderizar_evento, renderizar_informe_mensual
+
+# Procesos que renderizan PDFs fuera del bucle de eventos
+REPORTES_PROCESOS = int(os.getenv("REPORTES_PROCESOS", 2))
+# Tamaño máximo de la cache de PDFs generados
+REPORTES_CACHE_MB = float(os.getenv("REPORTES_CACHE_MB", 32))
+# Eventos críticos leídos por bloque del cursor al armar el informe mensual
+REPORTES_FILAS_POR_BLOQUE = int(os.getenv("REPORTES_FILAS_POR_BLOQUE", 1000))
+# Eventos listados en el detalle del informe mensual; el resumen por sensor cuenta todos
+REPORTES_MAX_DETALLE = int(os.getenv("REPORTES_MAX_DETALLE", 5000))
+
+
+class CachePdf:
+    # LRU acotada por bytes: al superar el máximo se descartan los PDFs usados hace más tiempo
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entradas = OrderedDict()
+        self.bytes = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+
+    def obtener(self, clave):
+        contenido = self.entradas.get(clave)
+        if contenido is None:
+            self.fallos += 1
+            return None
+        self.entradas.move_to_end(clave)
+        self.aciertos += 1
+        return contenido
+
+    def guardar(self, clave, contenido):
+        if len(contenido) > self.max_bytes:
+            return
+        anterior = self.entradas.pop(clave, None)
+        if anterior is not None:
+            self.bytes -= len(anterior)
+        self.entradas[clave] = contenido
+        self.bytes += len(contenido)
+        while self.bytes > self.max_bytes:
+            _, descartado = self.entradas.popitem(last=False)
+            self.bytes -= len(descartado)
+            self.desalojos += 1
+
+    def estado(self):
+        return {
+            "entradas": len(self.entradas),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "desalojos": self.desalojos,
+        }
+
+
+def datos_evento(evento_critico):
+    return {
+        "id": evento_critico.id,
+        "timestamp": str(evento_critico.timestamp),
+        "sensor_id": evento_critico.sensor_id,
+        "value": evento_critico.value,
+        "description": evento_critico.description,
+    }
+
+
+def limites_mes(anio, mes):
+    inicio = datetime(anio, mes, 1, tzinfo=timezone.utc)
+    fin = datetime(anio + mes // 12, mes % 12 + 1, 1, tzinfo=timezone.utc)
+    return inicio, fin
+
+
+class GeneradorPdf:
+    # Renderiza los PDFs en un pool de procesos para no bloquear la ingesta ni la API.
+    # Dos pedidos simultáneos del mismo documento comparten un único renderizado.
+    def __init__(self, procesos=REPORTES_PROCESOS, cache_mb=REPORTES_CACHE_MB):
+        self.procesos = procesos
+        self.cache = CachePdf(int(cache_mb * 1024 * 1024))
+        self._pool = None
+        self._en_curso = {}
+        self.renderizados = 0
+
+    def _ejecutor(self):
+        if self._pool is None:
+            # spawn: los procesos no heredan el bucle de eventos ni las conexiones abiertas
+            self._pool = ProcessPoolExecutor(self.procesos, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def renderizar(self, clave, cachear, funcion, *argumentos):
+        contenido = self.cache.obtener(clave)
+        if contenido is not None:
+            return contenido
+        futuro = self._en_curso.get(clave)
+        if futuro is None:
+            futuro = asyncio.get_running_loop().run_in_executor(self._ejecutor(), funcion, *argumentos)
+            self._en_curso[clave] = futuro
+            futuro.add_done_callback(lambda terminado: self._terminar(clave, cachear, terminado))
+        # shield: si un cliente cancela, el renderizado sigue para los demás que lo esperan
+        return await asyncio.shield(futuro)
+
+    def _terminar(self, clave, cachear, futuro):
+        self._en_curso.pop(clave, None)
+        if futuro.cancelled():
+            return
+        if isinstance(futuro.exception(), BrokenProcessPool):
+            # Murió un proceso del pool: se descarta y el próximo pedido crea uno nuevo
+            self._pool = None
+        if futuro.exception() is not None:
+            return
+        self.renderizados += 1
+        if cachear:
+            self.cache.guardar(clave, futuro.result())
+
+    async def pdf_evento(self, evento_critico):
+        # Los eventos críticos no cambian: el PDF se reutiliza en reenvíos y resúmenes
+        return await self.renderizar(("evento", evento_critico.id), True, renderizar_evento, datos_evento(evento_critico))
+
+    async def informe_mensual(self, sesion_db, anio, mes, maquina_id=None):
+        clave = ("mes", anio, mes, maquina_id)
+        inicio, fin = limites_mes(anio, mes)
+        contenido = self.cache.obtener(clave)
+        if contenido is not None:
+            return contenido
+
+        consulta = (
+            select(
+                models.EventosCriticos.timestamp, models.Maquina.nombre, models.Sensor.nombre,
+                models.EventosCriticos.value, models.EventosCriticos.description
+            )
+            .outerjoin(models.Sensor, models.Sensor.id == models.EventosCriticos.sensor_id)
+            .outerjoin(models.Maquina, models.Maquina.id == models.Sensor.maquina_id)
+            .where(models.EventosCriticos.timestamp >= inicio, models.EventosCriticos.timestamp < fin)
+            .order_by(models.EventosCriticos.timestamp, models.EventosCriticos.id)
+        )
+        if maquina_id is not None:
+            consulta = consulta.where(models.Sensor.maquina_id == maquina_id)
+
+        # Cursor del lado del servidor: se recorre por bloques acumulando el resumen por sensor sobre
+        # la marcha; del detalle solo se guardan los primeros REPORTES_MAX_DETALLE eventos
+        filas = []
+        total = 0
+        resumen = {}
+        resultado = await sesion_db.stream(consulta.execution_options(yield_per=REPORTES_FILAS_POR_BLOQUE))
+        async for bloque in resultado.partitions():
+            for fecha, maquina, sensor, valor, descripcion in bloque:
+                maquina, sensor = maquina or "-", sensor or "-"
+                total += 1
+                if len(filas) < REPORTES_MAX_DETALLE:
+                    filas.append((f"{fecha:%Y-%m-%d %H:%M:%S}", maquina, sensor, f"{valor:.2f}", descripcion or ""))
+                acumulado = resumen.get((maquina, sensor))
+                if acumulado is None:
+                    resumen[(maquina, sensor)] = [1, valor, valor]
+                else:
+                    acumulado[0] += 1
+                    acumulado[1] = min(acumulado[1], valor)
+                    acumulado[2] = max(acumulado[2], valor)
+
+        resumen = [
+            (maquina, sensor, cantidad, f"{minimo:.2f}", f"{maximo:.2f}")
+            for (maquina, sensor), (cantidad, minimo, maximo) in sorted(resumen.items())
+        ]
+        titulo = f"Eventos críticos {mes:02d}/{anio}" + (f" - máquina {maquina_id}" if maquina_id is not None else "")
+        # Solo los meses cerrados quedan en cache; el mes en curso sigue sumando eventos
+        cerrado = fin <= datetime.now(timezone.utc)
+        return await self.renderizar(clave, cerrado, renderizar_informe_mensual, titulo, resumen, filas, total)
+
+    def cerrar(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def estado(self):
+        return {
+            "procesos": self.procesos,
+            "en_curso": len(self._en_curso),
+            "renderizados": self.renderizados,
+            "cache": self.cache.estado(),
+        }
+
+
+generador_pdf = GeneradorPdf()
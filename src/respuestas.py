@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict, defaultdict
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+from . import models
+
+# Tamaño máximo de la cache de respuestas de lectura (listas de máquinas y tipos, resúmenes)
+RESPUESTAS_CACHE_MB = float(os.getenv("RESPUESTAS_CACHE_MB", 16))
+# Vigencia de las respuestas que solo cambian con altas de máquinas, sensores o tipos (se invalidan al instante)
+RESPUESTAS_TTL_S = float(os.getenv("RESPUESTAS_TTL_S", 300))
+# Vigencia del resumen de una máquina: incluye las últimas lecturas, que no invalidan la cache
+RESPUESTAS_TTL_RESUMEN_S = float(os.getenv("RESPUESTAS_TTL_RESUMEN_S", 5))
+# Los clientes deben revalidar siempre (If-None-Match) y las respuestas son por usuario autenticado
+CACHE_CONTROL = "private, no-cache"
+
+
+class Entrada:
+    def __init__(self, cuerpo, etiquetas, vence):
+        self.cuerpo = cuerpo
+        self.etag = '"' + hashlib.blake2b(cuerpo, digest_size=16).hexdigest() + '"'
+        self.etiquetas = etiquetas
+        self.vence = vence
+
+
+def coincide_etag(encabezado, etag):
+    # If-None-Match admite varias etiquetas separadas por coma, "*" y la forma débil W/"..."
+    if not encabezado:
+        return False
+    candidatos = [candidato.strip() for candidato in encabezado.split(",")]
+    return "*" in candidatos or etag in (candidato.removeprefix("W/") for candidato in candidatos)
+
+
+class CacheRespuestas:
+    # Cuerpos JSON ya serializados por ruta y parámetros, acotados por bytes (LRU) y con vencimiento.
+    # Cada entrada lleva etiquetas ("maquinas", "tipos", "maquina:<id>") que la ingesta y las rutas
+    # de escritura invalidan cuando cambian los datos de los que depende.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entradas = OrderedDict()
+        self.por_etiqueta = defaultdict(set)
+        self.bytes = 0
+        self._en_curso = {}
+        # Aumenta con cada invalidación: un cálculo que empezó antes no se guarda
+        self.version = 0
+        # Con la API en varios procesos, función que reenvía las invalidaciones al resto
+        self.difundir = None
+        self.aciertos = 0
+        self.fallos = 0
+        self.no_modificadas = 0
+        self.invalidaciones = 0
+
+    def obtener(self, clave):
+        entrada = self.entradas.get(clave)
+        if entrada is None:
+            return None
+        if entrada.vence <= time.monotonic():
+            self._quitar(clave)
+            return None
+        self.entradas.move_to_end(clave)
+        return entrada
+
+    def guardar(self, clave, entrada):
+        if len(entrada.cuerpo) > self.max_bytes:
+            return
+        if clave in self.entradas:
+            self._quitar(clave)
+        self.entradas[clave] = entrada
+        self.bytes += len(entrada.cuerpo)
+        for etiqueta in entrada.etiquetas:
+            self.por_etiqueta[etiqueta].add(clave)
+        while self.bytes > self.max_bytes:
+            self._quitar(next(iter(self.entradas)))
+
+    def _quitar(self, clave):
+        entrada = self.entradas.pop(clave)
+        self.bytes -= len(entrada.cuerpo)
+        for etiqueta in entrada.etiquetas:
+            claves = self.por_etiqueta.get(etiqueta)
+            if claves is not None:
+                claves.discard(clave)
+                if not claves:
+                    del self.por_etiqueta[etiqueta]
+
+    def invalidar(self, *etiquetas, difundir=True):
+        self.version += 1
+        for etiqueta in etiquetas:
+            for clave in list(self.por_etiqueta.get(etiqueta, ())):
+                self._quitar(clave)
+                self.invalidaciones += 1
+        if difundir and self.difundir:
+            self.difundir(list(etiquetas))
+
+    async def responder(self, request, clave, etiquetas, ttl, calcular):
+        # calcular(sesion_db) devuelve el contenido de la respuesta; solo se ejecuta si no hay una entrada vigente
+        entrada = self.obtener(clave)
+        if entrada is not None:
+            self.aciertos += 1
+        else:
+            self.fallos += 1
+            futuro = self._en_curso.get(clave)
+            if futuro is None:
+                futuro = asyncio.ensure_future(self._calcular(clave, etiquetas, ttl, calcular))
+                self._en_curso[clave] = futuro
+                futuro.add_done_callback(lambda _: self._en_curso.pop(clave, None))
+            # shield: si el cliente que disparó el cálculo se desconecta, los demás lo siguen esperando
+            entrada = await asyncio.shield(futuro)
+
+        encabezados = {"ETag": entrada.etag, "Cache-Control": CACHE_CONTROL}
+        if coincide_etag(request.headers.get("if-none-match"), entrada.etag):
+            self.no_modificadas += 1
+            return Response(status_code=304, headers=encabezados)
+        return Response(entrada.cuerpo, media_type="application/json", headers=encabezados)
+
+    async def _calcular(self, clave, etiquetas, ttl, calcular):
+        version = self.version
+        # El cálculo lo comparten varios pedidos: usa su propia sesión, no la del primero que lo disparó
+        async with models.get_async_session() as sesion_db:
+            contenido = await calcular(sesion_db)
+        cuerpo = json.dumps(jsonable_encoder(contenido), ensure_ascii=False, separators=(",", ":")).encode()
+        entrada = Entrada(cuerpo, etiquetas, time.monotonic() + ttl)
+        if version == self.version:
+            self.guardar(clave, entrada)
+        return entrada
+
+    def estado(self):
+        return {
+            "entradas": len(self.entradas),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "no_modificadas": self.no_modificadas,
+            "invalidaciones": self.invalidaciones,
+        }
+
+
+cache_respuestas = CacheRespuestas(int(RESPUESTAS_CACHE_MB * 1024 * 1024))
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.future import select
+from . import models
+
+logger = logging.getLogger("SensorApi")
+
+# Días por defecto para los tipos de sensor sin retención propia; vacío = sin vencimiento
+RETENCION_DIAS = int(os.getenv("RETENCION_DIAS") or 0) or None
+RETENCION_MINUTO_DIAS = int(os.getenv("RETENCION_MINUTO_DIAS") or 0) or None
+# Cada cuántas horas se aplica la retención en segundo plano (0 = solo a pedido)
+RETENCION_INTERVALO_H = float(os.getenv("RETENCION_INTERVALO_H", 6))
+# Filas por DELETE y pausa entre lotes: transacciones cortas que no frenan a la ingesta
+RETENCION_LOTE = int(os.getenv("RETENCION_LOTE", 5000))
+RETENCION_PAUSA_MS = float(os.getenv("RETENCION_PAUSA_MS", 50))
+# Espera máxima por el bloqueo de la tabla al separar una partición; si no se obtiene se reintenta después
+RETENCION_LOCK_TIMEOUT_MS = int(os.getenv("RETENCION_LOCK_TIMEOUT_MS", 2000))
+# Clave del bloqueo consultivo: una sola ejecución a la vez entre todos los procesos
+BLOQUEO_RETENCION = 7261002
+
+INICIO = datetime(1970, 1, 1, tzinfo=timezone.utc)
+LIMITE_PARTICION = re.compile(r"TO \('([^']+)'\)")
+
+CONSULTA_PARTICIONES = text(
+    "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), GREATEST(c.reltuples, 0)::bigint, "
+    "pg_total_relation_size(c.oid) "
+    "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+    "WHERE i.inhparent = 'lecturas'::regclass ORDER BY c.relname"
+)
+BORRAR_LECTURAS = text(
+    "DELETE FROM lecturas WHERE (id, fecha_hora) IN ("
+    "SELECT id, fecha_hora FROM lecturas WHERE sensor_id = ANY(:sensores) AND fecha_hora < :limite LIMIT :lote)"
+)
+# En simulación no se cuentan dos veces las filas de las particiones que se eliminarían enteras (< :desde)
+CONTAR_LECTURAS = text(
+    "SELECT count(*) FROM lecturas WHERE sensor_id = ANY(:sensores) AND fecha_hora >= :desde AND fecha_hora < :limite"
+)
+BORRAR_AGREGADOS_MINUTO = text(
+    "DELETE FROM lecturas_agregadas WHERE (resolucion, sensor_id, inicio) IN ("
+    "SELECT resolucion, sensor_id, inicio FROM lecturas_agregadas "
+    "WHERE resolucion = 'minuto' AND sensor_id = ANY(:sensores) AND inicio < :limite LIMIT :lote)"
+)
+CONTAR_AGREGADOS_MINUTO = text(
+    "SELECT count(*) FROM lecturas_agregadas "
+    "WHERE resolucion = 'minuto' AND sensor_id = ANY(:sensores) AND inicio >= :desde AND inicio < :limite"
+)
+
+
+def fin_particion(limites):
+    # "FOR VALUES FROM ('2026-01-01 00:00:00+00') TO ('2026-02-01 00:00:00+00')"; None para DEFAULT
+    coincidencia = LIMITE_PARTICION.search(limites or "")
+    return datetime.fromisoformat(coincidencia.group(1)) if coincidencia else None
+
+
+class Retencion:
+    # Vence las lecturas crudas y los agregados por minuto según la retención de cada tipo de sensor.
+    # Las particiones mensuales completamente vencidas para todos los tipos se separan y eliminan
+    # (sin reescribir filas); el resto se borra en lotes chicos, cada uno en su propia transacción.
+    def __init__(self):
+        self.ultimo_informe = None
+        self.ejecuciones = 0
+        # Lo asigna archivo.py: None si no se archiva, o la fecha desde la que las lecturas aún no están archivadas
+        self.limite_archivo = None
+
+    async def politicas(self, sesion_db):
+        # [(tipo_sensor_id, tipo, días crudas, días minuto, [sensor_ids])]; los sensores sin tipo usan los valores por defecto
+        tipos = await sesion_db.execute(
+            select(models.TipoSensor.id, models.TipoSensor.tipo, models.TipoSensor.retencion_dias, models.TipoSensor.retencion_minuto_dias)
+            .order_by(models.TipoSensor.id)
+        )
+        sensores = await sesion_db.execute(select(models.Sensor.tipo_sensor_id, models.Sensor.id))
+        por_tipo = defaultdict(list)
+        for tipo_sensor_id, sensor_id in sensores.all():
+            por_tipo[tipo_sensor_id].append(sensor_id)
+        politicas = [
+            (tipo_id, tipo, dias or RETENCION_DIAS, dias_minuto or RETENCION_MINUTO_DIAS, por_tipo.get(tipo_id, []))
+            for tipo_id, tipo, dias, dias_minuto in tipos.all()
+        ]
+        if por_tipo.get(None):
+            politicas.append((None, None, RETENCION_DIAS, RETENCION_MINUTO_DIAS, por_tipo[None]))
+        return politicas
+
+    async def ejecutar(self, simulacion=False):
+        async with models.engine.connect() as conexion:
+            if not await conexion.scalar(text("SELECT pg_try_advisory_lock(:clave)"), {"clave": BLOQUEO_RETENCION}):
+                return {"simulacion": simulacion, "omitida": "hay otra ejecución en curso"}
+            try:
+                informe = await self._ejecutar(simulacion)
+            finally:
+                await conexion.execute(text("SELECT pg_advisory_unlock(:clave)"), {"clave": BLOQUEO_RETENCION})
+                await conexion.commit()
+        self.ejecuciones += 1
+        self.ultimo_informe = informe
+        return informe
+
+    async def _ejecutar(self, simulacion):
+        inicio = time.perf_counter()
+        ahora = datetime.now(timezone.utc)
+        async with models.get_async_session() as sesion_db:
+            politicas = await self.politicas(sesion_db)
+        limite_archivo = self.limite_archivo() if self.limite_archivo else None
+        informe = {
+            "simulacion": simulacion,
+            "fecha": ahora.isoformat(),
+            "archivo_hasta": limite_archivo.isoformat() if limite_archivo else None,
+            "particiones": [],
+            "lecturas": {},
+            "agregados_minuto": {},
+            "errores": [],
+        }
+
+        # Una partición mensual solo se elimina entera si venció para todos los tipos con sensores
+        desde = INICIO
+        dias_crudas = [dias for _, _, dias, _, sensores in politicas if sensores]
+        if dias_crudas and all(dias_crudas):
+            horizonte = ahora - timedelta(days=max(dias_crudas))
+            if limite_archivo is not None:
+                horizonte = min(horizonte, limite_archivo)
+            desde = await self._eliminar_particiones(horizonte, limite_archivo is not None, simulacion, informe)
+
+        for tipo_id, tipo, dias, dias_minuto, sensores in politicas:
+            if not sensores:
+                continue
+            nombre = tipo or "sin tipo"
+            # Con el archivo activo las lecturas crudas salen de la base al archivarse: antes de la marca solo
+            # quedan filas ya archivadas o atrasadas que archiva la próxima ejecución, así que no se borran aquí
+            if dias and limite_archivo is None:
+                informe["lecturas"][nombre] = await self._borrar_en_lotes(
+                    BORRAR_LECTURAS, CONTAR_LECTURAS, sensores, desde, ahora - timedelta(days=dias), simulacion, informe
+                )
+            if dias_minuto:
+                informe["agregados_minuto"][nombre] = await self._borrar_en_lotes(
+                    BORRAR_AGREGADOS_MINUTO, CONTAR_AGREGADOS_MINUTO, sensores, INICIO, ahora - timedelta(days=dias_minuto),
+                    simulacion, informe
+                )
+
+        informe["filas"] = (
+            sum(particion["filas"] for particion in informe["particiones"])
+            + sum(informe["lecturas"].values()) + sum(informe["agregados_minuto"].values())
+        )
+        informe["bytes_particiones"] = sum(particion["bytes"] for particion in informe["particiones"])
+        informe["duracion_s"] = round(time.perf_counter() - inicio, 3)
+        logger.info(
+            f"Retención{' (simulación)' if simulacion else ''}: {len(informe['particiones'])} particiones y "
+            f"{informe['filas']} filas {'a eliminar' if simulacion else 'eliminadas'} en {informe['duracion_s']} s."
+        )
+        return informe
+
+    async def _eliminar_particiones(self, horizonte, solo_vacias, simulacion, informe):
+        # Devuelve el fin de la última partición eliminada: las lecturas anteriores ya no existen.
+        # solo_vacias: con el archivo activo, una partición con filas puede tener lecturas sin archivar.
+        desde = INICIO
+        async with models.engine.connect() as conexion:
+            particiones = (await conexion.execute(CONSULTA_PARTICIONES)).all()
+        for nombre, limites, filas, tamano in particiones:
+            fin = fin_particion(limites)
+            # La partición por defecto (sin límites) y las que aún tienen lecturas vigentes se conservan
+            if fin is None or fin > horizonte:
+                continue
+            if simulacion:
+                # reltuples es solo una estimación (0 si la partición nunca se analizó): la simulación cuenta
+                async with models.engine.connect() as conexion:
+                    filas = await conexion.scalar(text(f'SELECT count(*) FROM "{nombre}"'))
+                if solo_vacias and filas:
+                    continue
+            else:
+                try:
+                    async with models.engine.begin() as conexion:
+                        await conexion.execute(text(f"SET LOCAL lock_timeout = {RETENCION_LOCK_TIMEOUT_MS}"))
+                        if solo_vacias:
+                            # SHARE bloquea las inserciones hasta el DROP: no puede entrar una lectura después de verificar
+                            await conexion.execute(text(f'LOCK TABLE "{nombre}" IN SHARE MODE'))
+                            if await conexion.scalar(text(f'SELECT EXISTS (SELECT 1 FROM "{nombre}")')):
+                                continue
+                        await conexion.execute(text(f'ALTER TABLE lecturas DETACH PARTITION "{nombre}"'))
+                        await conexion.execute(text(f'DROP TABLE "{nombre}"'))
+                except DBAPIError as e:
+                    logger.warning(f"No se pudo eliminar la partición {nombre}: {e}")
+                    informe["errores"].append(f"{nombre}: {e.orig}")
+                    continue
+            informe["particiones"].append({"nombre": nombre, "hasta": fin.isoformat(), "filas": filas, "bytes": tamano})
+            desde = max(desde, fin)
+        return desde
+
+    async def _borrar_en_lotes(self, borrar, contar, sensores, desde, limite, simulacion, informe):
+        parametros = {"sensores": sensores, "limite": limite, "lote": RETENCION_LOTE}
+        if simulacion:
+            async with models.engine.connect() as conexion:
+                return await conexion.scalar(contar, {**parametros, "desde": desde})
+        total = 0
+        while True:
+            try:
+                async with models.engine.begin() as conexion:
+                    await conexion.execute(text(f"SET LOCAL lock_timeout = {RETENCION_LOCK_TIMEOUT_MS}"))
+                    borradas = (await conexion.execute(borrar, parametros)).rowcount
+            except DBAPIError as e:
+                logger.warning(f"Retención interrumpida: {e}")
+                informe["errores"].append(str(e.orig))
+                return total
+            total += borradas
+            if borradas < RETENCION_LOTE:
+                return total
+            await asyncio.sleep(RETENCION_PAUSA_MS / 1000)
+
+    def estado(self):
+        return {
+            "intervalo_h": RETENCION_INTERVALO_H,
+            "ejecuciones": self.ejecuciones,
+            "ultimo_informe": self.ultimo_informe,
+        }
+
+
+retencion = Retencion()
+
+
+async def mantener_retencion():
+    if not RETENCION_INTERVALO_H:
+        return
+    while True:
+        await asyncio.sleep(RETENCION_INTERVALO_H * 3600)
+        try:
+            await retencion.ejecutar()
+        except Exception as e:
+            logger.error(f"Error al aplicar la retención de lecturas: {e}")
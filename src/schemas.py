@@ -1,6 +1,6 @@
 import re
 from pydantic import BaseModel, EmailStr, Field
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from datetime import datetime
 import uuid
 from fastapi_users import schemas
@@ -17,6 +17,12 @@ class UserUpdate(schemas.BaseUserUpdate):
 class TipoSensorBase(BaseModel):
     tipo: str
     unidad: str
+    ventana_anomalias: Optional[int] = Field(None, ge=2)
+    umbral_z: Optional[float] = Field(None, gt=0)
+    detector: Optional[str] = None
+    parametros_detector: Optional[Dict[str, Any]] = None
+    retencion_dias: Optional[int] = Field(None, ge=1)
+    retencion_minuto_dias: Optional[int] = Field(None, ge=1)
 
 class TipoSensorCreate(TipoSensorBase):
     pass
@@ -26,6 +32,27 @@ class TipoSensorRead(TipoSensorBase):
 
     class Config:
         from_attributes = True
+class ConfiguracionAnomalias(BaseModel):
+    ventana_anomalias: Optional[int] = Field(None, ge=2)
+    umbral_z: Optional[float] = Field(None, gt=0)
+    detector: Optional[str] = None
+    parametros_detector: Optional[Dict[str, Any]] = None
+
+class ConfiguracionDetectorSensor(BaseModel):
+    # Sin detector, el sensor vuelve a usar el de su tipo
+    detector: Optional[str] = None
+    parametros_detector: Optional[Dict[str, Any]] = None
+
+class ConfiguracionRetencion(BaseModel):
+    # Sin valor, las lecturas del tipo se conservan según RETENCION_DIAS / RETENCION_MINUTO_DIAS
+    retencion_dias: Optional[int] = Field(None, ge=1)
+    retencion_minuto_dias: Optional[int] = Field(None, ge=1)
+
+class DetectorRead(BaseModel):
+    nombre: str
+    etiqueta: str
+    parametros: Dict[str, Any]
+
 class VerifyEmailSchema(BaseModel):
     email: str
     code: str
@@ -36,8 +63,6 @@ class SensorBase(BaseModel):
     nombre: str
     tipo_sensor_id: int
     maquina_id: int
-    estado: Optional[bool] = None
-    valor: Optional[float] = None
 
 class SensorListaRead(BaseModel):
     nombre: str
@@ -56,7 +81,20 @@ class SensorCreate(SensorBase):
 
 class SensorRead(SensorBase):
     id: int
+    detector: Optional[str] = None
+    parametros_detector: Optional[Dict[str, Any]] = None
+
+    class Config:
+        from_attributes = True
+
+class LecturaBase(BaseModel):
+    sensor_id: int
     fecha_hora: datetime
+    estado: Optional[bool] = None
+    valor: Optional[float] = None
+
+class LecturaRead(LecturaBase):
+    id: int
 
     class Config:
         from_attributes = True
@@ -84,6 +122,7 @@ class EventoCriticoCreate(EventoCriticoBase):
 
 class EventoCriticoRead(EventoCriticoBase):
     id: int
+    lectura_id: Optional[int] = None
     timestamp: datetime
 
     class Config:
@@ -100,6 +139,9 @@ class NotificacionCreate(NotificacionBase):
 class NotificacionRead(NotificacionBase):
     id: int
     sent_timestamp: datetime
+    intentos: int = 0
+    proximo_intento: Optional[datetime] = None
+    ultimo_error: Optional[str] = None
 
     class Config:
         from_attributes = True
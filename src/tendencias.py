@@ -0,0 +1,106 @@
+import asyncio
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.future import select
+from . import models
+from .agregados import consulta_agregados
+from .archivo import archivo
+
+SEGUNDOS_POR_HORA = 3600.0
+
+
+async def leer_series(db, sensor_ids, resolucion, fecha_inicio, maquina_id=None):
+    # Una fila por sensor con sus instantes (segundos epoch) y valores como arreglos de PostgreSQL:
+    # no se materializa un objeto por lectura y los arreglos pasan directo a NumPy.
+    # Con maquina_id, las lecturas crudas incluyen las del archivo frío.
+    if resolucion == "cruda":
+        sensor_id = models.Lectura.sensor_id
+        fecha_hora = models.Lectura.fecha_hora
+        valor = models.Lectura.valor
+        filtros = [sensor_id.in_(sensor_ids), fecha_hora >= fecha_inicio, valor.isnot(None)]
+        marca = archivo.marca() if maquina_id is not None else None
+        if marca:
+            # Lo anterior a la marca se lee del archivo frío
+            filtros.append(fecha_hora >= marca)
+    else:
+        # Media de cada ventana desde la tabla de agregados
+        agregados = consulta_agregados(sensor_ids, resolucion, fecha_inicio).subquery()
+        sensor_id = agregados.c.sensor_id
+        fecha_hora = agregados.c.inicio
+        valor = agregados.c.suma / agregados.c.cantidad
+        filtros = []
+
+    consulta = (
+        select(
+            sensor_id,
+            func.array_agg(aggregate_order_by(func.date_part("epoch", fecha_hora), fecha_hora)),
+            func.array_agg(aggregate_order_by(valor, fecha_hora))
+        )
+        .where(*filtros)
+        .group_by(sensor_id)
+    )
+    resultado = await db.execute(consulta)
+    series = {
+        id_sensor: (np.asarray(instantes, dtype=np.float64), np.asarray(valores, dtype=np.float64))
+        for id_sensor, instantes, valores in resultado.all()
+    }
+    if resolucion == "cruda" and maquina_id is not None:
+        archivadas = await asyncio.to_thread(archivo.series, maquina_id, marca, sensor_ids, fecha_inicio)
+        for id_sensor, (instantes, valores) in archivadas.items():
+            if id_sensor in series:
+                instantes = np.concatenate([instantes, series[id_sensor][0]])
+                valores = np.concatenate([valores, series[id_sensor][1]])
+            orden = np.argsort(instantes, kind="stable")
+            series[id_sensor] = (instantes[orden], valores[orden])
+    return series
+
+
+def regresion_lineal(grupos, x, y, cantidad_grupos):
+    # Mínimos cuadrados de cada grupo a la vez; las sumas se hacen sobre desvíos respecto de la
+    # media del grupo para no perder precisión con instantes grandes
+    n = np.bincount(grupos, minlength=cantidad_grupos).astype(np.float64)
+    media_x = np.bincount(grupos, x, cantidad_grupos) / n
+    media_y = np.bincount(grupos, y, cantidad_grupos) / n
+    dx = x - media_x[grupos]
+    dy = y - media_y[grupos]
+    sxx = np.bincount(grupos, dx * dx, cantidad_grupos)
+    sxy = np.bincount(grupos, dx * dy, cantidad_grupos)
+    syy = np.bincount(grupos, dy * dy, cantidad_grupos)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pendiente = np.where(sxx > 0, sxy / sxx, 0.0)
+        r_cuadrado = np.where((sxx > 0) & (syy > 0), sxy * sxy / (sxx * syy), 0.0)
+    intercepto = media_y - pendiente * media_x
+    return pendiente, intercepto, r_cuadrado
+
+
+def calcular_tendencias(series, origen):
+    # series: {clave: (instantes, valores)}; pendientes en unidades por hora desde 'origen' (epoch)
+    claves = list(series)
+    if not claves:
+        return {}
+    cantidades = [len(series[clave][0]) for clave in claves]
+    grupos = np.repeat(np.arange(len(claves)), cantidades)
+    x = (np.concatenate([series[clave][0] for clave in claves]) - origen) / SEGUNDOS_POR_HORA
+    y = np.concatenate([series[clave][1] for clave in claves])
+    pendiente, intercepto, r_cuadrado = regresion_lineal(grupos, x, y, len(claves))
+    return {
+        clave: {
+            "tendencia": clasificar_tendencia(pendiente[indice]),
+            "pendiente": float(pendiente[indice]),
+            "intercepto": float(intercepto[indice]),
+            "r_cuadrado": float(r_cuadrado[indice]),
+            "puntos": cantidades[indice],
+        }
+        for indice, clave in enumerate(claves)
+    }
+
+
+def clasificar_tendencia(pendiente):
+    return "creciente" if pendiente > 0 else "decreciente" if pendiente < 0 else "estable"
+
+
+def instantes_iso(instantes):
+    # Segundos epoch a ISO 8601 en UTC, igual que datetime.isoformat()
+    microsegundos = np.rint(instantes * 1e6).astype(np.int64).astype("datetime64[us]")
+    return [fecha + "+00:00" for fecha in np.datetime_as_string(microsegundos, unit="us")]
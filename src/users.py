@@ -1,9 +1,13 @@
 from datetime import datetime, timedelta, timezone
+import hashlib
+import time
 import uuid
+from collections import OrderedDict
 from typing import Optional
 
 from fastapi import Depends, Request
-from fastapi_users import BaseUserManager, FastAPIUsers, UUIDIDMixin
+import jwt
+from fastapi_users import BaseUserManager, FastAPIUsers, UUIDIDMixin, exceptions
 from fastapi_users.authentication import (
     AuthenticationBackend,
     BearerTransport,
@@ -12,7 +16,9 @@ from fastapi_users.authentication import (
 import os
 from dotenv import load_dotenv
 from fastapi_users.db import SQLAlchemyUserDatabase
-from .models import User, get_user_db
+from fastapi_users.jwt import decode_jwt
+from sqlalchemy.orm import make_transient_to_detached
+from .models import User, get_user_db, get_async_session
 from logging.config import dictConfig
 import logging
 from . import schemas
@@ -25,6 +31,10 @@ logger = logging.getLogger("SensorApi")
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
 SECRET_KEY = os.getenv('KEY', 'Insecure_key')
 USE_EMAILING = os.getenv("USE_EMAILING", False)
+# Segundos que se reutiliza un usuario ya autenticado sin volver a leerlo de la base;
+# es también la demora máxima con que se aplica una baja o desactivación hecha en otro proceso
+USUARIOS_CACHE_TTL_S = float(os.getenv("USUARIOS_CACHE_TTL_S", 30))
+USUARIOS_CACHE_MAX = int(os.getenv("USUARIOS_CACHE_MAX", 10000))
 if SECRET_KEY == 'Insecure_key':
     logger.warn('''no esta cargada la variable SECRET_KEY estas es necesaria para el correcto funcionamiento del sistema de autenticación
                 podes generarla con el siguiente comando python -c 'import secrets; print(secrets.token_urlsafe(26))
@@ -36,16 +46,81 @@ if USE_EMAILING:
     conf_correo = ConnectionConfig(
         MAIL_USERNAME = str(os.getenv("MAIL_USERNAME")),
         MAIL_PASSWORD = str(os.getenv("MAIL_PASSWORD")),
-        MAIL_FROM = str(os.getenv("MAIL_FROM")),
-        MAIL_PORT = 25,
+        MAIL_FROM = str(os.getenv("MAIL_FROM", "sistemas@bauduccosa.com.ar")),
+        MAIL_PORT = int(os.getenv("MAIL_PORT", 25)),
         MAIL_SERVER = str(os.getenv("MAIL_SERVER")),
-        MAIL_STARTTLS = os.getenv("MAIL_STARTTLS", True).lower() == "true",
-        MAIL_SSL_TLS = os.getenv("MAIL_SSL_TLS", False).lower() == "true",
-        USE_CREDENTIALS = True,
+        MAIL_STARTTLS = os.getenv("MAIL_STARTTLS", "True").lower() == "true",
+        MAIL_SSL_TLS = os.getenv("MAIL_SSL_TLS", "False").lower() == "true",
+        USE_CREDENTIALS = os.getenv("MAIL_USE_CREDENTIALS", "True").lower() == "true",
         VALIDATE_CERTS = True
     )
 
     fastmail = FastMail(conf_correo)
+class CacheUsuarios:
+    # Token ya validado -> columnas del usuario. Evita decodificar el JWT y leer la fila del
+    # usuario en cada solicitud; se invalida por usuario al modificarlo, desactivarlo o borrarlo.
+    def __init__(self, ttl=USUARIOS_CACHE_TTL_S, maximo=USUARIOS_CACHE_MAX):
+        self.ttl = ttl
+        self.maximo = maximo
+        self.entradas = OrderedDict()
+        self.por_usuario = {}
+        # Con la API en varios procesos, función que reenvía las invalidaciones al resto
+        self.difundir = None
+        self.aciertos = 0
+        self.fallos = 0
+
+    @staticmethod
+    def clave(token):
+        # No se guardan los tokens en claro
+        return hashlib.sha256(token.encode()).digest()
+
+    def obtener(self, token):
+        clave = self.clave(token)
+        entrada = self.entradas.get(clave)
+        if entrada is None or entrada[0] <= time.monotonic():
+            if entrada is not None:
+                self._quitar(clave)
+            self.fallos += 1
+            return None
+        self.entradas.move_to_end(clave)
+        self.aciertos += 1
+        # Copia separada por solicitud: una ruta que modifique al usuario no toca la entrada compartida
+        usuario = User(**entrada[1])
+        make_transient_to_detached(usuario)
+        return usuario
+
+    def guardar(self, token, usuario, expira):
+        clave = self.clave(token)
+        if clave in self.entradas:
+            self._quitar(clave)
+        columnas = {columna.key: getattr(usuario, columna.key) for columna in User.__table__.columns}
+        # No más allá del vencimiento del propio token
+        vence = time.monotonic() + min(self.ttl, max(expira - time.time(), 0) if expira else self.ttl)
+        self.entradas[clave] = (vence, columnas)
+        self.por_usuario.setdefault(usuario.id, set()).add(clave)
+        while len(self.entradas) > self.maximo:
+            self._quitar(next(iter(self.entradas)))
+
+    def _quitar(self, clave):
+        _, columnas = self.entradas.pop(clave)
+        claves = self.por_usuario.get(columnas["id"])
+        if claves is not None:
+            claves.discard(clave)
+            if not claves:
+                del self.por_usuario[columnas["id"]]
+
+    def invalidar(self, usuario_id, difundir=True):
+        for clave in list(self.por_usuario.get(usuario_id, ())):
+            self._quitar(clave)
+        if difundir and self.difundir:
+            self.difundir(str(usuario_id))
+
+    def estado(self):
+        return {"entradas": len(self.entradas), "aciertos": self.aciertos, "fallos": self.fallos, "ttl_s": self.ttl}
+
+
+cache_usuarios = CacheUsuarios()
+
 def generate_verification_code():
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
 
@@ -80,9 +155,20 @@ class UserManager(UUIDIDMixin, BaseUserManager[User, uuid.UUID]):
     ):
         logger.info(f"Verificación solicitada para el usuario {user.id}. Token de verificación: {token}")
 
+    async def on_after_update(self, user: User, update_dict, request: Optional[Request] = None):
+        # Incluye la desactivación (is_active) y el cambio de contraseña desde /users
+        cache_usuarios.invalidar(user.id)
+
+    async def on_after_reset_password(self, user: User, request: Optional[Request] = None):
+        cache_usuarios.invalidar(user.id)
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None):
+        cache_usuarios.invalidar(user.id)
+
     async def verify_user(self, user: User, code: str):
         if user.verification_code == code:
             await self.user_db.update(user, {"is_verified": True, "verification_code": None})
+            cache_usuarios.invalidar(user.id)
             return True
         return False
 
@@ -93,8 +179,30 @@ async def get_user_manager(user_db: SQLAlchemyUserDatabase = Depends(get_user_db
 
 bearer_transport = BearerTransport(tokenUrl="auth/jwt/login")
 
+class JWTStrategyCacheada(JWTStrategy):
+    async def read_token(self, token, user_manager):
+        if token is None:
+            return None
+        usuario = cache_usuarios.obtener(token)
+        if usuario is not None:
+            return usuario
+        # Misma validación que JWTStrategy.read_token, con una sola decodificación: el vencimiento del
+        # token sale de los mismos datos
+        try:
+            datos = decode_jwt(token, self.decode_key, self.token_audience, algorithms=[self.algorithm])
+        except jwt.PyJWTError:
+            return None
+        if datos.get("sub") is None:
+            return None
+        try:
+            usuario = await user_manager.get(user_manager.parse_id(datos["sub"]))
+        except (exceptions.UserNotExists, exceptions.InvalidID):
+            return None
+        cache_usuarios.guardar(token, usuario, datos.get("exp"))
+        return usuario
+
 def get_jwt_strategy() -> JWTStrategy:
-    return JWTStrategy(secret=SECRET_KEY, lifetime_seconds=3600)
+    return JWTStrategyCacheada(secret=SECRET_KEY, lifetime_seconds=3600)
 
 auth_backend = AuthenticationBackend(
     name="jwt",
@@ -104,4 +212,14 @@ auth_backend = AuthenticationBackend(
 
 fastapi_users = FastAPIUsers[User, uuid.UUID](get_user_manager, [auth_backend])
 
-current_active_user = fastapi_users.current_user(active=True)
\ No newline at end of file
+current_active_user = fastapi_users.current_user(active=True)
+
+async def usuario_activo_desde_token(token):
+    # Misma validación que current_active_user para conexiones WebSocket, que no llevan la cabecera Authorization
+    if not token:
+        return None
+    async with get_async_session() as session:
+        usuario = await get_jwt_strategy().read_token(token, UserManager(SQLAlchemyUserDatabase(session, User)))
+    if usuario is None or not usuario.is_active:
+        return None
+    return usuario
\ No newline at end of file
@@ -0,0 +1,321 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from collections import defaultdict, deque
+
+import msgpack
+import numpy as np
+from prometheus_client import REGISTRY
+
+# Benchmark de la ingesta con el pipeline real (escuchar -> ColaIngesta -> LoteIngesta/registrar_lecturas)
+# contra la base configurada en .env (DB_HOST, DB_USER, ...). Escribe lecturas de verdad: usar una
+# base local o de pruebas. Sin --broker, los mensajes pasan por un broker en memoria que reemplaza
+# a aiomqtt; con --broker se publica y se escucha a través de un Mosquitto real.
+#
+#   python test_arduino_simulation/benchmark_ingesta.py --maquinas 20 --sensores 12 --hz 5 --duracion 60
+#   python test_arduino_simulation/benchmark_ingesta.py --formato struct --max-p99-ms 500 --min-lecturas-s 1000
+#
+# Termina con código 1 si no se cumplen los umbrales, para usarlo como control de regresiones.
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [DIRECTORIO, os.path.dirname(DIRECTORIO)]
+
+from main import SensorSimulator  # noqa: E402
+from src import main as api, models  # noqa: E402
+from simulador_vectorizado import FuenteVectorizada  # noqa: E402
+from src.cargas import codificar_struct, decodificar_lote  # noqa: E402
+
+# (tipo de sensor, getter del simulador); los sensores de cada máquina recorren esta lista
+TIPOS_SIMULADOS = (
+    ("boolean", "get_motor_external_status"),
+    ("boolean", "get_motor_internal_status"),
+    ("energia", "get_energy"),
+    ("volumen", "get_flow_rate"),
+    ("distancia", "get_distance"),
+    ("boolean", "get_activity"),
+)
+ETAPAS = ("decodificacion", "escritura_db", "analisis_anomalias")
+
+
+class MensajeLocal:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class BrokerLocal:
+    # Sustituto en memoria del broker: escuchar() recorre .messages igual que con un aiomqtt.Client
+    def __init__(self, tamano=100000):
+        self.cola = asyncio.Queue(tamano)
+
+    async def publish(self, tema, carga):
+        await self.cola.put(MensajeLocal(tema, carga))
+
+    async def cerrar(self):
+        # escuchar() termina después de encolar el último mensaje
+        await self.cola.put(None)
+
+    @property
+    def messages(self):
+        return self._mensajes()
+
+    async def _mensajes(self):
+        while True:
+            mensaje = await self.cola.get()
+            if mensaje is None:
+                return
+            yield mensaje
+
+
+class FuenteSimulador:
+    # N máquinas con M sensores cada una, a partir del SensorSimulator del simulador de la estación.
+    # Cada tick devuelve los mensajes a publicar como [(tema, carga, claves_lecturas)].
+    def __init__(self, maquinas, sensores, formato, prefijo):
+        self.formato = formato
+        self.maquinas = [
+            (
+                f"{prefijo}_{indice_maquina}",
+                SensorSimulator(),
+                [
+                    (TIPOS_SIMULADOS[indice % len(TIPOS_SIMULADOS)][0], f"s{indice}", TIPOS_SIMULADOS[indice % len(TIPOS_SIMULADOS)][1])
+                    for indice in range(sensores)
+                ],
+            )
+            for indice_maquina in range(maquinas)
+        ]
+
+    def tick(self):
+        mensajes = []
+        instante = time.time()
+        for maquina, simulador, sensores in self.maquinas:
+            simulador.update()
+            valores = [(tipo, nombre, getattr(simulador, getter)()) for tipo, nombre, getter in sensores]
+            if self.formato == "texto":
+                for tipo, nombre, valor in valores:
+                    carga = f"{valor:.2f}" if isinstance(valor, float) else str(valor)
+                    mensajes.append((f"maquinas/{maquina}/{tipo}/{nombre}", carga.encode(), [(maquina, tipo, nombre)]))
+                continue
+            claves = [(maquina, tipo, nombre) for tipo, nombre, _ in valores]
+            if self.formato == "struct":
+                carga = codificar_struct([(tipo, nombre, float(valor), instante) for tipo, nombre, valor in valores])
+            else:
+                filas = [[tipo, nombre, valor, instante] for tipo, nombre, valor in valores]
+                carga = json.dumps(filas).encode() if self.formato == "json" else msgpack.packb(filas)
+            mensajes.append((f"lotes/{maquina}/{self.formato}", carga, claves))
+        return mensajes
+
+
+class Medicion:
+    # Empareja cada lectura confirmada con el instante en que se publicó: las lecturas de un sensor
+    # se procesan en orden, así que alcanza con una cola FIFO por sensor
+    def __init__(self):
+        self.publicadas = defaultdict(deque)
+        self.latencias = []
+        self.primera_publicacion = None
+        self.ultima_confirmacion = None
+        self.cantidad_publicada = 0
+
+    def publicada(self, claves, instante):
+        if self.primera_publicacion is None:
+            self.primera_publicacion = instante
+        for clave in claves:
+            self.publicadas[clave].append(instante)
+        self.cantidad_publicada += len(claves)
+
+    def confirmadas(self, lecturas):
+        ahora = time.perf_counter()
+        for lectura in lecturas:
+            pendientes = self.publicadas.get((lectura["maquina"], lectura["tipo"], lectura["nombre"]))
+            if pendientes:
+                self.latencias.append(ahora - pendientes.popleft())
+        self.ultima_confirmacion = ahora
+
+
+def memoria_mb():
+    with open("/proc/self/statm") as archivo:
+        paginas = int(archivo.read().split()[1])
+    return paginas * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def etapas_ms():
+    resultado = {}
+    for etapa in ETAPAS:
+        cantidad = REGISTRY.get_sample_value("sensores_etapa_segundos_count", {"etapa": etapa}) or 0
+        suma = REGISTRY.get_sample_value("sensores_etapa_segundos_sum", {"etapa": etapa}) or 0
+        resultado[etapa] = {"llamadas": int(cantidad), "media_ms": round(suma / cantidad * 1000, 3) if cantidad else None}
+    return resultado
+
+
+def instrumentar(medicion):
+    # Envoltorios de las funciones reales del pipeline: solo registran cuándo quedó confirmada cada lectura
+    async def volcar_medido(lecturas):
+        await api.volcar_lote(lecturas)
+        medicion.confirmadas(lecturas)
+
+    async def procesar_medido(indice_trabajador, tema, carga_util):
+        await api.procesar_mensaje(indice_trabajador, tema, carga_util)
+        if not api.lotes_ingesta:
+            medicion.confirmadas(claves_de(tema, carga_util))
+
+    return procesar_medido, volcar_medido
+
+
+def claves_de(tema, carga_util):
+    # Sin lotes de escritura, procesar_mensaje vuelve con las lecturas ya confirmadas
+    partes = tema.split("/")
+    if partes[0] == "maquinas":
+        return [{"maquina": partes[1], "tipo": partes[2], "nombre": partes[3]}]
+    return decodificar_lote(partes[1], partes[2], carga_util)
+
+
+async def publicar(fuente, destino, medicion, hz, duracion):
+    # Planificación absoluta: un tick que se atrasa no corre a los siguientes
+    periodo = 1 / hz
+    inicio = time.perf_counter()
+    ticks = int(duracion * hz)
+    atrasados = 0
+    generacion = 0.0
+    for tick in range(ticks):
+        objetivo = inicio + tick * periodo
+        espera = objetivo - time.perf_counter()
+        if espera > 0:
+            await asyncio.sleep(espera)
+        elif espera < -periodo:
+            atrasados += 1
+        antes = time.perf_counter()
+        mensajes = fuente.tick()
+        generacion += time.perf_counter() - antes
+        for tema, carga, claves in mensajes:
+            medicion.publicada(claves, time.perf_counter())
+            await destino.publish(tema, carga)
+    return {"ticks": ticks, "ticks_atrasados": atrasados, "generacion_s": round(generacion, 3)}
+
+
+async def ejecutar(args):
+    await models.create_db_and_tables()
+    await models.initialize_sensor_types()
+    await api.cache_dimensiones.calentar()
+    await api.motor_anomalias.cargar_configuracion()
+
+    medicion = Medicion()
+    procesar_medido, volcar_medido = instrumentar(medicion)
+    api.iniciar_ingesta(procesar_medido, volcar_medido)
+    if args.simulador == "vectorizado":
+        fuente = FuenteVectorizada(args.maquinas, args.sensores, args.formato, args.prefijo)
+    else:
+        fuente = FuenteSimulador(args.maquinas, args.sensores, args.formato, args.prefijo)
+    memoria_inicial = memoria_mb()
+
+    if args.broker:
+        import aiomqtt
+        host, _, puerto = args.broker.partition(":")
+        async with aiomqtt.Client(host, int(puerto or 1883)) as suscriptor, aiomqtt.Client(host, int(puerto or 1883)) as publicador:
+            await suscriptor.subscribe("maquinas/+/+/+")
+            await suscriptor.subscribe("lotes/+/+")
+            lector = asyncio.create_task(api.escuchar(suscriptor))
+            publicacion = await publicar(fuente, publicador, medicion, args.hz, args.duracion)
+            await esperar_confirmaciones(medicion, args.espera_final)
+            lector.cancel()
+    else:
+        broker = BrokerLocal()
+        lector = asyncio.create_task(api.escuchar(broker))
+        publicacion = await publicar(fuente, broker, medicion, args.hz, args.duracion)
+        await broker.cerrar()
+        await lector
+
+    await api.detener_ingesta()
+    return resumen(args, medicion, publicacion, memoria_inicial)
+
+
+async def esperar_confirmaciones(medicion, espera_maxima):
+    # Con un broker real no hay forma de saber si quedan mensajes en vuelo: se espera a que
+    # todas las lecturas publicadas se confirmen o a que venza el plazo
+    limite = time.perf_counter() + espera_maxima
+    while time.perf_counter() < limite and len(medicion.latencias) < medicion.cantidad_publicada:
+        await asyncio.sleep(0.1)
+
+
+def resumen(args, medicion, publicacion, memoria_inicial):
+    latencias = np.array(medicion.latencias) * 1000
+    duracion = (medicion.ultima_confirmacion or time.perf_counter()) - (medicion.primera_publicacion or time.perf_counter())
+    percentiles = np.percentile(latencias, [50, 90, 99]) if len(latencias) else [None] * 3
+    return {
+        "configuracion": {
+            "maquinas": args.maquinas,
+            "sensores": args.sensores,
+            "hz": args.hz,
+            "duracion_s": args.duracion,
+            "formato": args.formato,
+            "simulador": args.simulador,
+            "broker": args.broker or "local",
+            "lotes": bool(api.lotes_ingesta),
+        },
+        "ofrecidas_s": args.maquinas * args.sensores * args.hz,
+        "publicadas": medicion.cantidad_publicada,
+        "confirmadas": len(latencias),
+        "perdidas": medicion.cantidad_publicada - len(latencias),
+        "lecturas_s": round(len(latencias) / duracion, 1) if duracion > 0 else None,
+        "latencia_ms": {
+            "p50": round(float(percentiles[0]), 2) if len(latencias) else None,
+            "p90": round(float(percentiles[1]), 2) if len(latencias) else None,
+            "p99": round(float(percentiles[2]), 2) if len(latencias) else None,
+            "max": round(float(latencias.max()), 2) if len(latencias) else None,
+        },
+        "memoria_mb": {
+            "inicial": round(memoria_inicial, 1),
+            "final": round(memoria_mb(), 1),
+            "pico": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+        "publicador": publicacion,
+        "etapas": etapas_ms(),
+        "cola": api.cola_ingesta.estado(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la ingesta de lecturas")
+    parser.add_argument("--maquinas", type=int, default=10)
+    parser.add_argument("--sensores", type=int, default=6, help="Sensores por máquina")
+    parser.add_argument("--hz", type=float, default=1, help="Lecturas por segundo de cada sensor")
+    parser.add_argument("--duracion", type=float, default=30, help="Segundos publicando")
+    parser.add_argument("--formato", choices=("texto", "json", "msgpack", "struct"), default="texto")
+    parser.add_argument("--broker", help="host[:puerto] de un broker MQTT real; por defecto, broker en memoria")
+    parser.add_argument(
+        "--simulador", choices=("clasico", "vectorizado"), default="clasico",
+        help="SensorSimulator por máquina o el simulador vectorizado (para miles de sensores)"
+    )
+    parser.add_argument("--prefijo", default="bench", help="Prefijo de los nombres de máquina")
+    parser.add_argument("--espera-final", type=float, default=30, help="Segundos para confirmar lo publicado (con --broker)")
+    parser.add_argument("--min-lecturas-s", type=float, help="Falla si el throughput sostenido es menor")
+    parser.add_argument("--max-p99-ms", type=float, help="Falla si la latencia p99 es mayor")
+    parser.add_argument("--salida-json", help="Guarda el resultado en este archivo")
+    parser.add_argument("--nivel-log", default="WARNING", help="Nivel del logger de la API durante la prueba")
+    args = parser.parse_args()
+    # El log por lote de la API en DEBUG distorsiona la medición
+    logging.getLogger("SensorApi").setLevel(args.nivel_log)
+
+    resultado = asyncio.run(ejecutar(args))
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    print(texto)
+    if args.salida_json:
+        with open(args.salida_json, "w") as archivo:
+            archivo.write(texto)
+
+    fallas = []
+    if args.min_lecturas_s is not None and (resultado["lecturas_s"] or 0) < args.min_lecturas_s:
+        fallas.append(f"throughput {resultado['lecturas_s']} < {args.min_lecturas_s} lecturas/s")
+    p99 = resultado["latencia_ms"]["p99"]
+    if args.max_p99_ms is not None and (p99 is None or p99 > args.max_p99_ms):
+        fallas.append(f"latencia p99 {p99} > {args.max_p99_ms} ms")
+    if fallas:
+        print("FALLA: " + "; ".join(fallas), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import msgpack
+import numpy as np
+
+# Simulador de planta: las mismas estaciones que main.py (SensorSimulator), pero generadas con NumPy
+# para miles de sensores a la vez y publicadas con asyncio a una tasa controlada.
+#
+#   python simulador_vectorizado.py generar --broker localhost --maquinas 500 --sensores 12 --hz 2 --formato struct
+#   python simulador_vectorizado.py generar --maquinas 50 --duracion 60 --grabar captura.bin
+#   python simulador_vectorizado.py capturar --broker localhost --duracion 300 --salida captura.bin
+#   python simulador_vectorizado.py reproducir captura.bin --broker localhost --velocidad 20
+#
+# Sin --broker los mensajes no se envían a ningún lado (sirve para grabar o medir la generación).
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [DIRECTORIO, os.path.dirname(DIRECTORIO)]
+
+from main import NORMAL_MODE, FAILURE_MODE, MAINTENANCE_MODE  # noqa: E402
+from src.cargas import CABECERA_STRUCT, MAGIA_STRUCT, REGISTRO_STRUCT  # noqa: E402
+
+FORMATOS = ("texto", "json", "msgpack", "struct")
+VERSION_CAPTURA = 1
+
+# Sensores de una estación en el orden de main.py; con más sensores por máquina la lista se repite
+MOTOR, ENERGIA, CAUDAL, DISTANCIA, ACTIVIDAD = range(5)
+SENSORES_ESTACION = (
+    ("boolean", "motor_externo", MOTOR),
+    ("boolean", "motor_interno", MOTOR),
+    ("energia", "torcha", ENERGIA),
+    ("volumen", "caudalimetro", CAUDAL),
+    ("distancia", "encoder", DISTANCIA),
+    ("boolean", "actividad", ACTIVIDAD),
+)
+# Por clase de sensor, los mismos parámetros que los getters de SensorSimulator:
+# rango en mantenimiento, rango en falla, paso de la tendencia, ruido y amplitud de la oscilación
+PARAMETROS_ANALOGICOS = {
+    ENERGIA: ((0, 10), (80, 120), 5, 2, 0),
+    CAUDAL: ((0, 5), (90, 110), 2, 1, 0),
+    DISTANCIA: ((0, 1), (95, 105), 1, 0, 10),
+}
+# Probabilidad de estar encendido en falla y en modo normal (los motores en normal conservan su estado)
+PROBABILIDAD_BOOLEANOS = {MOTOR: (0.2, None), ACTIVIDAD: (0.5, 0.8)}
+PROBABILIDAD_CAMBIO_MODO = 0.01
+PROBABILIDAD_CAMBIO_MOTOR = 0.1
+TENDENCIA_INICIAL = 50
+
+
+class SimuladorVectorizado:
+    # Un SensorSimulator por máquina, con el estado de todas las máquinas en arreglos (máquinas x sensores).
+    # Cada paso equivale a un update() seguido de la lectura de todos los sensores.
+    def __init__(self, maquinas, sensores, semilla=None):
+        self.rng = np.random.default_rng(semilla)
+        self.maquinas = maquinas
+        # Desde la segunda vuelta los nombres llevan sufijo para que cada sensor sea único
+        self.sensores = []
+        for indice in range(sensores):
+            vuelta, posicion = divmod(indice, len(SENSORES_ESTACION))
+            tipo, nombre, clase = SENSORES_ESTACION[posicion]
+            self.sensores.append((tipo, f"{nombre}_{vuelta}" if vuelta else nombre, clase))
+        clases = np.array([clase for _, _, clase in self.sensores])
+        self.motor = clases == MOTOR
+        self.booleano = self.motor | (clases == ACTIVIDAD)
+
+        parametros = [PARAMETROS_ANALOGICOS.get(clase, ((0, 0), (0, 0), 0, 0, 0)) for clase in clases]
+        self.bajo_mantenimiento = np.array([p[0][0] for p in parametros], dtype=float)
+        self.ancho_mantenimiento = np.array([p[0][1] - p[0][0] for p in parametros], dtype=float)
+        self.bajo_falla = np.array([p[1][0] for p in parametros], dtype=float)
+        self.ancho_falla = np.array([p[1][1] - p[1][0] for p in parametros], dtype=float)
+        self.paso_tendencia = np.array([p[2] for p in parametros], dtype=float)
+        self.ruido = np.array([p[3] for p in parametros], dtype=float)
+        self.oscilacion = np.array([p[4] for p in parametros], dtype=float)
+        probabilidades = [PROBABILIDAD_BOOLEANOS.get(clase, (0, None)) for clase in clases]
+        self.probabilidad_falla = np.array([p[0] for p in probabilidades])
+        self.probabilidad_normal = np.array([p[1] or 0 for p in probabilidades])
+
+        self.tiempo = 0
+        self.modos = np.full(maquinas, NORMAL_MODE, dtype=np.int8)
+        self.tendencias = np.full((maquinas, sensores), TENDENCIA_INICIAL, dtype=float)
+        self.encendidos = np.zeros((maquinas, sensores), dtype=bool)
+
+    def paso(self):
+        forma = (self.maquinas, len(self.sensores))
+        self.tiempo += 1
+        cambia = self.rng.random(self.maquinas) < PROBABILIDAD_CAMBIO_MODO
+        self.modos[cambia] = self.rng.choice([NORMAL_MODE, FAILURE_MODE, MAINTENANCE_MODE], cambia.sum())
+        modo = self.modos[:, None]
+        normal = modo == NORMAL_MODE
+        falla = modo == FAILURE_MODE
+        mantenimiento = modo == MAINTENANCE_MODE
+        azar = self.rng.random(forma)
+
+        # Analógicos: en modo normal la tendencia hace una caminata acotada a [0, 100]
+        self.tendencias += np.where(normal, self.rng.uniform(-1, 1, forma) * self.paso_tendencia, 0)
+        np.clip(self.tendencias, 0, 100, out=self.tendencias)
+        valores = np.where(
+            mantenimiento, self.bajo_mantenimiento + azar * self.ancho_mantenimiento,
+            np.where(
+                falla, self.bajo_falla + azar * self.ancho_falla,
+                self.tendencias + self.rng.uniform(-1, 1, forma) * self.ruido + self.oscilacion * np.sin(self.tiempo / 10)
+            )
+        )
+
+        # Motores: en normal alternan su estado con 10% de probabilidad; en falla se sortean sin cambiarlo
+        self.encendidos ^= normal & self.motor & (self.rng.random(forma) < PROBABILIDAD_CAMBIO_MOTOR)
+        booleanos = ~mantenimiento & np.where(
+            falla, azar < self.probabilidad_falla,
+            np.where(self.motor, self.encendidos, azar < self.probabilidad_normal)
+        )
+        return np.where(self.booleano, booleanos, valores), self.modos.copy()
+
+    def bloque(self, pasos):
+        # (pasos x máquinas x sensores) valores y (pasos x máquinas) modos; los booleanos quedan como 0/1
+        valores = np.empty((pasos, self.maquinas, len(self.sensores)))
+        modos = np.empty((pasos, self.maquinas), dtype=np.int8)
+        for indice in range(pasos):
+            valores[indice], modos[indice] = self.paso()
+        return valores, modos
+
+
+class Codificador:
+    # Arma los mensajes MQTT de un paso con los temas y cargas que acepta la API
+    def __init__(self, nombres_maquinas, sensores, formato):
+        self.formato = formato
+        self.nombres_maquinas = nombres_maquinas
+        self.sensores = sensores
+        self.booleano = [tipo == "boolean" for tipo, _, _ in sensores]
+        self.claves = [[(maquina, tipo, nombre) for tipo, nombre, _ in sensores] for maquina in nombres_maquinas]
+        if formato == "texto":
+            self.temas = [[f"maquinas/{maquina}/{tipo}/{nombre}" for tipo, nombre, _ in sensores] for maquina in nombres_maquinas]
+        else:
+            self.temas = [f"lotes/{maquina}/{formato}" for maquina in nombres_maquinas]
+        if formato == "struct":
+            # Cabecera y tabla de sensores son iguales en todos los mensajes: se arman una sola vez
+            tabla = b"".join(
+                bytes([len(campo)]) + campo for tipo, nombre, _ in sensores for campo in (tipo.encode(), nombre.encode())
+            )
+            self.prefijo_struct = CABECERA_STRUCT.pack(MAGIA_STRUCT, len(sensores), len(sensores)) + tabla
+
+    def mensajes(self, valores, instante):
+        # [(tema, carga, claves)] de un paso; valores: (máquinas x sensores)
+        if self.formato == "struct":
+            registros = np.empty(valores.shape, REGISTRO_STRUCT)
+            registros["sensor"] = np.arange(valores.shape[1])
+            registros["ts"] = instante
+            registros["valor"] = valores
+            return [
+                (tema, self.prefijo_struct + registros[indice].tobytes(), claves)
+                for indice, (tema, claves) in enumerate(zip(self.temas, self.claves))
+            ]
+        mensajes = []
+        for temas, fila, claves in zip(self.temas, valores.tolist(), self.claves):
+            if self.formato == "texto":
+                for tema, valor, booleano, clave in zip(temas, fila, self.booleano, claves):
+                    mensajes.append((tema, (str(valor == 1) if booleano else f"{valor:.2f}").encode(), [clave]))
+                continue
+            filas = [
+                [tipo, nombre, valor == 1 if booleano else round(valor, 2), instante]
+                for (tipo, nombre, _), valor, booleano in zip(self.sensores, fila, self.booleano)
+            ]
+            carga = json.dumps(filas).encode() if self.formato == "json" else msgpack.packb(filas)
+            mensajes.append((temas, carga, claves))
+        return mensajes
+
+
+class FuenteVectorizada:
+    # Misma interfaz que FuenteSimulador de benchmark_ingesta: tick() -> [(tema, carga, claves)].
+    # Los valores se generan por bloques de pasos y se consumen de a uno.
+    def __init__(self, maquinas, sensores, formato, prefijo, semilla=None, pasos_por_bloque=64):
+        self.simulador = SimuladorVectorizado(maquinas, sensores, semilla)
+        self.codificador = Codificador(
+            [f"{prefijo}_{indice}" for indice in range(maquinas)], self.simulador.sensores, formato
+        )
+        self.pasos_por_bloque = pasos_por_bloque
+        self._bloque = None
+        self._posicion = 0
+
+    def tick(self):
+        if self._bloque is None or self._posicion == len(self._bloque):
+            self._bloque, _ = self.simulador.bloque(self.pasos_por_bloque)
+            self._posicion = 0
+        valores = self._bloque[self._posicion]
+        self._posicion += 1
+        return self.codificador.mensajes(valores, time.time())
+
+
+class LimitadorTasa:
+    # Cubeta de fichas: como máximo 'por_segundo' mensajes sostenidos, con ráfagas de hasta un segundo
+    def __init__(self, por_segundo):
+        self.por_segundo = por_segundo
+        self.fichas = por_segundo
+        self._ultimo = time.perf_counter()
+
+    async def esperar(self, cantidad=1):
+        while True:
+            ahora = time.perf_counter()
+            self.fichas = min(self.por_segundo, self.fichas + (ahora - self._ultimo) * self.por_segundo)
+            self._ultimo = ahora
+            if self.fichas >= cantidad:
+                self.fichas -= cantidad
+                return
+            await asyncio.sleep((cantidad - self.fichas) / self.por_segundo)
+
+
+class DestinoNulo:
+    async def publish(self, tema, carga):
+        pass
+
+
+class Grabador:
+    # Captura: stream MessagePack con una cabecera y luego [segundos desde el inicio, tema, carga] por mensaje
+    def __init__(self, ruta):
+        self.archivo = open(ruta, "wb")
+        self.packer = msgpack.Packer(use_bin_type=True)
+        self.inicio = time.time()
+        self.mensajes = 0
+        self.archivo.write(self.packer.pack({"version": VERSION_CAPTURA, "inicio": self.inicio}))
+
+    def registrar(self, tema, carga):
+        self.archivo.write(self.packer.pack([time.time() - self.inicio, tema, bytes(carga)]))
+        self.mensajes += 1
+
+    def cerrar(self):
+        self.archivo.close()
+
+
+async def publicar(fuente, destino, hz, duracion=None, mensajes_s=None, grabador=None):
+    # Un tick cada 1/hz segundos con planificación absoluta; duracion None publica sin fin.
+    # Con mensajes_s el envío se frena para no superar esa tasa aunque el tick quede atrasado.
+    periodo = 1 / hz
+    limitador = LimitadorTasa(mensajes_s) if mensajes_s else None
+    estadisticas = {"ticks": 0, "ticks_atrasados": 0, "mensajes": 0, "lecturas": 0, "generacion_s": 0.0}
+    inicio = time.perf_counter()
+    ultimo_reporte = inicio
+    while duracion is None or estadisticas["ticks"] < duracion * hz:
+        espera = inicio + estadisticas["ticks"] * periodo - time.perf_counter()
+        if espera > 0:
+            await asyncio.sleep(espera)
+        elif espera < -periodo:
+            estadisticas["ticks_atrasados"] += 1
+        antes = time.perf_counter()
+        mensajes = fuente.tick()
+        estadisticas["generacion_s"] += time.perf_counter() - antes
+        for tema, carga, claves in mensajes:
+            if limitador:
+                await limitador.esperar()
+            await destino.publish(tema, carga)
+            if grabador:
+                grabador.registrar(tema, carga)
+            estadisticas["lecturas"] += len(claves)
+        estadisticas["mensajes"] += len(mensajes)
+        estadisticas["ticks"] += 1
+        if time.perf_counter() - ultimo_reporte >= 5:
+            ultimo_reporte = time.perf_counter()
+            transcurrido = ultimo_reporte - inicio
+            print(
+                f"{transcurrido:.0f}s: {estadisticas['mensajes'] / transcurrido:.0f} mensajes/s, "
+                f"{estadisticas['lecturas'] / transcurrido:.0f} lecturas/s, {estadisticas['ticks_atrasados']} ticks atrasados"
+            )
+    estadisticas["generacion_s"] = round(estadisticas["generacion_s"], 3)
+    return estadisticas
+
+
+def reajustar_instantes(tema, carga, convertir):
+    # Los lotes llevan el instante de cada lectura: al reproducir se trasladan al presente y se
+    # comprimen según la velocidad. Los mensajes de un valor usan la hora de recepción.
+    partes = tema.split("/")
+    if partes[0] != "lotes" or len(partes) != 3:
+        return carga
+    try:
+        if partes[2] == "struct":
+            _, _, cantidad_registros = CABECERA_STRUCT.unpack_from(carga)
+            posicion = len(carga) - cantidad_registros * REGISTRO_STRUCT.itemsize
+            registros = np.frombuffer(carga, REGISTRO_STRUCT, cantidad_registros, posicion).copy()
+            # NaN (hora de recepción) sigue siendo NaN
+            registros["ts"] = convertir(registros["ts"])
+            return carga[:posicion] + registros.tobytes()
+        elementos = json.loads(carga) if partes[2] == "json" else msgpack.unpackb(carga)
+        for elemento in elementos:
+            if isinstance(elemento, dict) and isinstance(elemento.get("ts"), (int, float)):
+                elemento["ts"] = convertir(elemento["ts"])
+            elif isinstance(elemento, list) and len(elemento) >= 4 and isinstance(elemento[3], (int, float)):
+                elemento[3] = convertir(elemento[3])
+        return json.dumps(elementos).encode() if partes[2] == "json" else msgpack.packb(elementos)
+    except (ValueError, TypeError, IndexError, AttributeError, msgpack.UnpackException):
+        # Una carga inválida se reproduce tal como se capturó
+        return carga
+
+
+async def reproducir(ruta, destino, velocidad=1.0, reajustar=True):
+    with open(ruta, "rb") as archivo:
+        lector = msgpack.Unpacker(archivo, raw=False)
+        cabecera = next(lector)
+        if not isinstance(cabecera, dict) or cabecera.get("version") != VERSION_CAPTURA:
+            raise ValueError(f"{ruta} no es una captura del simulador")
+        inicio = time.perf_counter()
+        inicio_reproduccion = time.time()
+
+        def convertir(instante):
+            return inicio_reproduccion + (instante - cabecera["inicio"]) / velocidad
+
+        mensajes = 0
+        atraso_maximo = 0.0
+        for desplazamiento, tema, carga in lector:
+            espera = inicio + desplazamiento / velocidad - time.perf_counter()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            else:
+                atraso_maximo = max(atraso_maximo, -espera)
+            await destino.publish(tema, reajustar_instantes(tema, carga, convertir) if reajustar else carga)
+            mensajes += 1
+    duracion = time.perf_counter() - inicio
+    return {
+        "mensajes": mensajes,
+        "duracion_s": round(duracion, 3),
+        "mensajes_s": round(mensajes / duracion, 1) if duracion > 0 else None,
+        "atraso_maximo_s": round(atraso_maximo, 3),
+    }
+
+
+async def capturar(cliente, temas, ruta, duracion=None):
+    grabador = Grabador(ruta)
+    for tema in temas:
+        await cliente.subscribe(tema)
+
+    async def recibir():
+        async for mensaje in cliente.messages:
+            grabador.registrar(mensaje.topic.value, mensaje.payload)
+
+    try:
+        await asyncio.wait_for(recibir(), duracion)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        grabador.cerrar()
+    return {"mensajes": grabador.mensajes}
+
+
+async def con_destino(broker, funcion):
+    # funcion(destino) con un cliente aiomqtt si hay broker, o descartando los mensajes si no
+    if not broker:
+        return await funcion(DestinoNulo())
+    import aiomqtt
+    host, _, puerto = broker.partition(":")
+    async with aiomqtt.Client(host, int(puerto or 1883), max_queued_outgoing_messages=100000) as cliente:
+        return await funcion(cliente)
+
+
+async def ejecutar(args):
+    if args.comando == "generar":
+        fuente = FuenteVectorizada(args.maquinas, args.sensores, args.formato, args.prefijo, args.semilla)
+        grabador = Grabador(args.grabar) if args.grabar else None
+        try:
+            return await con_destino(
+                args.broker,
+                lambda destino: publicar(fuente, destino, args.hz, args.duracion, args.max_mensajes_s, grabador)
+            )
+        finally:
+            if grabador:
+                grabador.cerrar()
+    if args.comando == "reproducir":
+        return await con_destino(
+            args.broker,
+            lambda destino: reproducir(args.captura, destino, args.velocidad, not args.instantes_originales)
+        )
+    return await con_destino(args.broker, lambda cliente: capturar(cliente, args.temas, args.salida, args.duracion))
+
+
+def velocidad_valida(texto):
+    velocidad = float(texto)
+    if not 1 <= velocidad <= 100:
+        raise argparse.ArgumentTypeError("la velocidad debe estar entre 1 y 100")
+    return velocidad
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulador vectorizado de sensores")
+    subcomandos = parser.add_subparsers(dest="comando", required=True)
+
+    generar = subcomandos.add_parser("generar", help="Genera y publica lecturas simuladas")
+    generar.add_argument("--broker", help="host[:puerto] del broker MQTT; sin él no se publica")
+    generar.add_argument("--maquinas", type=int, default=100)
+    generar.add_argument("--sensores", type=int, default=len(SENSORES_ESTACION), help="Sensores por máquina")
+    generar.add_argument("--hz", type=float, default=1, help="Lecturas por segundo de cada sensor")
+    generar.add_argument("--duracion", type=float, help="Segundos publicando; sin límite si no se indica")
+    generar.add_argument("--formato", choices=FORMATOS, default="texto")
+    generar.add_argument("--max-mensajes-s", type=float, help="Tope de mensajes MQTT por segundo")
+    generar.add_argument("--prefijo", default="estacion", help="Prefijo de los nombres de máquina")
+    generar.add_argument("--semilla", type=int, help="Semilla para repetir la misma simulación")
+    generar.add_argument("--grabar", help="Guarda lo publicado en esta captura")
+
+    reproduccion = subcomandos.add_parser("reproducir", help="Reproduce una captura")
+    reproduccion.add_argument("captura")
+    reproduccion.add_argument("--broker", help="host[:puerto] del broker MQTT; sin él no se publica")
+    reproduccion.add_argument("--velocidad", type=velocidad_valida, default=1.0, help="De 1 (tiempo real) a 100")
+    reproduccion.add_argument(
+        "--instantes-originales", action="store_true", help="No traslada al presente los instantes de los lotes"
+    )
+
+    captura = subcomandos.add_parser("capturar", help="Graba el tráfico de un broker")
+    captura.add_argument("--broker", required=True, help="host[:puerto] del broker MQTT")
+    captura.add_argument("--temas", nargs="+", default=["maquinas/#", "lotes/#"])
+    captura.add_argument("--duracion", type=float, help="Segundos capturando; sin límite si no se indica")
+    captura.add_argument("--salida", required=True)
+
+    args = parser.parse_args()
+    try:
+        print(json.dumps(asyncio.run(ejecutar(args)), indent=2, ensure_ascii=False))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()